@@ -1,17 +1,305 @@
 from deepface import DeepFace
-from image_handler import get_image_files
+from deepface.modules import preprocessing
+from image_handler import get_images, heic2png
+from represent_faces import detect_faces, sha256_hash
+import os
+import cv2
+import time
+import multiprocessing
+import numpy as np
 import json
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
 
-def analyze_face(image_path, detector_backend="retinaface", enforce_detection=True):
-    return DeepFace.analyze(
-            img_path=image_path,
-            detector_backend=detector_backend, 
-            enforce_detection=enforce_detection
-    )
+ACTIONS = ("age", "gender", "emotion", "race")
+MODEL_NAMES = {"age": "Age", "gender": "Gender", "emotion": "Emotion", "race": "Race"}
+LABELS = {
+    "gender": ["Woman", "Man"],
+    "emotion": ["angry", "disgust", "fear", "happy", "sad", "surprise", "neutral"],
+    "race": ["asian", "indian", "black", "white", "middle eastern", "latino hispanic"],
+}
 
-images = get_image_files("/Users/main/Projects/Docker/faces/test_images")
+def analyze_face(image_path, detector_backend="retinaface", enforce_detection=True, cache=None, actions=ACTIONS):
+    # Detections come from the face cache, so only the attribute models run on a repeat image
+    try:
+        faces = detect_faces(image_path, detector_backend=detector_backend, enforce_detection=enforce_detection, cache=cache)
+    except Exception as e:
+        return f"Error: {str(e)}"
 
-for image in images:
-    results = analyze_face(image)
-    print(f"File: {image.name}")
-    print(json.dumps(results, indent=4, sort_keys=True))
\ No newline at end of file
+    results = []
+    for face in faces:
+        result = DeepFace.analyze(
+                img_path=np.round(face["face"][:, :, ::-1] * 255).astype(np.uint8),
+                actions=actions,
+                detector_backend="skip",
+                enforce_detection=False
+        )[0]
+        result["region"] = face["facial_area"]
+        result["face_confidence"] = face["confidence"]
+        results.append(result)
+    return results
+
+# Function to run each requested attribute model once over a batch of aligned RGB face crops
+def predict_attributes(faces, actions=ACTIONS):
+    # The attribute models take 224x224 BGR crops; emotion converts them to 48x48 grayscale
+    batch = np.concatenate([
+        preprocessing.resize_image(img=face[:, :, ::-1], target_size=(224, 224))
+        for face in faces
+    ]).astype(np.float32)
+    results = [{} for _ in faces]
+
+    for action in actions:
+        model = DeepFace.build_model(MODEL_NAMES[action])
+        if action == "emotion":
+            gray = np.stack([cv2.resize(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), (48, 48)) for image in batch])
+            predictions = model.model.predict(gray[..., None], verbose=0)
+        else:
+            predictions = model.model.predict(batch, verbose=0)
+
+        for result, prediction in zip(results, predictions):
+            if action == "age":
+                result["age"] = float(prediction @ np.arange(len(prediction)))
+                continue
+            scores = 100 * prediction / prediction.sum()
+            result[action] = {label: float(score) for label, score in zip(LABELS[action], scores)}
+            result[f"dominant_{action}"] = LABELS[action][int(np.argmax(scores))]
+
+    return results
+
+# Function run in the worker processes: detect every image of a chunk, then batch all of its crops through each model
+def _analyze_chunk(images, actions, detector_backend, enforce_detection):
+    records, crops, owners = [], [], []
+    for image in images:
+        try:
+            # HEIC files are decoded in memory; the hash keeps their detections cacheable
+            pixels, image_hash = image, None
+            if heic2png.is_heic(image):
+                image_hash = sha256_hash(image)
+                pixels = heic2png.read_heic(image)
+                if pixels is None:
+                    raise ValueError("could not decode HEIC file")
+                pixels = np.ascontiguousarray(pixels[:, :, ::-1])
+
+            faces = detect_faces(pixels, detector_backend=detector_backend, enforce_detection=enforce_detection, file_hash=image_hash)
+            faces = [face for face in faces if face["confidence"]] if not enforce_detection else faces
+            records.append({
+                "image_path": str(image),
+                "faces": [{"region": face["facial_area"], "face_confidence": face["confidence"]} for face in faces],
+            })
+            crops.extend(face["face"] for face in faces)
+            owners.extend(records[-1]["faces"])
+
+        except Exception as e:
+            records.append({"image_path": str(image), "error": f"Error: {str(e)}"})
+
+    if crops:
+        try:
+            for face, attributes in zip(owners, predict_attributes(crops, actions)):
+                face.update(attributes)
+        except Exception as e:
+            # A failed batch only fails the images it held faces for, not the whole run
+            for record in records:
+                if "error" not in record and record["faces"]:
+                    record["error"] = f"Error: {str(e)}"
+    return records
+
+class JSONLinesOutput:
+    """
+    Appends one JSON object per analyzed image to a .jsonl file.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.file = None
+
+    def completed(self):
+        """
+        Image paths already analyzed. Records of failed images do not count, so they are analyzed again.
+        A final line cut short by an interrupted run is dropped from the file; other unreadable lines are
+        skipped but kept, so their images are analyzed again too.
+        """
+        if not self.path.exists():
+            return set()
+
+        done, offset = set(), 0
+        with open(self.path, "rb") as file:
+            for line in file:
+                # Every record is written with its newline, so only the last line can lack one
+                if not line.endswith(b"\n"):
+                    os.truncate(self.path, offset)
+                    break
+                try:
+                    record = json.loads(line)
+                    if "error" not in record:
+                        done.add(record["image_path"])
+                except (ValueError, KeyError, TypeError):
+                    pass
+                offset += len(line)
+        return done
+
+    def write(self, records):
+        if self.file is None:
+            self.file = open(self.path, "a")
+        for record in records:
+            self.file.write(json.dumps(record, default=float) + "\n")
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+class ParquetOutput:
+    """
+    Writes one row per face (or per image without faces) to a directory of Parquet part files.
+
+    Every `write` adds a new part file, so an interrupted run never leaves a half-written file behind
+    and the directory can be read as one dataset with `pandas.read_parquet`. Requires pyarrow.
+    """
+
+    def __init__(self, path, actions=ACTIONS):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as e:
+            raise ImportError("Parquet output requires pyarrow: pip install pyarrow") from e
+
+        self.pyarrow = pyarrow
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        fields = [("image_path", pyarrow.string()), ("face", pyarrow.int32()), ("error", pyarrow.string())]
+        fields += [(key, pyarrow.int32()) for key in ("x", "y", "w", "h")]
+        fields += [("face_confidence", pyarrow.float64())]
+        for action in actions:
+            if action == "age":
+                fields.append(("age", pyarrow.float64()))
+            else:
+                fields.append((f"dominant_{action}", pyarrow.string()))
+                fields += [(f"{action}_{label}", pyarrow.float64()) for label in LABELS[action]]
+        self.schema = pyarrow.schema(fields)
+
+    def completed(self):
+        # Rows of failed images carry an error, so those images are analyzed again
+        done = set()
+        for part in sorted(self.path.glob("part-*.parquet")):
+            table = self.pyarrow.parquet.read_table(part, columns=["image_path", "error"])
+            done.update(path for path, error in zip(table.column("image_path").to_pylist(), table.column("error").to_pylist()) if error is None)
+        return done
+
+    def rows(self, record):
+        if "error" in record or not record["faces"]:
+            return [{"image_path": record["image_path"], "face": -1, "error": record.get("error")}]
+
+        rows = []
+        for number, face in enumerate(record["faces"]):
+            row = {"image_path": record["image_path"], "face": number, "face_confidence": face["face_confidence"]}
+            row.update({key: face["region"][key] for key in ("x", "y", "w", "h")})
+            for key, value in face.items():
+                if isinstance(value, dict) and key != "region":
+                    row.update({f"{key}_{label}": score for label, score in value.items()})
+                elif key == "age" or key.startswith("dominant_"):
+                    row[key] = value
+            rows.append(row)
+        return rows
+
+    def write(self, records):
+        rows = [row for record in records for row in self.rows(record)]
+        table = self.pyarrow.Table.from_pylist(rows, schema=self.schema)
+        part = self.path / f"part-{time.time_ns()}.parquet"
+        tmp_path = part.with_name(part.name + ".tmp")
+        self.pyarrow.parquet.write_table(table, tmp_path)
+        os.replace(tmp_path, part)
+
+    def close(self):
+        pass
+
+def analyze_all(images, output, actions=ACTIONS, workers=None, chunk_size=16, flush_every=256,
+                detector_backend="retinaface", enforce_detection=False):
+    """
+    Analyzes a large set of images in parallel, streaming the results to a JSON Lines or Parquet output.
+
+    Args:
+        images (Iterable[Path]): Image files to analyze, e.g. from `get_images.iter_images`.
+        output (Union[str, Path]): A .jsonl file, or a .parquet directory of part files.
+        actions (Iterable[str]): Subset of "age", "gender", "emotion" and "race". Only these models are loaded.
+        workers (Optional[int]): Number of worker processes. Defaults to `os.cpu_count()`.
+        chunk_size (int): Images per task. All crops of a chunk go through each model as one batch. Defaults to 16.
+        flush_every (int): Number of analyzed images buffered between writes to the output. Defaults to 256.
+        detector_backend (str): DeepFace detector backend. Defaults to "retinaface".
+        enforce_detection (bool): If True, images without a detected face are reported as errors. Defaults to False.
+
+    Returns:
+        dict: Counts of analyzed, skipped (already in the output) and failed images, faces, and elapsed seconds.
+
+    Description:
+    - Each face is detected once (through the face cache) and its aligned crop is shared by every action.
+    - Workers each load the requested attribute models once and reuse them for every chunk they get.
+    - At most `workers * 4` chunks are in flight, so memory stays bounded on large archives.
+    - Images already present in `output` are skipped, so an interrupted run resumes where it stopped.
+    """
+    start = time.perf_counter()
+    actions = tuple(actions)
+    unknown = set(actions) - set(ACTIONS)
+    if unknown:
+        raise ValueError(f"Unknown actions: {', '.join(sorted(unknown))}")
+
+    workers = workers or os.cpu_count()
+    writer = ParquetOutput(output, actions) if Path(output).suffix == ".parquet" else JSONLinesOutput(output)
+    done = writer.completed()
+    report = {"analyzed": 0, "skipped": 0, "failed": 0, "faces": 0}
+    buffer = []
+
+    def collect(future):
+        for record in future.result():
+            if "error" in record:
+                print(f"Skipping {record['image_path']}: {record['error']}")
+                report["failed"] += 1
+            else:
+                report["analyzed"] += 1
+                report["faces"] += len(record["faces"])
+            buffer.append(record)
+        if len(buffer) >= flush_every:
+            writer.write(buffer)
+            buffer.clear()
+
+    def chunks():
+        chunk = []
+        for image in images:
+            if str(image) in done:
+                report["skipped"] += 1
+                continue
+            chunk.append(image)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    # Spawn rather than fork so workers never inherit the parent's TensorFlow state
+    context = multiprocessing.get_context("spawn")
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            in_flight = set()
+            for chunk in chunks():
+                if len(in_flight) >= workers * 4:
+                    finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        collect(future)
+                in_flight.add(executor.submit(_analyze_chunk, chunk, actions, detector_backend, enforce_detection))
+
+            for future in wait(in_flight).done:
+                collect(future)
+
+        if buffer:
+            writer.write(buffer)
+    finally:
+        writer.close()
+
+    report["seconds"] = time.perf_counter() - start
+    print(f"Analyzed {report['analyzed']} images ({report['faces']} faces), skipped {report['skipped']}, failed {report['failed']} in {report['seconds']:.2f}s")
+    return report
+
+if __name__ == "__main__":
+    # Example usage: Age and gender only, for every image under test_images, resumable
+    images = get_images.iter_images("/Users/main/Projects/Docker/faces/test_images")
+    analyze_all(images, "analysis.jsonl", actions=("age", "gender"))
@@ -0,0 +1,246 @@
+import os
+import sys
+import json
+import time
+import types
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import hashlib
+import numpy as np
+from pathlib import Path
+
+# Function to replace DeepFace with a deterministic CPU-only stub, so the suite runs offline
+def install_model_stub(dim=512):
+    def embedding_for(img_path):
+        data = Path(img_path).read_bytes() if isinstance(img_path, (str, Path)) else np.asarray(img_path).tobytes()
+        seed = int.from_bytes(hashlib.sha256(data).digest()[:8], "little")
+        return np.random.default_rng(seed).normal(size=dim)
+
+    facial_area = {"x": 0, "y": 0, "w": 112, "h": 112, "left_eye": None, "right_eye": None}
+
+    class DeepFace:
+        @staticmethod
+        def represent(img_path, **kwargs):
+            return [{"embedding": embedding_for(img_path).tolist(), "facial_area": facial_area, "face_confidence": 1.0}]
+
+        @staticmethod
+        def extract_faces(img_path, **kwargs):
+            face = np.full((112, 112, 3), embedding_for(img_path)[0] % 1, dtype=np.float32)
+            return [{"face": face, "facial_area": facial_area, "confidence": 1.0}]
+
+    deepface = types.ModuleType("deepface")
+    deepface.DeepFace = DeepFace
+    modules = types.ModuleType("deepface.modules")
+    preprocessing = types.ModuleType("deepface.modules.preprocessing")
+    verification = types.ModuleType("deepface.modules.verification")
+    verification.find_threshold = lambda model_name, distance_metric: 0.68
+    modules.preprocessing, modules.verification = preprocessing, verification
+    sys.modules.update({
+        "deepface": deepface,
+        "deepface.modules": modules,
+        "deepface.modules.preprocessing": preprocessing,
+        "deepface.modules.verification": verification,
+    })
+
+# Function to read the peak resident set size of this process in MiB
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if platform.system() == "Darwin" else peak / 1024
+
+# Function to summarize per-item latencies of one stage
+def summarize(latencies, items=None):
+    latencies = np.asarray(latencies, dtype=np.float64)
+    total = float(latencies.sum())
+    items = items if items is not None else len(latencies)
+    return {
+        "items": items,
+        "seconds": total,
+        "throughput_per_second": items / total if total > 0 else None,
+        "p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "p99_ms": float(np.percentile(latencies, 99) * 1000),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+# Function to time a callable once per item
+def time_each(function, items):
+    latencies = []
+    for item in items:
+        start = time.perf_counter()
+        function(item)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+# Function to write a folder of small synthetic images, one subfolder per person, plus some HEIC files
+def synthetic_image_folder(root, images=200, people=20, heic=20, size=(160, 160), seed=0):
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    root = Path(root)
+    for index in range(images):
+        folder = root / f"person_{index % people}"
+        folder.mkdir(parents=True, exist_ok=True)
+        pixels = rng.integers(0, 256, size=(*size, 3), dtype=np.uint8)
+        Image.fromarray(pixels).save(folder / f"{index}.{'png' if index % 2 else 'jpg'}")
+
+    heic_files = []
+    try:
+        import pillow_heif
+        for index in range(heic):
+            pixels = rng.integers(0, 256, size=(*size, 3), dtype=np.uint8)
+            heic_file = root / "heic" / f"{index}.heic"
+            heic_file.parent.mkdir(parents=True, exist_ok=True)
+            pillow_heif.from_bytes(mode="RGB", size=size[::-1], data=pixels.tobytes()).save(heic_file)
+            heic_files.append(heic_file)
+    except Exception as e:
+        print(f"Skipping HEIC files: {str(e)}")
+
+    return heic_files
+
+# Function to write a synthetic clustered gallery into a packed store
+def synthetic_store(root, faces, people, dim=512, seed=0, chunk_size=65536):
+    from embedding_store import EmbeddingStore
+
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(people, dim)).astype(np.float32)
+    store = EmbeddingStore(root, dim=dim)
+    for start in range(0, faces, chunk_size):
+        count = min(chunk_size, faces - start)
+        labels = rng.integers(0, people, size=count)
+        embeddings = centers[labels] + 0.6 * rng.normal(size=(count, dim)).astype(np.float32)
+        names = [f"{start + index:08d}" for index in range(count)]
+        store.append(embeddings, [f"person_{label}" for label in labels], names, [f"{name}.png" for name in names])
+    return store, centers
+
+def run(gallery_sizes=(1000, 10000, 100000), images=200, people=1000, queries=100, k=5, stub_models=True):
+    """
+    Times each stage of the pipeline on synthetic data.
+
+    Args:
+        gallery_sizes (Iterable[int]): Synthetic 512-d gallery sizes for the loading and search stages.
+        images (int): Number of synthetic images for discovery, hashing and pairwise comparison.
+        people (int): Number of synthetic identities in each gallery.
+        queries (int): Number of queries timed per search stage.
+        k (int): Matches returned per query.
+        stub_models (bool): If True, DeepFace is replaced by a deterministic stub so no model is loaded.
+
+    Returns:
+        dict: `meta` describing the run and `stages` mapping each stage name to its items, seconds,
+              throughput, p50/p99 latency and the process peak RSS after the stage.
+    """
+    if stub_models:
+        install_model_stub()
+
+    workdir = Path(tempfile.mkdtemp(prefix="face_benchmark_"))
+    os.environ["FACE_CACHE_DIR"] = str(workdir / "cache")
+    stages = {}
+
+    try:
+        from image_handler import get_images, heic2png
+        from image_handler.scanner import sha256_hash
+
+        image_folder = workdir / "images"
+        heic_files = synthetic_image_folder(image_folder, images=images)
+
+        # Discovery
+        start = time.perf_counter()
+        found = get_images.get_images(image_folder)
+        stages["discovery"] = summarize([time.perf_counter() - start], items=len(found))
+
+        # HEIC conversion, on copies so every run converts the same files
+        if heic_files:
+            copies = [shutil.copy(heic_file, workdir / heic_file.name) for heic_file in heic_files]
+            stages["heic2png"] = summarize(time_each(lambda file_path: heic2png.heic2png(file_path, keep_original=True), copies))
+            stages["read_heic"] = summarize(time_each(heic2png.read_heic, heic_files))
+
+        # Hashing
+        stages["sha256_hash"] = summarize(time_each(sha256_hash, found))
+
+        # Pairwise comparison with each image embedded once
+        from compare_faces import pairwise_verification
+        pair_images = [image for image in found if not heic2png.is_heic(image)]
+        start = time.perf_counter()
+        pairs = sum(1 for _ in pairwise_verification(pair_images))
+        stages["pairwise_comparison"] = summarize([time.perf_counter() - start], items=pairs)
+
+        from centroid_index import CentroidIndex
+        from embedding_store import EmbeddingStore
+
+        for size in gallery_sizes:
+            store, centers = synthetic_store(workdir / f"store_{size}", size, min(people, size))
+            rng = np.random.default_rng(1)
+            query_embeddings = centers[rng.integers(0, len(centers), size=queries)] + 0.6 * rng.normal(size=(queries, centers.shape[1])).astype(np.float32)
+
+            # Gallery loading
+            start = time.perf_counter()
+            gallery = EmbeddingStore(store.root).to_gallery()
+            stages[f"gallery_load_{size}"] = summarize([time.perf_counter() - start], items=size)
+
+            # Brute-force search, one query at a time and as one batch
+            stages[f"brute_force_search_{size}"] = summarize(time_each(lambda query: gallery.search(query, k), query_embeddings))
+            start = time.perf_counter()
+            gallery.search_batch(query_embeddings, k)
+            stages[f"brute_force_batch_{size}"] = summarize([time.perf_counter() - start], items=queries)
+
+            # Centroid search
+            index = CentroidIndex.from_gallery(gallery)
+            stages[f"centroid_search_{size}"] = summarize(time_each(lambda query: index.search(query, k), query_embeddings))
+
+            del gallery, index, store
+
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "stub_models": stub_models,
+            "gallery_sizes": list(gallery_sizes),
+            "images": images,
+            "queries": queries,
+        },
+        "stages": stages,
+    }
+
+# Function to compare a run against a stored baseline, returning the stages that got slower
+def compare(results, baseline, tolerance=0.2):
+    regressions = {}
+    for stage, metrics in results["stages"].items():
+        reference = baseline["stages"].get(stage)
+        if reference is None or not reference.get("throughput_per_second") or not metrics.get("throughput_per_second"):
+            continue
+        change = metrics["throughput_per_second"] / reference["throughput_per_second"] - 1
+        print(f"{stage:32s} {metrics['throughput_per_second']:14.1f}/s  ({change:+.1%} vs baseline)")
+        if change < -tolerance:
+            regressions[stage] = change
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time each pipeline stage on synthetic data.")
+    parser.add_argument("--gallery-sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--images", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--real-models", action="store_true", help="Use the installed DeepFace instead of the stub")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", help="Baseline JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed throughput drop before failing")
+    args = parser.parse_args()
+
+    results = run(args.gallery_sizes, images=args.images, queries=args.queries, stub_models=not args.real_models)
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}")
+            sys.exit(1)
+    else:
+        for stage, metrics in results["stages"].items():
+            print(f"{stage:32s} {metrics['items']:>8} items  p50 {metrics['p50_ms']:9.3f} ms  p99 {metrics['p99_ms']:9.3f} ms")
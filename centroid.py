@@ -1,8 +1,11 @@
 import numpy as np
-import json
-from image_handler import get_image_files
+from centroid_index import CentroidIndex
+from embedding_store import load_gallery
+from face_index import gallery_version
+from identify_faces import identify_all_faces
+from open_set import OpenSetSearcher, Thresholds, calibrate
 from pathlib import Path
-from represent_faces import get_vector
+import instrumentation
 
 """
 Closest match: Hunter Boon with distance 0.39313323365644914, file: 4.png
@@ -28,60 +31,42 @@ def normalize(vectors):
 def calculate_centroid(embeddings):
     return np.mean(embeddings, axis=0)
 
-# Example usage:
-metadata_file = "database/metadata.json"
-image_path = "testing/query_image.png"
-embeddings_folder = "database/embeddings"
-
-# Get the image file to process
-image = get_image_files(image_path)[0]
-query_vector = get_vector(image)[0]["embedding"]
-
-# Normalize the query vector
-query_vector = query_vector / np.linalg.norm(query_vector)
-
-# Load metadata
-with open(metadata_file) as file:
-    data = json.load(file)
-    saved_images = data["images"]
-
-# Organize embeddings by person
-person_embeddings = {}
-for saved_image in saved_images:
-    label = saved_image["label"]
-    embedding_path = saved_image["embedding_path"]
-    embedding = load_embedding(embedding_path)
-    
-    if label not in person_embeddings:
-        person_embeddings[label] = []
-    person_embeddings[label].append(embedding)
-
-# Calculate centroids for each person
-person_centroids = {}
-for person, embeddings in person_embeddings.items():
-    embeddings = np.array(embeddings)  # Convert to numpy array
-    embeddings = normalize(embeddings)  # Normalize the embeddings
-    person_centroids[person] = calculate_centroid(embeddings)  # Calculate centroid
-
-# Initialize the list to hold distances
-distances = {}
-
-# Iterate through the person centroids and calculate cosine distance to query
-for person, centroid in person_centroids.items():
-    distances[person] = cosine_distance(query_vector, centroid)
-
-# Find the person with the closest centroid
-closest_person = min(distances, key=distances.get)
-closest_distance = distances[closest_person]
-
-# Find the corresponding image for the closest match
-closest_image = None
-for saved_image in saved_images:
-    if saved_image["label"] == closest_person:
-        closest_image = saved_image["image_path"]
-        break
-
-# Output result
-import os
-os.system('cls||clear')
-print(f"Closest match: {closest_person} with distance {closest_distance}, file: {Path(closest_image).name}")
+if __name__ == "__main__":
+    # Example usage:
+    metadata_file = "database/metadata.json"
+    store_folder = "database/store"
+    centroid_index_file = "database/centroids.npz"
+    thresholds_file = "database/centroid_thresholds.npz"
+    image_path = "testing/query_image.png"
+
+    # Load the persisted centroid index, rebuilding it when the gallery changed since it was built
+    gallery = load_gallery(metadata_file, store_folder)
+    index = CentroidIndex.load(centroid_index_file) if Path(centroid_index_file).exists() else None
+    if index is None or index.version != gallery_version(gallery):
+        index = CentroidIndex.from_gallery(gallery)
+        index.save(centroid_index_file)
+        Path(thresholds_file).unlink(missing_ok=True)
+
+    # Calibrate thresholds on distances to centroids, so strangers come back as unknown
+    if Path(thresholds_file).exists():
+        thresholds = Thresholds.load(thresholds_file)
+    else:
+        thresholds = calibrate(gallery, centroid_index=index)
+        thresholds.save(thresholds_file)
+
+    # Score every face in the query image(s) against every person's int8-compressed centroid
+    results = identify_all_faces(image_path, OpenSetSearcher(index.quantized(codec="int8", rerank=10), thresholds), k=1)
+
+    # Output result
+    import os
+    os.system('cls||clear')
+    for result in results:
+        if isinstance(result["faces"], str):
+            print(f"Skipping {result['image_path']}: {result['faces']}")
+            continue
+        for face in result["faces"]:
+            match = face["matches"][0]
+            print(f"Closest match: {match['label']} with distance {match['distance']}, file: {Path(match['image_path'] or '').name}")
+
+    if instrumentation.enabled():
+        print(instrumentation.export_prometheus())
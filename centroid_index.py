@@ -0,0 +1,254 @@
+import numpy as np
+import instrumentation
+from gallery import normalize, top_k
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple, Union
+
+class CentroidIndex:
+    """
+    Persisted per-person centroid index maintained incrementally.
+
+    For every label the index keeps the running sum and count of that person's unit-normalized
+    embeddings, so enrolling or removing one image updates a single centroid in O(d). The normalized
+    centroids are kept stacked in one matrix for vectorized scoring. Each label also keeps a pointer
+    to its representative image (the enrolled image closest to its centroid), so a query never has
+    to touch the full gallery. Rows live in arrays whose capacity doubles as people are enrolled, so
+    adding a new person costs amortized O(d).
+
+    `version` records the `face_index.gallery_version` of the gallery the index was built from, so a
+    saved index can be checked for staleness.
+
+    Example:
+        >>> index = CentroidIndex.from_gallery(load_gallery())
+        >>> index.search(query_embedding, k=3)
+        [{'label': 'Hunter Boon', 'distance': 0.393, 'image_path': 'database/images/Hunter Boon/4.png'}, ...]
+    """
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+        self.labels = []
+        self.rows = {}
+        self.representatives = []
+        self.version = None
+        self._sums = np.empty((0, dim), dtype=np.float64)
+        self._counts = np.empty(0, dtype=np.int64)
+        self._centroids = np.empty((0, dim), dtype=np.float32)
+        self._representative_vectors = np.empty((0, dim), dtype=np.float32)
+
+    def __len__(self):
+        return int(np.count_nonzero(self.counts))
+
+    # The per-person arrays are views of the used rows of their backing arrays
+    @property
+    def sums(self) -> np.ndarray:
+        return self._sums[:len(self.labels)]
+
+    @sums.setter
+    def sums(self, value):
+        self._sums = np.asarray(value, dtype=np.float64)
+
+    @property
+    def counts(self) -> np.ndarray:
+        return self._counts[:len(self.labels)]
+
+    @counts.setter
+    def counts(self, value):
+        self._counts = np.asarray(value, dtype=np.int64)
+
+    @property
+    def centroids(self) -> np.ndarray:
+        return self._centroids[:len(self.labels)]
+
+    @centroids.setter
+    def centroids(self, value):
+        self._centroids = np.asarray(value, dtype=np.float32)
+
+    @property
+    def representative_vectors(self) -> np.ndarray:
+        return self._representative_vectors[:len(self.labels)]
+
+    @representative_vectors.setter
+    def representative_vectors(self, value):
+        self._representative_vectors = np.asarray(value, dtype=np.float32)
+
+    @classmethod
+    def from_gallery(cls, gallery) -> "CentroidIndex":
+        """
+        Builds the index from every embedding of a `gallery.Gallery` in one vectorized pass.
+        """
+        index = cls(dim=gallery.embeddings.shape[1])
+        index.labels = list(dict.fromkeys(gallery.labels))
+        index.rows = {label: row for row, label in enumerate(index.labels)}
+        rows = np.array([index.rows[label] for label in gallery.labels], dtype=np.intp)
+
+        index.sums = np.zeros((len(index.labels), index.dim), dtype=np.float64)
+        np.add.at(index.sums, rows, gallery.embeddings)
+        index.counts = np.bincount(rows, minlength=len(index.labels))
+        index.centroids = normalize(index.sums)
+
+        # The representative of each person is their image most similar to the centroid
+        similarities = np.einsum("ij,ij->i", gallery.embeddings, index.centroids[rows])
+        order = np.lexsort((-similarities, rows))
+        first = order[np.r_[True, rows[order][1:] != rows[order][:-1]]]
+        index.representatives = list(gallery.image_paths[first])
+        index.representative_vectors = gallery.embeddings[first].copy()
+
+        from face_index import gallery_version
+        index.version = gallery_version(gallery)
+        return index
+
+    def _row(self, label):
+        if label not in self.rows:
+            row = len(self.labels)
+            if row == len(self._counts):
+                # Double the capacity, so enrolling P people copies O(P·d) in total rather than per person
+                capacity = max(2 * row, 16)
+                for name in ("_sums", "_counts", "_centroids", "_representative_vectors"):
+                    array = getattr(self, name)
+                    grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+                    grown[:row] = array[:row]
+                    setattr(self, name, grown)
+            self.rows[label] = row
+            self.labels.append(label)
+            self.representatives.append(None)
+        return self.rows[label]
+
+    def add(self, label: str, embedding, image_path: Optional[str] = None) -> None:
+        """
+        Adds one enrolled embedding to its person's centroid.
+        """
+        row = self._row(label)
+        vector = normalize(embedding)[0]
+        self.sums[row] += vector
+        self.counts[row] += 1
+        self.centroids[row] = normalize(self.sums[row])[0]
+
+        representative = self.representative_vectors[row]
+        if self.representatives[row] is None or vector @ self.centroids[row] > representative @ self.centroids[row]:
+            self.representatives[row] = image_path
+            self.representative_vectors[row] = vector
+
+    def remove(self, label: str, embedding, image_path: Optional[str] = None,
+               remaining: Optional[Iterable[Tuple[str, np.ndarray]]] = None) -> None:
+        """
+        Removes one previously added embedding from its person's centroid.
+
+        If `image_path` was the person's representative, the closest of `remaining`, (image_path, embedding)
+        pairs of their other enrolled images, replaces it. Without `remaining` the person is listed by
+        `missing_representatives` until `choose_representative` or the next `add` sets one.
+        """
+        row = self.rows[label]
+        self.sums[row] -= normalize(embedding)[0]
+        self.counts[row] -= 1
+
+        if self.counts[row] <= 0:
+            self.counts[row] = 0
+            self.sums[row] = 0
+            self.centroids[row] = 0
+        else:
+            self.centroids[row] = normalize(self.sums[row])[0]
+
+        if image_path is not None and image_path == self.representatives[row]:
+            self.representatives[row] = None
+            if remaining is not None and self.counts[row] > 0:
+                self.choose_representative(label, remaining)
+
+    def choose_representative(self, label: str, candidates: Iterable[Tuple[str, np.ndarray]]) -> None:
+        """
+        Points the person's representative at whichever (image_path, embedding) candidate is closest to their centroid.
+        """
+        candidates = list(candidates)
+        if not candidates:
+            return
+        row = self.rows[label]
+        image_paths, vectors = zip(*candidates)
+        vectors = normalize(np.stack(vectors))
+        best = int(np.argmax(vectors @ self.centroids[row]))
+        self.representatives[row] = image_paths[best]
+        self.representative_vectors[row] = vectors[best]
+
+    def missing_representatives(self) -> List[str]:
+        """
+        Labels that still have enrolled images but lost their representative to `remove`.
+        """
+        return [label for label, count, representative in zip(self.labels, self.counts, self.representatives) if count > 0 and representative is None]
+
+    @instrumentation.timed("centroid_search")
+    def search_batch(self, queries, k: int = 1) -> List[List[dict]]:
+        """
+        Scores each query against every centroid with one matrix multiply.
+
+        Args:
+            queries: Embeddings of shape (n, d), or a single embedding of shape (d,).
+            k (int): Number of people to return per query. Defaults to 1.
+
+        Returns:
+            List[List[dict]]: For each query, up to k people ordered by increasing distance. Each match
+                              holds `label`, `distance` and the representative `image_path`.
+        """
+        distances = 1 - normalize(queries) @ self.centroids.T
+        distances[:, self.counts == 0] = np.inf
+        indices = top_k(distances, min(k, len(self)))
+
+        return [
+            [
+                {
+                    "label": self.labels[row],
+                    "distance": float(row_distances[row]),
+                    "image_path": self.representatives[row],
+                }
+                for row in row_indices
+            ]
+            for row_distances, row_indices in zip(distances, indices)
+        ]
+
+    def search(self, query, k: int = 1) -> List[dict]:
+        return self.search_batch(np.atleast_2d(query), k)[0]
+
+    def quantized(self, codec: str = "int8", rerank: int = 0, **codec_kwargs):
+        """
+        Compresses the current centroids into a `quantization.QuantizedGallery` searched on the codes.
+
+        Matches carry the person's `label` and representative `image_path`. The quantized copy is a
+        snapshot, so re-create it after adding or removing embeddings.
+        """
+        from quantization import QuantizedGallery
+
+        rows = np.flatnonzero(self.counts)
+        return QuantizedGallery.encode(
+            self.centroids[rows],
+            [self.labels[row] for row in rows],
+            [self.representatives[row] for row in rows],
+            codec=codec,
+            full_vectors=self.centroids[rows],
+            rerank=rerank,
+            **codec_kwargs,
+        )
+
+    def save(self, path: Union[str, Path]) -> None:
+        keep = self.counts > 0
+        with open(path, "wb") as file:
+            np.savez(
+                file,
+                dim=self.dim,
+                labels=np.array(self.labels, dtype=str)[keep],
+                sums=self.sums[keep],
+                counts=self.counts[keep],
+                representatives=np.array([representative or "" for representative in self.representatives], dtype=str)[keep],
+                representative_vectors=self.representative_vectors[keep],
+                version=self.version or "",
+            )
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "CentroidIndex":
+        with np.load(path) as data:
+            index = cls(dim=int(data["dim"]))
+            index.labels = list(data["labels"])
+            index.rows = {label: row for row, label in enumerate(index.labels)}
+            index.sums = data["sums"]
+            index.counts = data["counts"]
+            index.representatives = [representative or None for representative in data["representatives"]]
+            index.representative_vectors = data["representative_vectors"]
+            index.version = (str(data["version"]) or None) if "version" in data.files else None
+        index.centroids = normalize(index.sums) if len(index.labels) else np.empty((0, index.dim), dtype=np.float32)
+        return index
@@ -1,5 +1,9 @@
+import numpy as np
+import instrumentation
 from deepface import DeepFace
-from image_handler import get_image_files, pairwise_comparison
+from deepface.modules.verification import find_threshold
+from image_handler import get_image_files
+from represent_faces import get_vector
 import json
 
 def compare_faces(img1_path, img2_path, detector_backend="retinaface", model_name='ArcFace', distance_metric="cosine", enforce_detection=True):
@@ -13,9 +17,100 @@ def compare_faces(img1_path, img2_path, detector_backend="retinaface", model_nam
         )
         
     except Exception as e:
+        instrumentation.count("failures", stage="compare_faces", error=type(e).__name__)
         return f"Error: {str(e)}"
 
-images = get_image_files("/Users/main/Projects/Docker/faces/test_images")
+# Function to compute the distances between every row of A and every row of B in one operation
+def distance_matrix(A, B, distance_metric="cosine"):
+    A = np.asarray(A, dtype=np.float32)
+    B = np.asarray(B, dtype=np.float32)
 
-results = pairwise_comparison(images, compare_faces)
-print(json.dumps(results, indent=4, sort_keys=True))
+    if distance_metric in ("cosine", "euclidean_l2"):
+        A = A / np.linalg.norm(A, axis=1, keepdims=True)
+        B = B / np.linalg.norm(B, axis=1, keepdims=True)
+
+    if distance_metric == "cosine":
+        return 1 - A @ B.T
+    if distance_metric in ("euclidean", "euclidean_l2"):
+        squared = (A ** 2).sum(axis=1)[:, None] + (B ** 2).sum(axis=1)[None, :] - 2 * A @ B.T
+        return np.sqrt(np.maximum(squared, 0))
+    raise ValueError(f"Invalid distance_metric passed - {distance_metric}")
+
+def pairwise_verification(images, detector_backend="retinaface", model_name="ArcFace", distance_metric="cosine",
+                          only_verified=False, block_size=1024):
+    """
+    Verifies every pair of images while embedding each image exactly once.
+
+    Args:
+        images (List[Path]): Image files to compare, e.g. from `get_image_files`.
+        detector_backend (str): DeepFace detector backend. Defaults to "retinaface".
+        model_name (str): DeepFace recognition model. Defaults to "ArcFace".
+        distance_metric (str): "cosine", "euclidean" or "euclidean_l2". Defaults to "cosine".
+        only_verified (bool): If True, only pairs under the model's threshold are yielded. Defaults to False.
+        block_size (int): Number of images whose rows of the distance matrix are computed per operation.
+                          Defaults to 1024, which bounds memory to block_size * N distances.
+
+    Yields:
+        dict: Entries shaped like `pairwise_comparison` output, whose `result` holds the same
+              `verified`, `distance`, `threshold`, `model`, `detector_backend` and `similarity_metric`
+              keys as `DeepFace.verify`. Pairs with an image that failed to embed carry an "Error: ..." string.
+    """
+    threshold = find_threshold(model_name, distance_metric)
+
+    # Embed each image once, keeping the first face like DeepFace.verify does
+    embeddings, facial_areas, errors = [], [], {}
+    for index, image in enumerate(images):
+        results = get_vector(image, detector_backend=detector_backend, model_name=model_name)
+        if isinstance(results, str):
+            errors[index] = results
+            embeddings.append(None)
+            facial_areas.append(None)
+        else:
+            embeddings.append(results[0]["embedding"])
+            facial_areas.append(results[0]["facial_area"])
+
+    valid = np.array([index for index in range(len(images)) if index not in errors], dtype=np.intp)
+    matrix = np.array([embeddings[index] for index in valid], dtype=np.float32)
+
+    if not only_verified:
+        for index in sorted(errors):
+            for other in range(len(images)):
+                if other != index and (other not in errors or other > index):
+                    pair = sorted((index, other))
+                    yield {"images": [images[pair[0]].name, images[pair[1]].name], "result": errors[index]}
+
+    for start in range(0, len(valid), block_size):
+        with instrumentation.span("pairwise_distance"):
+            distances = distance_matrix(matrix[start:start + block_size], matrix, distance_metric)
+
+        # Keep each unordered pair once, and drop pairs over the threshold up front when only matches are wanted
+        mask = np.triu(np.ones(distances.shape, dtype=bool), k=start + 1)
+        if only_verified:
+            mask &= distances <= threshold
+
+        for row, column in zip(*np.nonzero(mask)):
+            distance = float(distances[row, column])
+            verified = distance <= threshold
+            img1, img2 = valid[start + row], valid[column]
+            yield {
+                "images": [images[img1].name, images[img2].name],
+                "result": {
+                    "verified": verified,
+                    "distance": distance,
+                    "threshold": threshold,
+                    "model": model_name,
+                    "detector_backend": detector_backend,
+                    "similarity_metric": distance_metric,
+                    "facial_areas": {"img1": facial_areas[img1], "img2": facial_areas[img2]},
+                },
+            }
+
+if __name__ == "__main__":
+    images = get_image_files("/Users/main/Projects/Docker/faces/test_images")
+
+    # Embed each image once instead of running DeepFace.verify on every pair
+    results = list(pairwise_verification(images))
+    print(json.dumps(results, indent=4, sort_keys=True))
+
+    if instrumentation.enabled():
+        print(instrumentation.export_prometheus())
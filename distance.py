@@ -1,8 +1,10 @@
 import numpy as np
-import json
-from image_handler import get_image_files
+from embedding_store import EmbeddingStore, load_gallery
+from identify_faces import identify_all_faces
 from pathlib import Path
-from represent_faces import get_vector
+from open_set import OpenSetSearcher, Thresholds, calibrate
+from quantization import QuantizedGallery
+import instrumentation
 
 def cosine_distance(A, B):
     dot_product = np.dot(A, B)
@@ -15,34 +17,47 @@ def cosine_distance(A, B):
 def load_embedding(embedding_path):
     return np.load(embedding_path)
 
-# Example usage:
-metadata_file = "database/metadata.json"
-image_path = "testing/query_image.png"
-embeddings_folder = "database/embeddings"
-
-# Get the image file to process
-image = get_image_files(image_path)[0]
-results = get_vector(image)
-
-# Load metadata
-with open(metadata_file) as file:
-    data = json.load(file)
-    saved_images = data["images"]
-
-# Initialize the list to hold distances
-distances = [None] * len(saved_images)
-
-# Iterate through the saved images and calculate cosine distance
-for index, saved_image in enumerate(saved_images):
-    embedding_path = saved_image["embedding_path"]
-    saved_embedding = load_embedding(embedding_path)
-    distances[index] = cosine_distance(results[0]["embedding"], saved_embedding)
-    
-# Find the index of the closest image
-closest_image_index = distances.index(min(distances))
-person = saved_images[closest_image_index]["label"]
-image_file_name = Path(saved_images[closest_image_index]["image_path"]).name
-
-import os
-os.system('cls||clear')
-print(f"Closest match: {person} with distance {distances[closest_image_index]}, file: {image_file_name}")
+if __name__ == "__main__":
+    # Example usage:
+    metadata_file = "database/metadata.json"
+    store_folder = "database/store"
+    quantized_file = "database/gallery_int8.npz"
+    thresholds_file = "database/thresholds.npz"
+    image_path = "testing/query_image.png"
+    top_k = 3
+
+    if Path(store_folder).exists():
+        # Scan int8 codes, re-ranking the 100 best candidates against the memory-mapped store
+        store = EmbeddingStore(store_folder)
+        gallery = QuantizedGallery.load(quantized_file, full_vectors=store.embeddings, rerank=100) if Path(quantized_file).exists() else None
+        # Re-encode when faces were enrolled, deleted or compacted since the codes were saved
+        if gallery is None or gallery.version != store.version:
+            gallery = QuantizedGallery.from_store(store, codec="int8", rerank=100)
+            gallery.save(quantized_file)
+    else:
+        # Load every saved embedding once into a single normalized matrix
+        gallery = load_gallery(metadata_file, store_folder)
+
+    # Report faces beyond their calibrated threshold as unknown instead of forcing the closest label
+    if Path(thresholds_file).exists():
+        thresholds = Thresholds.load(thresholds_file)
+    else:
+        thresholds = calibrate(load_gallery(metadata_file, store_folder))
+        thresholds.save(thresholds_file)
+    gallery = OpenSetSearcher(gallery, thresholds)
+
+    # Score every face in the query image(s) against the whole gallery in one matrix multiply
+    results = identify_all_faces(image_path, gallery, k=top_k)
+
+    import os
+    os.system('cls||clear')
+    for result in results:
+        if isinstance(result["faces"], str):
+            print(f"Skipping {result['image_path']}: {result['faces']}")
+            continue
+        for face in result["faces"]:
+            for match in face["matches"]:
+                print(f"Face at {face['facial_area']}: {match['label']} with distance {match['distance']}, file: {Path(match['image_path']).name}")
+
+    if instrumentation.enabled():
+        print(instrumentation.export_prometheus())
@@ -0,0 +1,370 @@
+import fcntl
+import json
+import mmap
+import os
+import tempfile
+import numpy as np
+import instrumentation
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterable, Union
+
+STORE_FILE = "store.json"
+LOCK_FILE = "lock"
+OPEN_ATTEMPTS = 3
+
+# Function to atomically replace a file with the given bytes
+def atomic_write_bytes(path, data):
+    path = Path(path)
+    # A unique temporary file per writer, so concurrent writers of one path never share it
+    descriptor, tmp_path = tempfile.mkstemp(prefix=path.name + ".", suffix=".tmp", dir=path.parent)
+    try:
+        with os.fdopen(descriptor, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
+
+# Function to hold an exclusive advisory lock on a file for the duration of a with block
+@contextmanager
+def file_lock(path):
+    with open(path, "a") as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+class StringColumn:
+    """
+    Read-only string column over a memory-mapped UTF-8 buffer and per-row byte offsets.
+
+    Indexing with an int returns one `str`; indexing with a slice, mask or array of rows decodes only
+    those rows into a numpy string array. Nothing is decoded until it is asked for.
+    """
+
+    def __init__(self, buffer, starts, ends):
+        self.buffer = buffer
+        self.starts = starts
+        self.ends = ends
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, rows):
+        if isinstance(rows, (int, np.integer)):
+            return self.buffer[self.starts[rows]:self.ends[rows]].decode()
+        if isinstance(rows, slice):
+            rows = np.arange(*rows.indices(len(self)))
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        values = [self.buffer[start:end].decode() for start, end in zip(self.starts[rows].tolist(), self.ends[rows].tolist())]
+        return np.array(values, dtype=str)
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __array__(self, dtype=None, copy=None):
+        values = self[:]
+        return values if dtype is None else values.astype(dtype)
+
+    def tolist(self):
+        return self[:].tolist()
+
+class EmbeddingStore:
+    """
+    Packed, append-only embedding store backed by a single memory-mapped float32 matrix.
+
+    Layout of the store directory, for the current generation g:
+        store.json:          Embedding dimension and current generation. Replacing it commits a compaction.
+        embeddings-g.f32:    Raw row-major float32 matrix, one row per enrolled face, appended in place.
+        strings-g.bin:       UTF-8 label, hash and image path of every row, back to back, appended in place.
+        offsets-g.i64:       Per row, the end offsets of its label, hash and image path in strings-g.bin.
+        deleted-g.i64:       Row numbers of tombstoned faces, appended in place.
+        lock:                Held by writers while they append, delete or compact.
+
+    Rows are never rewritten in place. Deleting a face only appends its row to the tombstones, and
+    `compact` writes a new generation without tombstoned rows. Every write appends to the end of its
+    files, so an append costs the size of the new rows rather than of the whole store. Opening a store
+    maps the files without reading them; labels, hashes and paths are decoded only for the rows asked for.
+
+    A row exists once its 24-byte offsets record is complete. Writers write the matrix and strings
+    first and the offsets last, so readers never see a row whose embedding or strings are missing;
+    anything past the last complete record is ignored. Only a writer, holding the lock, trims the
+    torn tails left by a writer that died.
+
+    Example:
+        >>> store = EmbeddingStore("database/store", dim=512)
+        >>> store.append(embeddings, labels, hashes, image_paths)
+        >>> gallery = store.to_gallery()
+    """
+
+    def __init__(self, root: Union[str, Path], dim: int = 512):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.dim = dim
+
+        if not (self.root / STORE_FILE).exists():
+            with self.lock():
+                if not (self.root / STORE_FILE).exists():
+                    for path in self._files(0):
+                        path.touch()
+                    atomic_write_bytes(self.root / STORE_FILE, json.dumps({"dim": self.dim, "generation": 0}).encode())
+        self._open()
+
+    def _files(self, generation):
+        return (
+            self.root / f"embeddings-{generation}.f32",
+            self.root / f"strings-{generation}.bin",
+            self.root / f"offsets-{generation}.i64",
+            self.root / f"deleted-{generation}.i64",
+        )
+
+    def lock(self):
+        """
+        Holds the writer lock. Appends, deletes and compactions of other writers wait until it is released.
+        """
+        return file_lock(self.root / LOCK_FILE)
+
+    def _open(self):
+        # A compaction may remove the files of the generation just read, so retry a few times with the next one
+        for attempt in range(OPEN_ATTEMPTS):
+            with open(self.root / STORE_FILE) as file:
+                state = json.load(file)
+            self.dim, self.generation = state["dim"], state["generation"]
+            self.matrix_path, self.strings_path, self.offsets_path, self.deleted_path = self._files(self.generation)
+            self.deleted = np.array([], dtype=bool)
+            self._deleted_offset = 0
+            try:
+                self.refresh()
+                return
+            except FileNotFoundError:
+                if attempt == OPEN_ATTEMPTS - 1:
+                    raise
+
+    def refresh(self) -> None:
+        """
+        Maps the rows and reads the tombstones appended since the store was opened.
+        """
+        # Tombstones are read first: every row they name was committed before they were written
+        with open(self.deleted_path, "rb") as file:
+            file.seek(self._deleted_offset)
+            tombstones = file.read()
+        tombstones = tombstones[:len(tombstones) - len(tombstones) % 8]
+
+        rows = os.path.getsize(self.offsets_path) // 24
+        offsets = np.memmap(self.offsets_path, dtype=np.int64, mode="r", shape=(rows, 3)) if rows else np.empty((0, 3), dtype=np.int64)
+        with open(self.strings_path, "rb") as file:
+            strings = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if rows and offsets[-1, 2] else b""
+
+        # Map the matrix right away, so this snapshot stays readable after a compaction removes its files
+        row_bytes = self.dim * np.dtype(np.float32).itemsize
+        if os.path.getsize(self.matrix_path) < rows * row_bytes:
+            raise ValueError(f"{self.matrix_path} holds fewer rows than {self.offsets_path} lists")
+        self._matrix = np.memmap(self.matrix_path, dtype=np.float32, mode="r", shape=(rows, self.dim)) if rows else None
+
+        row_starts = np.concatenate([[0], offsets[:-1, 2]]).astype(np.int64)
+        self.offsets = offsets
+        self.labels = StringColumn(strings, row_starts, offsets[:, 0])
+        self.hashes = StringColumn(strings, offsets[:, 0], offsets[:, 1])
+        self.image_paths = StringColumn(strings, offsets[:, 1], offsets[:, 2])
+
+        if rows > len(self.deleted):
+            self.deleted = np.concatenate([self.deleted, np.zeros(rows - len(self.deleted), dtype=bool)])
+        self.deleted[np.frombuffer(tombstones, dtype=np.int64)] = True
+        self._deleted_offset += len(tombstones)
+
+    def _recover(self):
+        # Under the writer lock: catch up with other writers, then trim whatever a dead writer left half-written
+        if json.loads((self.root / STORE_FILE).read_text())["generation"] != self.generation:
+            self._open()
+        else:
+            self.refresh()
+        row_bytes = self.dim * np.dtype(np.float32).itemsize
+        sizes = (
+            (self.matrix_path, len(self.offsets) * row_bytes),
+            (self.strings_path, int(self.offsets[-1, 2]) if len(self.offsets) else 0),
+            (self.offsets_path, len(self.offsets) * 24),
+            (self.deleted_path, self._deleted_offset),
+        )
+        for path, size in sizes:
+            if os.path.getsize(path) > size:
+                os.truncate(path, size)
+
+    def __len__(self):
+        return int(np.count_nonzero(~self.deleted))
+
+    @property
+    def embeddings(self) -> np.ndarray:
+        """
+        Read-only memory map over every stored row, including tombstoned ones.
+        """
+        if self._matrix is None:
+            return np.empty((0, self.dim), dtype=np.float32)
+        return self._matrix
+
+    @property
+    def version(self) -> str:
+        """
+        Changes with every append, delete and compaction, so data derived from the store can be checked for staleness.
+        """
+        return f"{self.generation}:{len(self.offsets)}:{int(np.count_nonzero(self.deleted))}"
+
+    @property
+    def live(self) -> np.ndarray:
+        """
+        Row indices of every face that has not been deleted.
+        """
+        return np.flatnonzero(~self.deleted)
+
+    @staticmethod
+    def _append_bytes(path, data):
+        with open(path, "ab") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+
+    @staticmethod
+    def _encode_strings(labels, hashes, image_paths, base=0):
+        # Returns the concatenated UTF-8 bytes and the (n, 3) end offsets of each row's fields
+        fields = [str(value).encode() for row in zip(labels, hashes, image_paths) for value in row]
+        ends = base + np.cumsum([len(field) for field in fields], dtype=np.int64).reshape(-1, 3)
+        return b"".join(fields), ends
+
+    def append(self, embeddings, labels: Iterable[str], hashes: Iterable[str], image_paths: Iterable[str]) -> np.ndarray:
+        """
+        Appends embeddings and their metadata to the end of the store.
+
+        Args:
+            embeddings: Array of shape (n, dim).
+            labels (Iterable[str]): Person label for each embedding.
+            hashes (Iterable[str]): sha256 of each source image.
+            image_paths (Iterable[str]): Source image path for each embedding.
+
+        Returns:
+            np.ndarray: Row indices assigned to the appended embeddings.
+        """
+        embeddings = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+        labels, hashes, image_paths = list(labels), list(hashes), list(image_paths)
+        if embeddings.shape[1] != self.dim:
+            raise ValueError(f"Expected embeddings of dimension {self.dim}, got {embeddings.shape[1]}")
+        if not len(embeddings) == len(labels) == len(hashes) == len(image_paths):
+            raise ValueError("embeddings, labels, hashes and image_paths must have the same length")
+
+        with self.lock():
+            self._recover()
+            start = len(self.offsets)
+            strings, ends = self._encode_strings(labels, hashes, image_paths, int(self.offsets[-1, 2]) if start else 0)
+            self._append_bytes(self.matrix_path, np.ascontiguousarray(embeddings).tobytes())
+            self._append_bytes(self.strings_path, strings)
+            self._append_bytes(self.offsets_path, ends.tobytes())
+            self.refresh()
+
+        return np.arange(start, start + len(labels))
+
+    def delete(self, hashes: Iterable[str]) -> int:
+        """
+        Tombstones every live row whose image hash is in `hashes`.
+
+        Args:
+            hashes (Iterable[str]): sha256 hashes of the images to remove.
+
+        Returns:
+            int: Number of rows that were tombstoned.
+        """
+        hashes = list(hashes)
+        with self.lock():
+            self._recover()
+            rows = np.flatnonzero(np.isin(self.hashes[:], hashes) & ~self.deleted)
+            if len(rows):
+                self._append_bytes(self.deleted_path, rows.astype(np.int64).tobytes())
+                self.refresh()
+        return len(rows)
+
+    def compact(self) -> int:
+        """
+        Writes a new generation of the store without tombstoned rows.
+
+        Returns:
+            int: Number of rows that were reclaimed.
+        """
+        with self.lock():
+            self._recover()
+            live = self.live
+            reclaimed = len(self.offsets) - len(live)
+            if reclaimed == 0:
+                return 0
+
+            old_files = self._files(self.generation)
+            new_files = self._files(self.generation + 1)
+            with open(new_files[0], "wb") as matrix_file, open(new_files[1], "wb") as strings_file, open(new_files[2], "wb") as offsets_file:
+                # Strings are copied as raw bytes and their offsets shifted, without decoding them
+                buffer, row_starts, base = self.labels.buffer, self.labels.starts, 0
+                for start in range(0, len(live), 65536):
+                    rows = live[start:start + 65536]
+                    matrix_file.write(np.ascontiguousarray(self.embeddings[rows]).tobytes())
+                    starts, ends = row_starts[rows], np.asarray(self.offsets[rows])
+                    new_starts = base + np.cumsum(ends[:, 2] - starts) - (ends[:, 2] - starts)
+                    strings_file.write(b"".join(buffer[row_start:row_end] for row_start, row_end in zip(starts.tolist(), ends[:, 2].tolist())))
+                    offsets_file.write((ends - starts[:, None] + new_starts[:, None]).astype(np.int64).tobytes())
+                    base = int(new_starts[-1] + ends[-1, 2] - starts[-1])
+                for file in (matrix_file, strings_file, offsets_file):
+                    file.flush()
+                    os.fsync(file.fileno())
+            new_files[3].touch()
+
+            # Replacing store.json switches readers to the new generation in one step
+            atomic_write_bytes(self.root / STORE_FILE, json.dumps({"dim": self.dim, "generation": self.generation + 1}).encode())
+            for path in old_files:
+                path.unlink(missing_ok=True)
+            self._open()
+
+        return reclaimed
+
+    @instrumentation.timed("gallery_load")
+    def to_gallery(self):
+        """
+        Loads the live rows into a `gallery.Gallery` for vectorized search.
+        """
+        from gallery import Gallery
+
+        live = self.live
+        return Gallery(self.embeddings[live], self.labels[live], self.image_paths[live], self.hashes[live])
+
+# Function to migrate a metadata.json + one .npy per image database into a packed store
+def migrate_metadata(metadata_file, store_root, dim=512):
+    with open(metadata_file) as file:
+        saved_images = json.load(file)["images"]
+
+    store = EmbeddingStore(store_root, dim=dim)
+    known_hashes = set(store.hashes[store.live])
+    saved_images = [saved_image for saved_image in saved_images if saved_image["hash"] not in known_hashes]
+
+    # Migrate in chunks so large galleries never hold every embedding in memory at once
+    for start in range(0, len(saved_images), 4096):
+        chunk = saved_images[start:start + 4096]
+        store.append(
+            [np.load(saved_image["embedding_path"]) for saved_image in chunk],
+            labels=[saved_image["label"] for saved_image in chunk],
+            hashes=[saved_image["hash"] for saved_image in chunk],
+            image_paths=[saved_image["image_path"] for saved_image in chunk],
+        )
+
+    return store
+
+# Function to load the gallery from the packed store, falling back to the metadata.json layout
+def load_gallery(metadata_file="database/metadata.json", store_folder="database/store"):
+    if (Path(store_folder) / STORE_FILE).exists():
+        return EmbeddingStore(store_folder).to_gallery()
+
+    from gallery import Gallery
+    return Gallery.from_metadata(metadata_file)
+
+if __name__ == "__main__":
+    # Example usage: Migrate the existing database into a packed store
+    store = migrate_metadata("database/metadata.json", "database/store")
+    print(f"Migrated {len(store)} embeddings into {store.root}")
@@ -0,0 +1,151 @@
+import os
+import time
+import multiprocessing
+import numpy as np
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+from image_handler import get_images, heic2png
+from represent_faces import detect_faces, embed_faces, load_database, save_embedding, sha256_hash, write_database
+
+_known_hashes = set()
+
+# Function to share the already enrolled hashes with each worker once
+def _init_worker(known_hashes):
+    global _known_hashes
+    _known_hashes = known_hashes
+
+# Function run in the worker processes: hash, decode and detect a single image, also returning how many faces it held
+def _detect(image, detector_backend):
+    try:
+        image_hash = sha256_hash(image)
+        if image_hash in _known_hashes:
+            return image, image_hash, None, None, 0
+
+        # HEIC files are decoded in memory and handed to the detector without a PNG round-trip
+        pixels = image
+        if heic2png.is_heic(image):
+            pixels = heic2png.read_heic(image)
+            if pixels is None:
+                return image, None, None, "Error: could not decode HEIC file", 0
+            pixels = np.ascontiguousarray(pixels[:, :, ::-1])
+
+        faces = detect_faces(pixels, detector_backend=detector_backend, file_hash=image_hash)
+        return image, image_hash, faces[0]["face"].astype(np.float32), None, len(faces)
+
+    except Exception as e:
+        return image, None, None, f"Error: {str(e)}", 0
+
+def enroll(images, metadata_output, embeddings_folder, workers=None, batch_size=32, checkpoint_every=1000,
+           detector_backend="retinaface", model_name="ArcFace"):
+    """
+    Enrolls a large set of images with parallel detection and batched embedding.
+
+    Args:
+        images (Iterable[Path]): Image files to enroll, e.g. from `get_images.iter_images`. HEIC files are
+                                 decoded in memory by the workers and are never converted or deleted.
+        metadata_output (Union[str, Path]): Path of the metadata JSON file to write.
+        embeddings_folder (Union[str, Path]): Folder the .npy embeddings are written to.
+        workers (Optional[int]): Number of decode/detection processes. Defaults to `os.cpu_count()`.
+        batch_size (int): Number of aligned face crops embedded per model call. Defaults to 32.
+        checkpoint_every (int): Number of newly embedded images between metadata checkpoints. Defaults to 1000.
+        detector_backend (str): DeepFace detector backend. Defaults to "retinaface".
+        model_name (str): DeepFace recognition model. Defaults to "ArcFace".
+
+    Returns:
+        dict: Counts of new, skipped and failed images, the total elapsed seconds, and `extra_faces`, a mapping
+              of each image with more than one detected face to the number of its faces that were not enrolled.
+
+    Description:
+    - Hashing, decoding and face detection run in a process pool. At most `workers * 4` images
+      are in flight at once, so the pool never runs far ahead of the embedding step.
+    - Aligned crops are collected in the parent process and embedded `batch_size` at a time by a
+      single model instance.
+    - Metadata is written atomically every `checkpoint_every` new images. An interrupted job that is
+      started again skips every image whose hash was already checkpointed.
+    - Each image enrolls its first detected face, as `DeepFace.verify` compares, under its folder's label.
+      Other faces in the image are usually other people, so they are not enrolled but listed in `extra_faces`.
+    """
+    start = time.perf_counter()
+    workers = workers or os.cpu_count()
+    params = {"model_name": model_name, "detector_backend": detector_backend}
+    Path(embeddings_folder).mkdir(parents=True, exist_ok=True)
+
+    # Resume from the last checkpoint
+    existing = {
+        saved_image["hash"]: saved_image
+        for saved_image in load_database(metadata_output, params)["images"]
+        if Path(saved_image["embedding_path"]).exists()
+    }
+    database = {"params": params, "images": []}
+    report = {"new": 0, "skipped": 0, "failed": 0, "extra_faces": {}}
+    pending = []
+    reused = set()
+    since_checkpoint = 0
+
+    def flush():
+        embeddings = embed_faces([face for _, _, face in pending], model_name=model_name)
+        for (image, image_hash, _), embedding in zip(pending, embeddings):
+            embedding_file_path = Path(embeddings_folder) / f"{image_hash}.npy"
+            save_embedding(embedding, embedding_file_path)
+            database["images"].append({
+                "label": image.parent.name,
+                "image_path": str(image),
+                "hash": image_hash,
+                "embedding_path": str(embedding_file_path),
+            })
+        report["new"] += len(pending)
+        pending.clear()
+
+    def collect(future):
+        nonlocal since_checkpoint
+        image, image_hash, face, error, face_count = future.result()
+        if face_count > 1:
+            print(f"Enrolling the first of {face_count} faces in {image}")
+            report["extra_faces"][str(image)] = face_count - 1
+        if error is not None:
+            print(f"Skipping {image}: {error}")
+            report["failed"] += 1
+        elif face is None:
+            database["images"].append({**existing[image_hash], "label": image.parent.name, "image_path": str(image)})
+            reused.add(image_hash)
+            report["skipped"] += 1
+        else:
+            pending.append((image, image_hash, face))
+            if len(pending) >= batch_size:
+                since_checkpoint += len(pending)
+                flush()
+                if since_checkpoint >= checkpoint_every:
+                    # Keep not yet revisited entries so an interrupted run can still skip them
+                    remaining = [saved_image for image_hash, saved_image in existing.items() if image_hash not in reused]
+                    write_database({**database, "images": database["images"] + remaining}, metadata_output)
+                    since_checkpoint = 0
+
+    # Spawn rather than fork so workers never inherit the parent's TensorFlow state
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker, initargs=(set(existing),)) as executor:
+        in_flight = set()
+        for image in images:
+            if len(in_flight) >= workers * 4:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect(future)
+            in_flight.add(executor.submit(_detect, image, detector_backend))
+
+        for future in wait(in_flight).done:
+            collect(future)
+
+    if pending:
+        flush()
+
+    write_database(database, metadata_output)
+    report["seconds"] = time.perf_counter() - start
+    print(f"Enrolled {report['new']} new, skipped {report['skipped']}, failed {report['failed']} in {report['seconds']:.2f}s")
+    if report["extra_faces"]:
+        print(f"{sum(report['extra_faces'].values())} extra faces in {len(report['extra_faces'])} images were not enrolled")
+
+    return report
+
+if __name__ == "__main__":
+    # Example usage: Bulk enroll every image under database/images
+    images = get_images.iter_images("database/images")
+    enroll(images, "database/metadata.json", "database/embeddings", batch_size=64)
@@ -0,0 +1,140 @@
+import io
+import os
+import json
+import hashlib
+import numpy as np
+from pathlib import Path
+from typing import Optional, Union
+from embedding_store import atomic_write_bytes
+
+class FaceCache:
+    """
+    On-disk, size-bounded LRU cache of face detections and embeddings.
+
+    Entries are keyed by the sha256 of the image bytes, the detector backend, the alignment option
+    and whether detection was enforced, so an unchanged image is never detected twice with the same
+    settings and the whole-image fallback cached without enforcement never stands in for an error.
+    Each entry stores the detected face boxes and landmarks, the aligned crops and one embedding
+    matrix per recognition model, in a single .npz file named after the key.
+
+    Recency is tracked through file modification times, which lets several processes share one cache
+    directory. Once the total size exceeds `max_bytes`, the least recently used entries are evicted.
+
+    Example:
+        >>> cache = FaceCache("database/cache")
+        >>> key = FaceCache.key(sha256_hash(image), "retinaface")
+        >>> cache.get(key)
+        {'faces': [{'facial_area': {...}, 'confidence': 0.99, 'face': array(...)}], 'embeddings': {'ArcFace': array(...)}}
+    """
+
+    def __init__(self, root: Union[str, Path] = "database/cache", max_bytes: int = 1 << 30):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.sizes = {entry.name: entry.stat().st_size for entry in os.scandir(self.root) if entry.name.endswith(".npz")}
+
+    @staticmethod
+    def key(file_hash: str, detector_backend: str = "retinaface", align: bool = True, enforce_detection: bool = True) -> str:
+        return hashlib.sha256(f"{file_hash}:{detector_backend}:{align}:{enforce_detection}".encode()).hexdigest()
+
+    def _path(self, key):
+        return self.root / f"{key}.npz"
+
+    def get(self, key: str) -> Optional[dict]:
+        """
+        Returns the cached entry for `key`, or None on a miss.
+
+        Returns:
+            Optional[dict]: `faces` is a list of dicts with `facial_area`, `confidence` and, when cached,
+                            the aligned RGB `face` crop scaled to [0, 1]. `embeddings` maps each cached
+                            model name to an (n_faces, d) array.
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                facial_areas = json.loads(str(data["facial_areas"]))
+                confidences = data["confidences"]
+                faces = [
+                    {
+                        "facial_area": facial_area,
+                        "confidence": float(confidence),
+                        **({"face": data[f"face_{index}"].astype(np.float32) / 255} if f"face_{index}" in data else {}),
+                    }
+                    for index, (facial_area, confidence) in enumerate(zip(facial_areas, confidences))
+                ]
+                embeddings = {name[len("embedding_"):]: data[name] for name in data.files if name.startswith("embedding_")}
+        except (FileNotFoundError, OSError, ValueError, KeyError):
+            return None
+
+        # Mark as recently used. Another process may have evicted the entry since it was read; it is still a hit
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return {"faces": faces, "embeddings": embeddings}
+
+    def put(self, key: str, faces: list, model_name: Optional[str] = None, embeddings=None) -> None:
+        """
+        Stores detections, and optionally the embeddings of one model, merging with any existing entry.
+
+        Args:
+            key (str): Cache key from `FaceCache.key`.
+            faces (list): Dicts with `facial_area`, `confidence` and optionally an aligned RGB `face` crop in [0, 1].
+            model_name (Optional[str]): Recognition model the embeddings belong to.
+            embeddings: Array of shape (n_faces, d) produced by `model_name`.
+        """
+        arrays = {}
+        cached = self.get(key)
+        if cached is not None and len(cached["faces"]) == len(faces):
+            arrays.update({f"embedding_{name}": value for name, value in cached["embeddings"].items()})
+            faces = [{**cached_face, **face} for cached_face, face in zip(cached["faces"], faces)]
+
+        arrays["facial_areas"] = json.dumps([face["facial_area"] for face in faces], default=int)
+        arrays["confidences"] = np.array([face.get("confidence") or 0 for face in faces], dtype=np.float32)
+        for index, face in enumerate(faces):
+            if "face" in face:
+                arrays[f"face_{index}"] = np.round(np.asarray(face["face"]) * 255).astype(np.uint8)
+        if model_name is not None and embeddings is not None:
+            arrays[f"embedding_{model_name}"] = np.asarray(embeddings, dtype=np.float32)
+
+        buffer = io.BytesIO()
+        np.savez(buffer, **arrays)
+        atomic_write_bytes(self._path(key), buffer.getvalue())
+        self.sizes[self._path(key).name] = buffer.tell()
+        self.evict()
+
+    def evict(self) -> int:
+        """
+        Removes least recently used entries until the cache fits in `max_bytes`.
+
+        Returns:
+            int: Number of evicted entries.
+        """
+        if sum(self.sizes.values()) <= self.max_bytes:
+            return 0
+
+        # Re-scan so entries written by other processes are accounted for
+        entries = sorted(
+            (entry for entry in os.scandir(self.root) if entry.name.endswith(".npz")),
+            key=lambda entry: entry.stat().st_mtime_ns,
+        )
+        self.sizes = {entry.name: entry.stat().st_size for entry in entries}
+        total = sum(self.sizes.values())
+
+        evicted = 0
+        for entry in entries:
+            if total <= self.max_bytes:
+                break
+            Path(entry.path).unlink(missing_ok=True)
+            total -= self.sizes.pop(entry.name)
+            evicted += 1
+        return evicted
+
+_default_cache = None
+
+# Function to get the cache shared by every entry point, created on first use
+def default_cache():
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = FaceCache(os.environ.get("FACE_CACHE_DIR", "database/cache"))
+    return _default_cache
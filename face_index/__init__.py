@@ -0,0 +1,50 @@
+from . import base
+from . import flat
+from . import ivf
+from . import report
+from .base import Index
+from .flat import FlatIndex
+from .ivf import IVFIndex
+from .report import recall_report
+import hashlib
+
+INDEX_TYPES = {"flat": FlatIndex, "ivf": IVFIndex}
+
+# Function to fingerprint the rows of a gallery, in order, since index ids are row numbers
+def gallery_version(gallery) -> str:
+    digest = hashlib.sha256()
+    for start in range(0, len(gallery.hashes), 65536):
+        digest.update("\n".join(map(str, gallery.hashes[start:start + 65536])).encode() + b"\n")
+    return digest.hexdigest()
+
+def build_index(gallery, kind: str = "ivf", **kwargs) -> Index:
+    """
+    Builds an index over every embedding of a `gallery.Gallery`.
+
+    Args:
+        gallery (Gallery): Gallery whose rows are indexed. Row numbers are used as ids.
+        kind (str): "flat" for exact search or "ivf" for approximate search. Defaults to "ivf".
+        **kwargs: Passed to the index constructor, e.g. `nlist` and `nprobe` for "ivf".
+
+    Returns:
+        Index: The populated index, with `version` set to `gallery_version(gallery)`.
+
+    Example:
+        >>> index = build_index(load_gallery(), kind="ivf", nlist=1024, nprobe=16)
+        >>> distances, ids = index.search(query_embeddings, k=5)
+    """
+    index = INDEX_TYPES[kind](dim=gallery.embeddings.shape[1], **kwargs)
+    index.train(gallery.embeddings)
+    index.add(gallery.embeddings, range(len(gallery)))
+    index.version = gallery_version(gallery)
+    return index
+
+def load_index(path) -> Index:
+    """
+    Loads an index written by `Index.save`, whichever kind it is.
+    """
+    import numpy as np
+
+    with np.load(path) as data:
+        kind = str(data["kind"])
+    return INDEX_TYPES[kind].load(path)
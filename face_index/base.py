@@ -0,0 +1,66 @@
+import numpy as np
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Iterable, Tuple, Union
+
+class Index(ABC):
+    """
+    Base class of the nearest-neighbour indexes over enrolled embeddings.
+
+    Every index stores unit-normalized float32 vectors under integer ids and ranks them by cosine
+    distance. Implementations provide `add`, `remove`, `search`, `save` and `load`. Indexes that need
+    training (e.g. `IVFIndex`) override `train`. `version` records which gallery the ids refer to and
+    is saved with the index, so a stale index can be detected and rebuilt.
+    """
+    kind = None
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+        self.version = None
+
+    @abstractmethod
+    def __len__(self):
+        raise NotImplementedError
+
+    def train(self, embeddings) -> None:
+        pass
+
+    @abstractmethod
+    def add(self, embeddings, ids: Iterable[int]) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove(self, ids: Iterable[int]) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    def search(self, queries, k: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the k nearest ids for each query.
+
+        Args:
+            queries: Embeddings of shape (n, dim), or a single embedding of shape (dim,).
+            k (int): Number of neighbours per query. Defaults to 1.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Cosine distances and ids, both of shape (n, k), ordered by
+                                           increasing distance. Missing neighbours have id -1 and distance inf.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def save(self, path: Union[str, Path]) -> None:
+        raise NotImplementedError
+
+    @classmethod
+    @abstractmethod
+    def load(cls, path: Union[str, Path]) -> "Index":
+        raise NotImplementedError
+
+# Function to pad per-query results to a fixed k
+def pad_results(distances, ids, k):
+    padded_distances = np.full(k, np.inf, dtype=np.float32)
+    padded_ids = np.full(k, -1, dtype=np.int64)
+    padded_distances[:len(distances)] = distances
+    padded_ids[:len(ids)] = ids
+    return padded_distances, padded_ids
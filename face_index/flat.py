@@ -0,0 +1,56 @@
+import numpy as np
+from gallery import normalize, top_k
+from .base import Index
+
+class FlatIndex(Index):
+    """
+    Exact brute-force index: one matrix multiply against every stored vector.
+    """
+    kind = "flat"
+
+    def __init__(self, dim: int = 512):
+        super().__init__(dim)
+        self.vectors = np.empty((0, dim), dtype=np.float32)
+        self.ids = np.empty(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, embeddings, ids):
+        self.vectors = np.concatenate([self.vectors, normalize(embeddings)])
+        self.ids = np.concatenate([self.ids, np.fromiter(ids, dtype=np.int64)])
+
+    def remove(self, ids):
+        keep = ~np.isin(self.ids, np.fromiter(ids, dtype=np.int64))
+        removed = len(self.ids) - int(np.count_nonzero(keep))
+        self.vectors, self.ids = self.vectors[keep], self.ids[keep]
+        return removed
+
+    def search(self, queries, k=1):
+        queries = normalize(queries)
+        if len(self) == 0:
+            return np.full((len(queries), k), np.inf, dtype=np.float32), np.full((len(queries), k), -1, dtype=np.int64)
+
+        distances = 1 - queries @ self.vectors.T
+        positions = top_k(distances, k)
+        result_distances = np.take_along_axis(distances, positions, axis=1)
+        result_ids = self.ids[positions]
+
+        if positions.shape[1] < k:
+            missing = k - positions.shape[1]
+            result_distances = np.pad(result_distances, ((0, 0), (0, missing)), constant_values=np.inf)
+            result_ids = np.pad(result_ids, ((0, 0), (0, missing)), constant_values=-1)
+        return result_distances, result_ids
+
+    def save(self, path):
+        with open(path, "wb") as file:
+            np.savez(file, kind=self.kind, dim=self.dim, vectors=self.vectors, ids=self.ids, version=self.version or "")
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            index = cls(dim=int(data["dim"]))
+            index.vectors = data["vectors"]
+            index.ids = data["ids"]
+            index.version = (str(data["version"]) or None) if "version" in data.files else None
+        return index
@@ -0,0 +1,152 @@
+import numpy as np
+from gallery import normalize, top_k
+from .base import Index
+
+# Function to assign each vector to its most similar centroid, in chunks to bound memory
+def assign(vectors, centroids, chunk_size=65536):
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), chunk_size):
+        assignments[start:start + chunk_size] = (vectors[start:start + chunk_size] @ centroids.T).argmax(axis=1)
+    return assignments
+
+# Function to train a spherical k-means coarse quantizer
+def spherical_kmeans(vectors, nlist, iterations=20, seed=0):
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=nlist, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignments = assign(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        counts = np.bincount(assignments, minlength=nlist)
+
+        # Re-seed empty lists with random vectors so every list stays in use
+        empty = np.flatnonzero(counts == 0)
+        sums[empty] = vectors[rng.choice(len(vectors), size=len(empty), replace=False)]
+        centroids = normalize(sums)
+
+    return centroids
+
+class IVFIndex(Index):
+    """
+    Approximate inverted-file index with a spherical k-means coarse quantizer.
+
+    Vectors are bucketed into `nlist` lists by their closest centroid. A query scans only the
+    `nprobe` lists whose centroids are closest to it, so search cost is roughly
+    `nlist + nprobe * N / nlist` dot products instead of N. Raising `nprobe` trades latency for recall;
+    `nprobe == nlist` is exact search.
+
+    Example:
+        >>> index = IVFIndex(dim=512, nlist=1024, nprobe=16)
+        >>> index.train(embeddings)
+        >>> index.add(embeddings, range(len(embeddings)))
+        >>> distances, ids = index.search(query, k=5)
+    """
+    kind = "ivf"
+
+    def __init__(self, dim: int = 512, nlist: int = 256, nprobe: int = 8, max_training_points: int = 256):
+        super().__init__(dim)
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.max_training_points = max_training_points
+        self.centroids = None
+        self.list_vectors = [np.empty((0, dim), dtype=np.float32) for _ in range(nlist)]
+        self.list_ids = [np.empty(0, dtype=np.int64) for _ in range(nlist)]
+
+    def __len__(self):
+        return sum(len(ids) for ids in self.list_ids)
+
+    def train(self, embeddings):
+        """
+        Fits the coarse quantizer on at most `max_training_points * nlist` sampled embeddings.
+        """
+        vectors = normalize(embeddings)
+        self.nlist = min(self.nlist, len(vectors))
+        self.list_vectors = self.list_vectors[:self.nlist]
+        self.list_ids = self.list_ids[:self.nlist]
+
+        sample_size = min(len(vectors), self.max_training_points * self.nlist)
+        sample = vectors[np.random.default_rng(0).choice(len(vectors), size=sample_size, replace=False)]
+        self.centroids = spherical_kmeans(sample, self.nlist)
+
+    def add(self, embeddings, ids):
+        if self.centroids is None:
+            raise ValueError("IVFIndex must be trained before vectors are added")
+
+        vectors = normalize(embeddings)
+        ids = np.fromiter(ids, dtype=np.int64)
+        assignments = assign(vectors, self.centroids)
+
+        for list_number in np.unique(assignments):
+            members = assignments == list_number
+            self.list_vectors[list_number] = np.concatenate([self.list_vectors[list_number], vectors[members]])
+            self.list_ids[list_number] = np.concatenate([self.list_ids[list_number], ids[members]])
+
+    def remove(self, ids):
+        ids = np.fromiter(ids, dtype=np.int64)
+        removed = 0
+        for list_number, list_ids in enumerate(self.list_ids):
+            keep = ~np.isin(list_ids, ids)
+            if not keep.all():
+                removed += len(list_ids) - int(np.count_nonzero(keep))
+                self.list_vectors[list_number] = self.list_vectors[list_number][keep]
+                self.list_ids[list_number] = list_ids[keep]
+        return removed
+
+    def search(self, queries, k=1, nprobe=None):
+        queries = normalize(queries)
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        probes = top_k(-(queries @ self.centroids.T), nprobe)
+
+        # Each probed list is scored in place against every query that probes it, keeping up to k candidates
+        # per (query, probe) slot; the slots of a query are then merged into its top k
+        candidate_distances = np.full((len(queries), nprobe * k), np.inf, dtype=np.float32)
+        candidate_ids = np.full((len(queries), nprobe * k), -1, dtype=np.int64)
+        probed = probes.ravel()
+        order = np.argsort(probed, kind="stable")
+        bounds = np.flatnonzero(np.r_[True, probed[order][1:] != probed[order][:-1], True])
+
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            list_number = probed[order[first]]
+            vectors, ids = self.list_vectors[list_number], self.list_ids[list_number]
+            if not len(ids):
+                continue
+            rows, slots = np.divmod(order[first:last], nprobe)
+            distances = 1 - queries[rows] @ vectors.T
+            positions = top_k(distances, k)
+            columns = slots[:, None] * k + np.arange(positions.shape[1])
+            candidate_distances[rows[:, None], columns] = np.take_along_axis(distances, positions, axis=1)
+            candidate_ids[rows[:, None], columns] = ids[positions]
+
+        best = top_k(candidate_distances, k)
+        result_distances = np.take_along_axis(candidate_distances, best, axis=1)
+        result_ids = np.take_along_axis(candidate_ids, best, axis=1)
+        result_ids[~np.isfinite(result_distances)] = -1
+        return result_distances, result_ids
+
+    def save(self, path):
+        sizes = np.array([len(ids) for ids in self.list_ids], dtype=np.int64)
+        with open(path, "wb") as file:
+            np.savez(
+                file,
+                kind=self.kind,
+                dim=self.dim,
+                nlist=self.nlist,
+                nprobe=self.nprobe,
+                centroids=self.centroids,
+                sizes=sizes,
+                vectors=np.concatenate(self.list_vectors),
+                ids=np.concatenate(self.list_ids),
+                version=self.version or "",
+            )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            index = cls(dim=int(data["dim"]), nlist=int(data["nlist"]), nprobe=int(data["nprobe"]))
+            index.centroids = data["centroids"]
+            offsets = np.cumsum(data["sizes"])[:-1]
+            index.list_vectors = np.split(data["vectors"], offsets)
+            index.list_ids = np.split(data["ids"], offsets)
+            index.version = (str(data["version"]) or None) if "version" in data.files else None
+        return index
@@ -0,0 +1,59 @@
+import sys
+import time
+import numpy as np
+from pathlib import Path
+
+# Make the project modules importable when run as a script
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from face_index.flat import FlatIndex
+
+def recall_report(index, embeddings, queries, k=10, nprobes=(1, 2, 4, 8, 16, 32, 64)):
+    """
+    Measures recall@k and per-query latency of an approximate index against exact search.
+
+    Args:
+        index (IVFIndex): Trained and populated index whose ids are the row numbers of `embeddings`.
+        embeddings: The embeddings held by `index`, used to build the exact reference.
+        queries: Query embeddings of shape (n, dim).
+        k (int): Number of neighbours compared per query. Defaults to 10.
+        nprobes (Iterable[int]): nprobe values to sweep. Defaults to 1 through 64.
+
+    Returns:
+        List[dict]: One row per setting with `nprobe`, `recall` and `latency_ms`. The first row is exact
+                    flat search with `nprobe` set to None and recall 1.0.
+    """
+    exact = FlatIndex(dim=index.dim)
+    exact.add(embeddings, range(len(embeddings)))
+
+    start = time.perf_counter()
+    _, expected = exact.search(queries, k)
+    rows = [{"nprobe": None, "recall": 1.0, "latency_ms": (time.perf_counter() - start) * 1000 / len(queries)}]
+
+    for nprobe in nprobes:
+        if nprobe > index.nlist:
+            break
+        start = time.perf_counter()
+        _, found = index.search(queries, k, nprobe=nprobe)
+        latency = (time.perf_counter() - start) * 1000 / len(queries)
+
+        hits = sum(len(np.intersect1d(row_found, row_expected)) for row_found, row_expected in zip(found, expected))
+        rows.append({"nprobe": nprobe, "recall": hits / expected.size, "latency_ms": latency})
+
+    return rows
+
+if __name__ == "__main__":
+    # Example usage: Recall vs latency on a synthetic clustered gallery
+    from face_index.ivf import IVFIndex
+
+    rng = np.random.default_rng(0)
+    people = rng.normal(size=(5000, 512)).astype(np.float32)
+    embeddings = people[rng.integers(0, len(people), size=100000)] + 0.5 * rng.normal(size=(100000, 512)).astype(np.float32)
+    queries = embeddings[rng.choice(len(embeddings), size=200, replace=False)] + 0.1 * rng.normal(size=(200, 512)).astype(np.float32)
+
+    index = IVFIndex(dim=512, nlist=316)
+    index.train(embeddings)
+    index.add(embeddings, range(len(embeddings)))
+
+    for row in recall_report(index, embeddings, queries):
+        print(f"nprobe={row['nprobe']}: recall@10 {row['recall']:.3f}, {row['latency_ms']:.2f} ms/query")
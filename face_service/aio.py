@@ -0,0 +1,205 @@
+import asyncio
+import time
+import numpy as np
+import instrumentation
+from concurrent.futures import ThreadPoolExecutor
+from embedding_store import load_gallery
+from represent_faces import detect_faces, embed_faces
+
+class MicroBatcher:
+    """
+    Coalesces concurrent single-item calls into batched calls of a blocking function.
+
+    Callers `await submit(item)`. Items wait in a bounded queue; a single consumer task takes the first
+    waiting item, keeps collecting until `max_batch_size` items are gathered or `max_latency` seconds
+    have passed since the first one, then runs `function(items)` in `executor` and hands each caller
+    its own result. When the queue is full, `submit` waits, which pushes back on the callers.
+
+    Example:
+        >>> batcher = MicroBatcher(lambda crops: embed_faces(crops), max_batch_size=32, max_latency=0.005)
+        >>> embedding = await batcher.submit(crop)
+    """
+
+    def __init__(self, function, max_batch_size=32, max_latency=0.005, max_queue=1024, executor=None, name="batch"):
+        self.function = function
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.executor = executor
+        self.name = name
+        self.max_queue = max_queue
+        self.queue = None
+        self.task = None
+
+    def start(self):
+        # The queue and consumer task are created on first use so they belong to the running loop
+        if self.task is None:
+            self.queue = asyncio.Queue(maxsize=self.max_queue)
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def submit(self, item):
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_latency
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # Drop callers that were cancelled while waiting in the queue
+            batch = [(item, future) for item, future in batch if not future.done()]
+            if not batch:
+                continue
+
+            instrumentation.count("batch_items", len(batch), stage=self.name)
+            start = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(self.executor, self.function, [item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            finally:
+                instrumentation.observe(self.name, time.perf_counter() - start)
+
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+class AsyncFaceService:
+    """
+    Asyncio front end for representation and identification under concurrent requests.
+
+    Each request is decoded and detected in a thread pool (`detect_workers` at a time), so detection of
+    concurrent images overlaps. The aligned crops of all in-flight requests are coalesced by one
+    `MicroBatcher` into batched calls of the recognition model, and their embeddings by a second one
+    into batched `search_batch` calls on the gallery. Both run on a single dedicated thread each, so
+    the model and the gallery matrix are never used from two threads at once. At most `max_pending`
+    requests are admitted at a time; the others wait for a free slot.
+
+    Example:
+        >>> async with AsyncFaceService(load_gallery(), max_latency=0.01) as service:
+        ...     results = await asyncio.gather(*(service.identify(image) for image in images))
+    """
+
+    def __init__(self, searcher=None, detector_backend="retinaface", model_name="ArcFace", detect_workers=4,
+                 max_batch_size=32, max_latency=0.01, max_pending=256):
+        self.searcher = searcher if searcher is not None else load_gallery()
+        self.detector_backend = detector_backend
+        self.model_name = model_name
+        self.detect_executor = ThreadPoolExecutor(max_workers=detect_workers, thread_name_prefix="detect")
+        self.embed_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embed")
+        self.search_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="search")
+        self.max_pending = max_pending
+        self.pending = None
+
+        self.embed_batcher = MicroBatcher(
+            lambda crops: list(embed_faces(crops, model_name=model_name)),
+            max_batch_size, max_latency, max_pending * 4, self.embed_executor, name="async_embed",
+        )
+        self.search_batcher = MicroBatcher(
+            self._search, max_batch_size, max_latency, max_pending * 4, self.search_executor, name="async_search",
+        )
+
+    def _search(self, items):
+        # Items are (embedding, k); the batch is searched with the largest k and trimmed per caller
+        matches = self.searcher.search_batch(np.stack([embedding for embedding, _ in items]), k=max(k for _, k in items))
+        return [query_matches[:k] for (_, k), query_matches in zip(items, matches)]
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        await self.embed_batcher.close()
+        await self.search_batcher.close()
+        for executor in (self.detect_executor, self.embed_executor, self.search_executor):
+            executor.shutdown(wait=False)
+
+    async def _detect(self, img_path):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.detect_executor, lambda: detect_faces(img_path, detector_backend=self.detector_backend))
+
+    async def represent(self, img_path):
+        """
+        Detects and embeds every face of one image.
+
+        Returns:
+            Union[List[dict], str]: One entry per face with `embedding`, `facial_area` and `face_confidence`,
+                                    shaped like `represent_faces.get_vector`, or an "Error: ..." string.
+        """
+        if self.pending is None:
+            self.pending = asyncio.Semaphore(self.max_pending)
+
+        async with self.pending:
+            try:
+                faces = await self._detect(img_path)
+                embeddings = await asyncio.gather(*(self.embed_batcher.submit(face["face"]) for face in faces))
+            except Exception as e:
+                instrumentation.count("failures", stage="async_represent", error=type(e).__name__)
+                return f"Error: {str(e)}"
+
+        return [
+            {"embedding": embedding.tolist(), "facial_area": face["facial_area"], "face_confidence": face["confidence"]}
+            for face, embedding in zip(faces, embeddings)
+        ]
+
+    async def identify(self, img_path, k=1):
+        """
+        Identifies every face of one image against the gallery.
+
+        Returns:
+            Union[List[dict], str]: One entry per face with `facial_area`, `face_confidence` and up to k
+                                    `matches`, like the `faces` of `identify_faces.identify_all_faces`,
+                                    or an "Error: ..." string.
+        """
+        faces = await self.represent(img_path)
+        if isinstance(faces, str):
+            return faces
+
+        try:
+            matches = await asyncio.gather(*(self.search_batcher.submit((face["embedding"], k)) for face in faces))
+        except Exception as e:
+            instrumentation.count("failures", stage="async_identify", error=type(e).__name__)
+            return f"Error: {str(e)}"
+
+        return [
+            {"facial_area": face["facial_area"], "face_confidence": face["face_confidence"], "matches": face_matches}
+            for face, face_matches in zip(faces, matches)
+        ]
+
+if __name__ == "__main__":
+    # Example usage: Identify a folder of images as concurrent requests
+    import json
+    from image_handler import get_image_files
+
+    async def main():
+        images = get_image_files("testing")
+        async with AsyncFaceService(max_latency=0.01) as service:
+            results = await asyncio.gather(*(service.identify(image, k=1) for image in images))
+        for image, faces in zip(images, results):
+            print(f"{image.name}: {json.dumps(faces, default=str)}")
+
+    asyncio.run(main())
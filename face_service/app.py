@@ -0,0 +1,153 @@
+import numpy as np
+from flask import Flask, jsonify, request
+from flask.json.provider import DefaultJSONProvider
+from deepface import DeepFace
+from deepface.modules.verification import find_threshold
+from compare_faces import distance_matrix
+from embedding_store import load_gallery
+from represent_faces import detect_faces, embed_faces
+
+class NumpyJSONProvider(DefaultJSONProvider):
+    # DeepFace results carry numpy scalars (e.g. float32 emotion scores) that json cannot encode
+    @staticmethod
+    def default(o):
+        if isinstance(o, np.generic):
+            return o.item()
+        if isinstance(o, np.ndarray):
+            return o.tolist()
+        return DefaultJSONProvider.default(o)
+
+def create_app(metadata_file="database/metadata.json", store_folder="database/store", detector_backend="retinaface",
+               model_name="ArcFace", distance_metric="cosine"):
+    """
+    Creates the long-lived face service with its models and gallery loaded once.
+
+    Args:
+        metadata_file (str): Metadata JSON used when no packed store exists.
+        store_folder (str): Packed embedding store folder.
+        detector_backend (str): DeepFace detector backend. Defaults to "retinaface".
+        model_name (str): DeepFace recognition model. Defaults to "ArcFace".
+        distance_metric (str): Distance metric used by /verify. Defaults to "cosine".
+
+    Returns:
+        Flask: The application. Serve it with e.g. `gunicorn -w 1 "face_service.app:create_app()"`.
+
+    Endpoints (all POST, JSON in and out):
+        /represent  {"images": [...]}                       -> {"results": [[face, ...], ...]}
+        /identify   {"images": [...], "k": 1}               -> {"results": [[{"facial_area", "matches"}, ...], ...]}
+        /verify     {"pairs": [[img1, img2], ...]}          -> {"results": [verify result, ...]}
+        /analyze    {"images": [...], "actions": [...]}     -> {"results": [analyze result, ...]}
+        /reload     {}                                      -> {"gallery_size": n}
+
+    Images are file paths visible to the service or base64 encoded data URIs. A failure on one image
+    is returned as an "Error: ..." string in its slot, so one bad image never fails the whole batch.
+    """
+    app = Flask(__name__)
+    app.json = NumpyJSONProvider(app)
+
+    # Warm start: build the recognition model and run the detector once so its weights are loaded
+    DeepFace.build_model(model_name)
+    detect_faces(np.zeros((64, 64, 3), dtype=np.uint8), detector_backend=detector_backend, enforce_detection=False)
+    state = {"gallery": load_gallery(metadata_file, store_folder)}
+
+    # Function to detect every image, then embed all of their faces in a single batch
+    def represent(images):
+        detections = []
+        for image in images:
+            try:
+                detections.append(detect_faces(image, detector_backend=detector_backend))
+            except Exception as e:
+                detections.append(f"Error: {str(e)}")
+
+        faces = [face["face"] for faces in detections if not isinstance(faces, str) for face in faces]
+        embeddings = iter(embed_faces(faces, model_name=model_name) if faces else [])
+
+        return [
+            faces if isinstance(faces, str) else [
+                {
+                    "embedding": next(embeddings).tolist(),
+                    "facial_area": face["facial_area"],
+                    "face_confidence": face["confidence"],
+                }
+                for face in faces
+            ]
+            for faces in detections
+        ]
+
+    @app.post("/represent")
+    def represent_endpoint():
+        return jsonify({"results": represent(request.get_json()["images"])})
+
+    @app.post("/identify")
+    def identify_endpoint():
+        body = request.get_json()
+        results = represent(body["images"])
+
+        # Score every face of every image against the gallery in one batched search
+        embeddings = [face["embedding"] for faces in results if not isinstance(faces, str) for face in faces]
+        matches = iter(state["gallery"].search_batch(np.array(embeddings), k=body.get("k", 1)) if embeddings else [])
+
+        return jsonify({"results": [
+            faces if isinstance(faces, str) else [
+                {"facial_area": face["facial_area"], "matches": next(matches)}
+                for face in faces
+            ]
+            for faces in results
+        ]})
+
+    @app.post("/verify")
+    def verify_endpoint():
+        pairs = request.get_json()["pairs"]
+        threshold = find_threshold(model_name, distance_metric)
+
+        # Embed each distinct image once, keeping its first face like DeepFace.verify does
+        images = list(dict.fromkeys(image for pair in pairs for image in pair))
+        results = dict(zip(images, represent(images)))
+        for image, faces in results.items():
+            if not isinstance(faces, str) and not faces:
+                results[image] = "Error: no face detected"
+        embedded = [image for image in images if not isinstance(results[image], str)]
+        rows = {image: row for row, image in enumerate(embedded)}
+        vectors = np.array([results[image][0]["embedding"] for image in embedded], dtype=np.float32)
+        distances = distance_matrix(vectors, vectors, distance_metric) if embedded else None
+
+        output = []
+        for img1_path, img2_path in pairs:
+            error = next((results[image] for image in (img1_path, img2_path) if isinstance(results[image], str)), None)
+            if error is not None:
+                output.append(error)
+                continue
+            distance = float(distances[rows[img1_path], rows[img2_path]])
+            output.append({
+                "verified": distance <= threshold,
+                "distance": distance,
+                "threshold": threshold,
+                "model": model_name,
+                "detector_backend": detector_backend,
+                "similarity_metric": distance_metric,
+                "facial_areas": {"img1": results[img1_path][0]["facial_area"], "img2": results[img2_path][0]["facial_area"]},
+            })
+        return jsonify({"results": output})
+
+    @app.post("/analyze")
+    def analyze_endpoint():
+        body = request.get_json()
+        actions = body.get("actions", ["emotion", "age", "gender", "race"])
+        output = []
+        for image in body["images"]:
+            try:
+                output.append(DeepFace.analyze(img_path=image, actions=actions, detector_backend=detector_backend))
+            except Exception as e:
+                output.append(f"Error: {str(e)}")
+        return jsonify({"results": output})
+
+    @app.post("/reload")
+    def reload_endpoint():
+        state["gallery"] = load_gallery(metadata_file, store_folder)
+        return jsonify({"gallery_size": len(state["gallery"])})
+
+    return app
+
+if __name__ == "__main__":
+    # Example usage: Serve on localhost with the development server
+    create_app().run(host="127.0.0.1", port=5000)
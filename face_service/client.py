@@ -0,0 +1,82 @@
+import os
+import requests
+from pathlib import Path
+from typing import List, Sequence, Tuple, Union
+
+Image = Union[str, Path]
+
+class FaceServiceClient:
+    """
+    Thin HTTP client for the long-lived face service in `face_service.app`.
+
+    Example:
+        >>> client = FaceServiceClient("http://127.0.0.1:5000")
+        >>> client.identify(["testing/query_image.png"], k=3)
+        [[{'facial_area': {...}, 'matches': [{'label': 'Hunter Boon', 'distance': 0.393, ...}]}]]
+    """
+
+    def __init__(self, url: str = "http://127.0.0.1:5000", timeout: float = 300):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def _post(self, endpoint, body):
+        response = self.session.post(f"{self.url}/{endpoint}", json=body, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    @staticmethod
+    def _image(image: Image) -> str:
+        # Paths are resolved so the service can open them regardless of its working directory
+        if isinstance(image, Path) or not str(image).startswith("data:"):
+            return str(Path(image).resolve())
+        return image
+
+    def represent(self, images: Sequence[Image]) -> List:
+        return self._post("represent", {"images": [self._image(image) for image in images]})["results"]
+
+    def identify(self, images: Sequence[Image], k: int = 1) -> List:
+        return self._post("identify", {"images": [self._image(image) for image in images], "k": k})["results"]
+
+    def verify(self, pairs: Sequence[Tuple[Image, Image]]) -> List:
+        return self._post("verify", {"pairs": [[self._image(img1), self._image(img2)] for img1, img2 in pairs]})["results"]
+
+    def analyze(self, images: Sequence[Image], actions=("emotion", "age", "gender", "race")) -> List:
+        return self._post("analyze", {"images": [self._image(image) for image in images], "actions": list(actions)})["results"]
+
+    def reload(self) -> int:
+        return self._post("reload", {})["gallery_size"]
+
+_default_client = None
+
+# Function to get the client shared by the helpers below, created on first use
+def default_client():
+    global _default_client
+    if _default_client is None:
+        _default_client = FaceServiceClient(os.environ.get("FACE_SERVICE_URL", "http://127.0.0.1:5000"))
+    return _default_client
+
+# Drop-in replacements for the in-process helpers in the scripts, served by the running service
+def get_vector(img_path, client=None):
+    return (client or default_client()).represent([img_path])[0]
+
+def get_identity(img_path, k=1, client=None):
+    return (client or default_client()).identify([img_path], k=k)[0]
+
+def compare_faces(img1_path, img2_path, client=None):
+    return (client or default_client()).verify([(img1_path, img2_path)])[0]
+
+def analyze_face(image_path, client=None):
+    return (client or default_client()).analyze([image_path])[0]
+
+if __name__ == "__main__":
+    # Example usage: Identify and verify against a service started with `python -m face_service.app`
+    import json
+
+    query_image = "testing/query_image.png"
+    faces = get_identity(query_image, k=3)
+    print(json.dumps(faces, indent=4, default=str))
+
+    # Verify the query against the gallery image of its closest match
+    if not isinstance(faces, str) and faces and faces[0]["matches"]:
+        print(json.dumps(compare_faces(query_image, faces[0]["matches"][0]["image_path"]), indent=4, default=str))
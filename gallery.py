@@ -0,0 +1,128 @@
+import json
+import numpy as np
+import instrumentation
+from pathlib import Path
+from typing import List, Union
+
+# Function to normalize vectors (unit norm for cosine similarity)
+def normalize(vectors):
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+# Function to find the k smallest distances per row without sorting the full row
+def top_k(distances, k):
+    distances = np.atleast_2d(distances)
+    k = min(k, distances.shape[1])
+    if k <= 0:
+        return np.empty((distances.shape[0], 0), dtype=np.intp)
+    if k < distances.shape[1]:
+        candidates = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.tile(np.arange(distances.shape[1]), (distances.shape[0], 1))
+    order = np.take_along_axis(distances, candidates, axis=1).argsort(axis=1, kind="stable")
+    return np.take_along_axis(candidates, order, axis=1)
+
+class Gallery:
+    """
+    In-memory matrix of enrolled face embeddings for vectorized cosine search.
+
+    All embeddings are loaded once into a single contiguous, unit-normalized float32 matrix
+    alongside parallel arrays of labels, image paths and hashes. Cosine distance against the
+    whole gallery then reduces to one matrix multiply per query batch.
+
+    Example:
+        >>> gallery = Gallery.from_metadata("database/metadata.json")
+        >>> gallery.search(query_embedding, k=3)
+        [{'label': 'Hunter Boon', 'distance': 0.393, 'image_path': 'database/images/Hunter Boon/4.png', 'hash': '...'}, ...]
+    """
+
+    def __init__(self, embeddings, labels, image_paths, hashes=None):
+        self.embeddings = np.ascontiguousarray(normalize(embeddings)) if len(labels) else np.empty((0, 0), dtype=np.float32)
+        self.labels = np.asarray(labels, dtype=object)
+        self.image_paths = np.asarray(image_paths, dtype=object)
+        self.hashes = np.asarray(hashes if hashes is not None else [None] * len(labels), dtype=object)
+
+    def __len__(self):
+        return len(self.labels)
+
+    @classmethod
+    @instrumentation.timed("gallery_load")
+    def from_metadata(cls, metadata_file: Union[str, Path]) -> "Gallery":
+        """
+        Builds a gallery from the metadata.json written by `represent_faces.store_metadata_and_embeddings`.
+
+        Args:
+            metadata_file (Union[str, Path]): Path to the metadata JSON file.
+
+        Returns:
+            Gallery: Gallery holding every embedding listed in the metadata file.
+        """
+        with open(metadata_file) as file:
+            saved_images = json.load(file)["images"]
+
+        embeddings = [np.load(saved_image["embedding_path"]) for saved_image in saved_images]
+        return cls(
+            embeddings,
+            labels=[saved_image["label"] for saved_image in saved_images],
+            image_paths=[saved_image["image_path"] for saved_image in saved_images],
+            hashes=[saved_image.get("hash") for saved_image in saved_images],
+        )
+
+    def distances(self, queries):
+        """
+        Computes the cosine distance between each query and every gallery embedding.
+
+        Args:
+            queries: A single embedding of shape (d,) or a batch of shape (n, d).
+
+        Returns:
+            np.ndarray: Distance matrix of shape (n, len(gallery)).
+        """
+        return 1 - normalize(queries) @ self.embeddings.T
+
+    @instrumentation.timed("gallery_search")
+    def search_batch(self, queries, k: int = 1) -> List[List[dict]]:
+        """
+        Finds the k closest gallery images for each query in a batch.
+
+        Args:
+            queries: Embeddings of shape (n, d), or a single embedding of shape (d,).
+            k (int): Number of matches to return per query. Defaults to 1.
+
+        Returns:
+            List[List[dict]]: For each query, up to k matches ordered by increasing distance.
+                              Each match holds `label`, `distance`, `image_path` and `hash`.
+        """
+        if len(self) == 0:
+            return [[] for _ in range(len(np.atleast_2d(queries)))]
+
+        distances = self.distances(queries)
+        indices = top_k(distances, k)
+
+        return [
+            [
+                {
+                    "label": self.labels[index],
+                    "distance": float(row_distances[index]),
+                    "image_path": self.image_paths[index],
+                    "hash": self.hashes[index],
+                }
+                for index in row_indices
+            ]
+            for row_distances, row_indices in zip(distances, indices)
+        ]
+
+    def search(self, query, k: int = 1) -> List[dict]:
+        """
+        Finds the k closest gallery images for a single query embedding.
+
+        Args:
+            query: Embedding of shape (d,).
+            k (int): Number of matches to return. Defaults to 1.
+
+        Returns:
+            List[dict]: Up to k matches ordered by increasing distance.
+        """
+        return self.search_batch(np.atleast_2d(query), k)[0]
@@ -0,0 +1,134 @@
+import sys
+import json
+import time
+import numpy as np
+import tenseal as ts
+from pathlib import Path
+
+root = Path(__file__).resolve().parent.parent
+
+# Make the project modules importable when run as a script
+sys.path.insert(0, str(root))
+
+from gallery import Gallery, normalize
+from homomorphic.encrypted_gallery import EncryptedGallery, create_context, scoring_pool
+
+# CKKS parameter sets to sweep. The first is the one encrypt.py and centroid_encrypted.py used to hardcode.
+PARAMETER_SETS = [
+    {"poly_modulus_degree": 8192, "coeff_mod_bit_sizes": [40, 20, 40], "global_scale": 2**20},
+    {"poly_modulus_degree": 8192, "coeff_mod_bit_sizes": [60, 40, 40, 60], "global_scale": 2**40},
+    {"poly_modulus_degree": 8192, "coeff_mod_bit_sizes": [40, 30, 30, 40], "global_scale": 2**30},
+    {"poly_modulus_degree": 16384, "coeff_mod_bit_sizes": [60, 40, 40, 40, 60], "global_scale": 2**40},
+]
+
+# Function to generate clustered synthetic embeddings shaped like ArcFace output
+def synthetic_embeddings(faces, people, dim=512, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(people, dim))
+    labels = rng.integers(0, people, size=faces)
+    return (centers[labels] + 0.6 * rng.normal(size=(faces, dim))).astype(np.float32), labels
+
+# Function to measure one parameter set against plaintext search
+def benchmark_parameters(parameters, embeddings, queries, k=5, packed=True, workers=None, bundle_path=None):
+    labels = [str(index) for index in range(len(embeddings))]
+    plaintext = Gallery(embeddings, labels, labels)
+
+    start = time.perf_counter()
+    context = create_context(**parameters)
+    context_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if packed:
+        encrypted = EncryptedGallery.encrypt(embeddings, labels, labels, context=context)
+        ciphertexts = encrypted.ciphertexts
+    else:
+        # One ciphertext per face, the layout homomorphic/encrypt.py used to write
+        ciphertexts = [ts.ckks_vector(context, vector.astype(np.float64).tolist()) for vector in normalize(embeddings)]
+    encrypt_seconds = time.perf_counter() - start
+
+    score_seconds, decrypt_seconds, errors, agreement = 0.0, 0.0, [], []
+    for query in queries:
+        expected = 1 - plaintext.distances(query)[0]
+        start = time.perf_counter()
+        if packed:
+            normalized = normalize(query)[0].astype(np.float64).tolist()
+            results = [
+                ciphertext.enc_matmul_plain(normalized, min(encrypted.rows, len(embeddings) - number * encrypted.rows))
+                for number, ciphertext in enumerate(ciphertexts)
+            ]
+        else:
+            normalized = normalize(query)[0].astype(np.float64).tolist()
+            results = [ciphertext.dot(normalized) for ciphertext in ciphertexts]
+        score_seconds += time.perf_counter() - start
+
+        start = time.perf_counter()
+        similarities = np.array([value for result in results for value in result.decrypt()])[:len(embeddings)]
+        decrypt_seconds += time.perf_counter() - start
+
+        errors.append(np.abs(similarities - expected).max())
+        agreement.append(len(np.intersect1d(np.argsort(-similarities)[:k], np.argsort(-expected)[:k])) / k)
+
+    row = {
+        **parameters,
+        "layout": "packed" if packed else "per_face",
+        "faces": len(embeddings),
+        "ciphertexts": len(ciphertexts),
+        "context_seconds": context_seconds,
+        "encrypt_ms_per_face": encrypt_seconds * 1000 / len(embeddings),
+        "score_ms_per_face": score_seconds * 1000 / (len(queries) * len(embeddings)),
+        "decrypt_ms_per_face": decrypt_seconds * 1000 / (len(queries) * len(embeddings)),
+        "bytes_per_face": sum(len(ciphertext.serialize()) for ciphertext in ciphertexts) / len(embeddings),
+        "context_bytes": len(context.serialize(save_secret_key=True)),
+        "max_cosine_error": float(np.max(errors)),
+        f"top{k}_agreement": float(np.mean(agreement)),
+    }
+
+    # Parallel scoring of the packed layout, end to end including decryption
+    if packed and workers != 1 and bundle_path is not None:
+        encrypted.save(bundle_path)
+        with scoring_pool(bundle_path, workers) as executor:
+            encrypted.similarities(queries[0], executor)  # Warm the workers
+            start = time.perf_counter()
+            for query in queries:
+                encrypted.similarities(query, executor)
+            row["parallel_query_ms"] = (time.perf_counter() - start) * 1000 / len(queries)
+
+    return row
+
+def run(faces=1024, people=128, queries=10, k=5, workers=None, output="homomorphic/benchmark.json"):
+    """
+    Sweeps `PARAMETER_SETS` on synthetic 512-d embeddings and writes the results as JSON.
+
+    Args:
+        faces (int): Number of synthetic gallery faces. Defaults to 1024.
+        people (int): Number of synthetic identities. Defaults to 128.
+        queries (int): Number of queries timed per parameter set. Defaults to 10.
+        k (int): Depth of the ranking-agreement check against plaintext search. Defaults to 5.
+        workers (Optional[int]): Processes for the parallel scoring run. 1 skips it. Defaults to `os.cpu_count()`.
+        output (Union[str, Path]): JSON file the rows are written to.
+
+    Returns:
+        List[dict]: One row per parameter set and layout with encrypt/score/decrypt time per face, serialized
+                    bytes per face, the largest cosine error and top-k agreement with plaintext search.
+    """
+    embeddings, _ = synthetic_embeddings(faces, people)
+    query_embeddings = embeddings[:queries] + 0.1 * np.random.default_rng(1).normal(size=(queries, embeddings.shape[1])).astype(np.float32)
+    bundle_path = root / "homomorphic/benchmark_bundle.bin"
+
+    rows = [benchmark_parameters(PARAMETER_SETS[0], embeddings, query_embeddings, k, packed=False)]
+    for parameters in PARAMETER_SETS:
+        try:
+            rows.append(benchmark_parameters(parameters, embeddings, query_embeddings, k, workers=workers, bundle_path=bundle_path))
+        except Exception as e:
+            rows.append({**parameters, "layout": "packed", "error": f"Error: {str(e)}"})
+    bundle_path.unlink(missing_ok=True)
+
+    with open(root / output, "w") as file:
+        json.dump(rows, file, indent=4)
+
+    for row in rows:
+        print(json.dumps(row))
+    return rows
+
+if __name__ == "__main__":
+    run()
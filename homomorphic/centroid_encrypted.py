@@ -1,49 +1,35 @@
+import sys
 import numpy as np
-import tenseal as ts
+from pathlib import Path
 
-# Example vectors
-vector_A = np.array([1, 2, 3])
-vector_B = np.array([4, 5, 6])
+root = Path(__file__).resolve().parent.parent
 
-# Step 1: Calculate magnitudes (norm) in plaintext
-magnitude_A = np.linalg.norm(vector_A)
-magnitude_B = np.linalg.norm(vector_B)
+# Make the project modules importable when run as a script
+sys.path.insert(0, str(root))
 
-# Step 2: Set up TenSEAL context (encryption parameters)
-context = ts.context(ts.SCHEME_TYPE.CKKS, poly_modulus_degree=8192, coeff_mod_bit_sizes=[40, 20, 40])
-context.global_scale = 2**20
-context.generate_galois_keys()
+from centroid_index import CentroidIndex
+from embedding_store import load_gallery
+from homomorphic.encrypted_gallery import EncryptedGallery, create_context
 
-# Step 3: Encrypt the vectors
-encrypted_vector_A = ts.ckks_vector(context, vector_A)
-encrypted_vector_B = ts.ckks_vector(context, vector_B)
+if __name__ == "__main__":
+    # Step 1: Build the per-person centroids in plaintext
+    gallery = load_gallery(root / "database/metadata.json", root / "database/store")
+    index = CentroidIndex.from_gallery(gallery)
 
-# Save the encrypted vectors to .npy files
-encrypted_vector_A.save("encrypted_vector_A.npy")
-encrypted_vector_B.save("encrypted_vector_B.npy")
+    # Step 2: Set up TenSEAL context (encryption parameters)
+    context = create_context()
 
-# You can also save the magnitudes in plaintext for later
-np.save("magnitude_A.npy", magnitude_A)
-np.save("magnitude_B.npy", magnitude_B)
+    # Step 3: Normalize and encrypt every centroid, several per ciphertext
+    encrypted = EncryptedGallery.encrypt(index.centroids, index.labels, index.representatives, context=context)
 
-# Now later when we need to compute cosine similarity...
+    # Step 4: Save the context and encrypted centroids together, then load them back
+    encrypted.save(root / "homomorphic/encrypted_centroids.bin")
+    encrypted = EncryptedGallery.load(root / "homomorphic/encrypted_centroids.bin")
 
-# Step 4: Load the encrypted vectors from the .npy files
-encrypted_vector_A = ts.ckks_vector.load(context, "encrypted_vector_A.npy")
-encrypted_vector_B = ts.ckks_vector.load(context, "encrypted_vector_B.npy")
+    # Step 5: Score a query against every encrypted centroid with one product per ciphertext and decrypt
+    query_vector = gallery.embeddings[0]
+    match = encrypted.search(query_vector, k=1)[0]
 
-# Step 5: Compute the encrypted dot product (A · B)
-encrypted_dot_product = encrypted_vector_A.dot(encrypted_vector_B)
-
-# Step 6: Decrypt the result of the dot product
-dot_product = encrypted_dot_product.decrypt()
-
-# Step 7: Load the saved plaintext magnitudes
-magnitude_A = np.load("magnitude_A.npy")
-magnitude_B = np.load("magnitude_B.npy")
-
-# Step 8: Compute the final cosine similarity
-cosine_similarity = dot_product / (magnitude_A * magnitude_B)
-difference = 1 - cosine_similarity
-
-print(f"Cosine Similarity: {cosine_similarity}")
+    # Step 6: Compare with the plaintext cosine distance
+    expected = 1 - np.dot(query_vector, index.centroids[index.rows[match["label"]]])
+    print(f"Closest match: {match['label']} with distance {match['distance']} (plaintext {expected})")
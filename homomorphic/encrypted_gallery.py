@@ -0,0 +1,183 @@
+import os
+import json
+import struct
+import numpy as np
+import tenseal as ts
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Union
+from gallery import normalize, top_k
+
+MAGIC = b"FACEGALLERY1"
+
+# Function to set up a CKKS context deep enough for the rotations of an encrypted matrix-vector product
+def create_context(poly_modulus_degree=8192, coeff_mod_bit_sizes=(60, 40, 40, 60), global_scale=2**40):
+    context = ts.context(ts.SCHEME_TYPE.CKKS, poly_modulus_degree=poly_modulus_degree, coeff_mod_bit_sizes=list(coeff_mod_bit_sizes))
+    context.global_scale = global_scale
+    context.generate_galois_keys()
+    return context
+
+# Function to get the number of CKKS slots (half the polynomial modulus degree) of a context
+def slot_count(context):
+    return context.seal_context().data.first_context_data().parms().poly_modulus_degree() // 2
+
+class EncryptedGallery:
+    """
+    CKKS-encrypted gallery that packs several normalized embeddings into each ciphertext.
+
+    A CKKS ciphertext with polynomial degree N has N / 2 slots. A 512-d embedding would use only 512 of
+    them, so `slots // dim` consecutive embeddings (8 at degree 8192) are packed into each ciphertext as a
+    matrix with `ts.enc_matmul_encoding`. A plaintext query is then scored against every face in a
+    ciphertext with one plaintext-ciphertext product and log2(dim) rotations (`enc_matmul_plain`).
+    Because the embeddings are normalized before encryption, the decrypted scores are cosine
+    similarities and no plaintext magnitudes have to be kept.
+
+    The serialized context, the ciphertexts and the labels, image paths and hashes are saved together
+    in one bundle file.
+
+    Example:
+        >>> encrypted = EncryptedGallery.from_gallery(load_gallery())
+        >>> encrypted.save("homomorphic/encrypted_gallery.bin")
+        >>> EncryptedGallery.load("homomorphic/encrypted_gallery.bin").search(query_embedding, k=3)
+        [{'label': 'Hunter Boon', 'distance': 0.393, 'image_path': 'database/images/Hunter Boon/4.png', 'hash': '...'}, ...]
+    """
+
+    def __init__(self, context, ciphertexts, rows, labels, image_paths, hashes, dim):
+        self.context = context
+        self.ciphertexts = ciphertexts
+        self.rows = rows
+        self.labels = np.asarray(labels, dtype=object)
+        self.image_paths = np.asarray(image_paths, dtype=object)
+        self.hashes = np.asarray(hashes, dtype=object)
+        self.dim = dim
+
+    def __len__(self):
+        return len(self.labels)
+
+    @classmethod
+    def encrypt(cls, embeddings, labels, image_paths, hashes=None, context=None) -> "EncryptedGallery":
+        """
+        Normalizes and encrypts embeddings, packing as many per ciphertext as the slots allow.
+
+        Args:
+            embeddings: Array of shape (n, d).
+            labels (Sequence[str]): Person label for each embedding.
+            image_paths (Sequence[str]): Source image for each embedding.
+            hashes (Optional[Sequence[str]]): sha256 of each source image.
+            context (Optional[ts.Context]): CKKS context with galois keys. Defaults to `create_context()`.
+
+        Returns:
+            EncryptedGallery: The encrypted gallery.
+        """
+        context = context or create_context()
+        vectors = normalize(embeddings).astype(np.float64)
+        dim = vectors.shape[1]
+        rows = max(1, slot_count(context) // dim)
+
+        ciphertexts = [ts.enc_matmul_encoding(context, vectors[start:start + rows]) for start in range(0, len(vectors), rows)]
+        return cls(context, ciphertexts, rows, labels, image_paths, hashes if hashes is not None else [None] * len(labels), dim)
+
+    @classmethod
+    def from_gallery(cls, gallery, context=None) -> "EncryptedGallery":
+        return cls.encrypt(gallery.embeddings, gallery.labels, gallery.image_paths, gallery.hashes, context)
+
+    def _score(self, query, first, last):
+        scores = []
+        for number in range(first, last):
+            count = min(self.rows, len(self) - number * self.rows)
+            scores.extend(self.ciphertexts[number].enc_matmul_plain(query, count).decrypt()[:count])
+        return scores
+
+    def similarities(self, query, executor=None) -> np.ndarray:
+        """
+        Computes the cosine similarity of a plaintext query to every encrypted face, then decrypts it.
+
+        Args:
+            query: Plaintext embedding of shape (d,).
+            executor (Optional[ProcessPoolExecutor]): Pool from `scoring_pool` to spread the ciphertexts
+                                                      across processes. Defaults to scoring in this process.
+
+        Returns:
+            np.ndarray: Similarities of shape (len(gallery),).
+        """
+        query = normalize(query)[0].astype(np.float64).tolist()
+        if executor is None:
+            return np.array(self._score(query, 0, len(self.ciphertexts)), dtype=np.float64)
+
+        # Contiguous ranges of ciphertexts, a couple per core, concatenated back in order
+        bounds = np.linspace(0, len(self.ciphertexts), min(len(self.ciphertexts), 2 * os.cpu_count()) + 1).astype(int)
+        shards = executor.map(_score_shard, [query] * (len(bounds) - 1), bounds[:-1], bounds[1:])
+        return np.array([score for shard in shards for score in shard], dtype=np.float64)
+
+    def search(self, query, k: int = 1, executor=None) -> List[dict]:
+        """
+        Finds the k closest encrypted faces to a plaintext query.
+
+        Returns:
+            List[dict]: Up to k matches ordered by increasing distance, shaped like `Gallery.search`.
+        """
+        if len(self) == 0:
+            return []
+
+        distances = 1 - self.similarities(query, executor)
+        return [
+            {
+                "label": self.labels[index],
+                "distance": float(distances[index]),
+                "image_path": self.image_paths[index],
+                "hash": self.hashes[index],
+            }
+            for index in top_k(distances, k)[0]
+        ]
+
+    def save(self, path: Union[str, Path], save_secret_key: bool = True) -> None:
+        """
+        Writes the context, ciphertexts and metadata to a single bundle file.
+
+        Args:
+            path (Union[str, Path]): Bundle file to write.
+            save_secret_key (bool): If False, the bundle can only be scored, not decrypted. Defaults to True.
+        """
+        header = json.dumps({
+            "dim": self.dim,
+            "rows": self.rows,
+            "labels": [str(label) for label in self.labels],
+            "image_paths": [None if image_path is None else str(image_path) for image_path in self.image_paths],
+            "hashes": [None if image_hash is None else str(image_hash) for image_hash in self.hashes],
+        }).encode()
+
+        with open(path, "wb") as file:
+            file.write(MAGIC)
+            for blob in [header, self.context.serialize(save_secret_key=save_secret_key)] + [ciphertext.serialize() for ciphertext in self.ciphertexts]:
+                file.write(struct.pack("<Q", len(blob)))
+                file.write(blob)
+
+    @classmethod
+    def load(cls, path: Union[str, Path], n_threads=None) -> "EncryptedGallery":
+        with open(path, "rb") as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not an encrypted gallery bundle")
+
+            blobs = []
+            while size := file.read(8):
+                blobs.append(file.read(struct.unpack("<Q", size)[0]))
+
+        header = json.loads(blobs[0])
+        context = ts.context_from(blobs[1], n_threads=n_threads)
+        ciphertexts = [ts.ckks_vector_from(context, blob) for blob in blobs[2:]]
+        return cls(context, ciphertexts, header["rows"], header["labels"], header["image_paths"], header["hashes"], header["dim"])
+
+_worker_gallery = None
+
+# Function to load the bundle once in each scoring worker, single-threaded so workers do not oversubscribe the cores
+def _init_scoring_worker(path):
+    global _worker_gallery
+    _worker_gallery = EncryptedGallery.load(path, n_threads=1)
+
+# Function run in the scoring workers: score one range of ciphertexts
+def _score_shard(query, first, last):
+    return _worker_gallery._score(query, int(first), int(last))
+
+# Function to start a process pool whose workers each hold the encrypted gallery saved at `path`
+def scoring_pool(path, workers=None):
+    return ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=_init_scoring_worker, initargs=(str(path),))
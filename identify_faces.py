@@ -1,5 +1,10 @@
+import numpy as np
+import instrumentation
 from deepface import DeepFace
+from embedding_store import load_gallery
+from face_index import build_index, gallery_version, load_index
 from image_handler import get_image_files
+from pathlib import Path
 from represent_faces import get_vector
 
 def get_identity(img_path, db_path, detector_backend="retinaface", model_name='ArcFace', distance_metric="cosine"):
@@ -13,11 +18,75 @@ def get_identity(img_path, db_path, detector_backend="retinaface", model_name='A
         )
         
     except Exception as e:
+        instrumentation.count("failures", stage="get_identity", error=type(e).__name__)
         return f"Error: {str(e)}"
 
-database_path = "/Users/main/Projects/Docker/faces/database"
-images = get_image_files("/Users/main/Projects/Docker/faces/0.png")[0]
-vector = get_vector(images)
-result = DeepFace.find(img_path = images, db_path = database_path)
-# result = get_identity(images, database_path)
-# print(result)
\ No newline at end of file
+# Function to identify a face through a nearest-neighbour index instead of a linear scan
+def get_identity_indexed(img_path, index, gallery, k=1, detector_backend="retinaface", model_name='ArcFace'):
+    results = get_vector(img_path, detector_backend=detector_backend, model_name=model_name)
+    if isinstance(results, str):
+        return results
+
+    distances, ids = index.search(results[0]["embedding"], k=k)
+    return [
+        {
+            "label": gallery.labels[row],
+            "distance": float(distance),
+            "image_path": gallery.image_paths[row],
+            "hash": gallery.hashes[row],
+        }
+        for distance, row in zip(distances[0], ids[0])
+        if row >= 0
+    ]
+
+def identify_all_faces(images, searcher, k=1, detector_backend="retinaface", model_name='ArcFace'):
+    """
+    Identifies every face in one or more query images with a single batched search.
+
+    Args:
+        images (Union[str, Path, List[Path]]): A query image, a directory of query images or a list of image files.
+        searcher (Union[Gallery, CentroidIndex]): Anything with a `search_batch(queries, k)` method.
+        k (int): Number of matches per face. Defaults to 1.
+        detector_backend (str): DeepFace detector backend. Defaults to "retinaface".
+        model_name (str): DeepFace recognition model. Defaults to "ArcFace".
+
+    Returns:
+        List[dict]: One entry per query image with its `image_path` and a `faces` list. Each face holds its
+                    `facial_area`, `face_confidence` and up to k `matches` (label, distance, image_path).
+                    Images that failed to embed carry an "Error: ..." string in `faces`.
+
+    Example:
+        >>> identify_all_faces("testing/team_photo.png", load_gallery(), k=1)
+        [{'image_path': 'testing/team_photo.png', 'faces': [{'facial_area': {...}, 'face_confidence': 0.99, 'matches': [...]}, ...]}]
+    """
+    if isinstance(images, (str, Path)):
+        images = get_image_files(images)
+
+    # Embed every face of every image, then score them all as one query matrix
+    results = [get_vector(image, detector_backend=detector_backend, model_name=model_name) for image in images]
+    embeddings = [face["embedding"] for faces in results if not isinstance(faces, str) for face in faces]
+    matches = iter(searcher.search_batch(np.array(embeddings), k=k) if embeddings else [])
+
+    return [
+        {
+            "image_path": str(image),
+            "faces": faces if isinstance(faces, str) else [
+                {"facial_area": face["facial_area"], "face_confidence": face["face_confidence"], "matches": next(matches)}
+                for face in faces
+            ],
+        }
+        for image, faces in zip(images, results)
+    ]
+
+if __name__ == "__main__":
+    index_file = "database/index.npz"
+    images = get_image_files("/Users/main/Projects/Docker/faces/0.png")[0]
+
+    # Ids in the index are gallery row numbers, so rebuild it whenever the gallery rows changed
+    gallery = load_gallery()
+    index = load_index(index_file) if Path(index_file).exists() else None
+    if index is None or index.version != gallery_version(gallery):
+        index = build_index(gallery, kind="ivf", nlist=max(1, int(len(gallery) ** 0.5)), nprobe=8)
+        index.save(index_file)
+
+    print(get_identity_indexed(images, index, gallery, k=3))
@@ -0,0 +1,245 @@
+import re
+import cv2
+import numpy as np
+import instrumentation
+from gallery import normalize
+from image_handler import get_images, heic2png
+from pathlib import Path
+from represent_faces import detect_faces, embed_faces
+
+# Function to order frame files naturally, so frame_2.png comes before frame_10.png
+def natural_key(path):
+    # Splitting on digit runs alternates text and numbers, so the parts of any two keys compare with like types
+    return [int(part) if index % 2 else part for index, part in enumerate(re.split(r"(\d+)", str(path)))]
+
+# Function to lazily decode a video file, camera index or folder of frame images as (frame number, seconds, BGR frame)
+def iter_frames(source, fps=None):
+    if isinstance(source, (str, Path)) and Path(source).is_dir():
+        # Frame sequences are decoded one image at a time in natural name order; only the paths are listed up front
+        # and HEIC frames are decoded in memory, so the source folder is never modified
+        fps = fps or 25.0
+        for frame_number, frame_file in enumerate(sorted(get_images.iter_images(source), key=natural_key)):
+            with instrumentation.span("video_decode"):
+                if heic2png.is_heic(frame_file):
+                    frame = heic2png.read_heic(frame_file)
+                    frame = None if frame is None else np.ascontiguousarray(frame[:, :, ::-1])
+                else:
+                    frame = cv2.imread(str(frame_file))
+            if frame is not None:
+                yield frame_number, frame_number / fps, frame
+        return
+
+    capture = cv2.VideoCapture(str(source) if isinstance(source, Path) else source)
+    if not capture.isOpened():
+        raise ValueError(f"Could not open video source {source}")
+    fps = fps or capture.get(cv2.CAP_PROP_FPS) or 25.0
+
+    try:
+        frame_number = 0
+        while True:
+            with instrumentation.span("video_decode"):
+                ok, frame = capture.read()
+            if not ok:
+                break
+            yield frame_number, frame_number / fps, frame
+            frame_number += 1
+    finally:
+        capture.release()
+
+# Function to compute the intersection over union of every pair of (x, y, w, h) boxes
+def iou_matrix(boxes_a, boxes_b):
+    boxes_a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, dtype=np.float32).reshape(-1, 4)
+    left = np.maximum(boxes_a[:, None, 0], boxes_b[None, :, 0])
+    top = np.maximum(boxes_a[:, None, 1], boxes_b[None, :, 1])
+    right = np.minimum(boxes_a[:, None, 0] + boxes_a[:, None, 2], boxes_b[None, :, 0] + boxes_b[None, :, 2])
+    bottom = np.minimum(boxes_a[:, None, 1] + boxes_a[:, None, 3], boxes_b[None, :, 1] + boxes_b[None, :, 3])
+    intersection = np.clip(right - left, 0, None) * np.clip(bottom - top, 0, None)
+    union = (boxes_a[:, 2] * boxes_a[:, 3])[:, None] + (boxes_b[:, 2] * boxes_b[:, 3])[None, :] - intersection
+    return np.where(union > 0, intersection / np.maximum(union, 1e-9), 0)
+
+# Function to pair tracks with detections greedily by decreasing IoU
+def match_boxes(track_boxes, detection_boxes, iou_threshold=0.3):
+    overlaps = iou_matrix(track_boxes, detection_boxes)
+    pairs = []
+    while overlaps.size and overlaps.max() >= iou_threshold:
+        track, detection = np.unravel_index(overlaps.argmax(), overlaps.shape)
+        pairs.append((int(track), int(detection)))
+        overlaps[track, :] = -1
+        overlaps[:, detection] = -1
+    return pairs
+
+# Function to flag a shot change from the mean absolute difference of two downscaled grayscale frames
+def is_scene_cut(previous_small, small, threshold=40.0):
+    return previous_small is not None and float(np.mean(cv2.absdiff(previous_small, small))) > threshold
+
+class Track:
+    """
+    One face followed across frames, holding its latest box and the embeddings sampled along the way.
+    """
+
+    def __init__(self, track_id, box, frame_number, seconds):
+        self.track_id = track_id
+        self.box = np.asarray(box, dtype=np.float32)
+        self.first_frame = self.last_frame = frame_number
+        self.start_seconds = self.end_seconds = seconds
+        self.last_embedded = None
+        self.embeddings = []
+        self.missed = 0
+
+    def embedding(self):
+        # Mean of the unit-normalized samples, so every sampled frame weighs the same
+        return normalize(np.mean(normalize(self.embeddings), axis=0))[0]
+
+    def result(self):
+        return {
+            "track_id": self.track_id,
+            "first_frame": self.first_frame,
+            "last_frame": self.last_frame,
+            "start_seconds": self.start_seconds,
+            "end_seconds": self.end_seconds,
+            "facial_area": dict(zip(("x", "y", "w", "h"), (int(value) for value in self.box))),
+            "embeddings": len(self.embeddings),
+        }
+
+# Function to move every track box by the median optical flow of the corner points inside it, returning the tracks that moved
+def propagate(tracks, previous_gray, gray):
+    moved_tracks = []
+    for track in tracks:
+        x, y, w, h = track.box.astype(int)
+        x, y = max(x, 0), max(y, 0)
+        region = previous_gray[y:y + h, x:x + w]
+        points = cv2.goodFeaturesToTrack(region, maxCorners=30, qualityLevel=0.01, minDistance=3) if region.size else None
+        if points is None or len(points) < 3:
+            continue
+
+        points = (points + np.float32([x, y])).astype(np.float32)
+        moved, status, _ = cv2.calcOpticalFlowPyrLK(previous_gray, gray, points, None, winSize=(15, 15), maxLevel=2)
+        tracked = status.ravel() == 1
+        if np.count_nonzero(tracked) >= 3:
+            track.box[:2] += np.median((moved - points)[tracked].reshape(-1, 2), axis=0)
+            moved_tracks.append(track)
+    return moved_tracks
+
+def identify_video(source, searcher, k=1, detect_every=10, embeddings_per_track=3, embed_gap=5, max_missed=2,
+                   iou_threshold=0.3, min_confidence=0.5, detector_backend="retinaface", model_name="ArcFace", fps=None):
+    """
+    Identifies the people in a video by tracking faces and matching one aggregated embedding per track.
+
+    Args:
+        source (Union[str, Path, int]): Video file, camera index, stream URL or folder of frame images.
+        searcher (Union[Gallery, CentroidIndex, QuantizedGallery]): Anything with a `search_batch(queries, k)` method.
+        k (int): Number of matches per track. Defaults to 1.
+        detect_every (int): Run the face detector on every Nth frame (and on scene cuts). Defaults to 10.
+        embeddings_per_track (int): Maximum number of crops embedded for one track. Defaults to 3.
+        embed_gap (int): Minimum number of frames between two embedded crops of one track. Defaults to 5.
+        max_missed (int): Detection passes a track may go unmatched before it is closed. Defaults to 2.
+        iou_threshold (float): Minimum IoU for a detection to continue a track. Defaults to 0.3.
+        min_confidence (float): Detections below this confidence are ignored. Defaults to 0.5.
+        detector_backend (str): DeepFace detector backend. Defaults to "retinaface".
+        model_name (str): DeepFace recognition model. Defaults to "ArcFace".
+        fps (Optional[float]): Frame rate used for timestamps. Defaults to the rate reported by the video.
+
+    Yields:
+        dict: One entry per closed track with `track_id`, `first_frame`, `last_frame`, `start_seconds`,
+              `end_seconds`, its last `facial_area`, the number of `embeddings` averaged and up to k `matches`.
+              Tracks that never got an embedding are not reported.
+
+    Description:
+    - The detector only runs on every `detect_every`th frame and on frames that differ sharply from the
+      previous one. In between, track boxes are moved by sparse Lucas-Kanade optical flow.
+    - A scene cut closes every open track, so faces in the new shot always start new tracks.
+    - Detections are associated with tracks by IoU. Unmatched detections start new tracks.
+    - Each track embeds at most `embeddings_per_track` aligned crops, batched across tracks, so embedding
+      cost grows with the number of distinct faces rather than the number of frames.
+    - When a track closes, its normalized mean embedding is matched against the gallery. Tracks closing
+      on the same frame are searched as one batch.
+
+    Example:
+        >>> for track in identify_video("testing/lobby.mp4", load_gallery(), detect_every=15):
+        ...     print(track["start_seconds"], track["matches"][0]["label"])
+    """
+    tracks = []
+    next_track_id = 0
+    previous_gray = previous_small = None
+
+    def close(closed):
+        closed = [track for track in closed if track.embeddings]
+        if not closed:
+            return []
+        matches = searcher.search_batch(np.stack([track.embedding() for track in closed]), k=k)
+        return [{**track.result(), "matches": track_matches} for track, track_matches in zip(closed, matches)]
+
+    for frame_number, seconds, frame in iter_frames(source, fps):
+        with instrumentation.span("video_track"):
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            small = cv2.resize(gray, (64, 36), interpolation=cv2.INTER_AREA)
+            scene_cut = is_scene_cut(previous_small, small)
+            keyframe = frame_number % detect_every == 0 or scene_cut
+            if previous_gray is not None and tracks and not keyframe:
+                for track in propagate(tracks, previous_gray, gray):
+                    track.last_frame, track.end_seconds = frame_number, seconds
+            previous_gray, previous_small = gray, small
+
+        if not keyframe:
+            continue
+
+        instrumentation.count("keyframes")
+        if scene_cut:
+            # Tracks end at a shot change, so no track mixes the faces of two shots
+            yield from close(tracks)
+            tracks = []
+
+        faces = [
+            face for face in detect_faces(frame, detector_backend=detector_backend, enforce_detection=False, cache=False)
+            if face["confidence"] and face["confidence"] >= min_confidence
+        ]
+        boxes = [[face["facial_area"][key] for key in ("x", "y", "w", "h")] for face in faces]
+
+        # Continue the tracks that overlap a detection, and start a new track for every other detection
+        assigned = {}
+        for track_number, face_number in match_boxes([track.box for track in tracks], boxes, iou_threshold):
+            track = tracks[track_number]
+            track.box = np.asarray(boxes[face_number], dtype=np.float32)
+            track.last_frame, track.end_seconds, track.missed = frame_number, seconds, 0
+            assigned[track_number] = face_number
+
+        for face_number in sorted(set(range(len(boxes))) - set(assigned.values())):
+            tracks.append(Track(next_track_id, boxes[face_number], frame_number, seconds))
+            assigned[len(tracks) - 1] = face_number
+            next_track_id += 1
+            instrumentation.count("tracks")
+
+        # Embed the crops of the tracks that still need samples, in one batch
+        pending = [
+            (tracks[track_number], faces[face_number]["face"])
+            for track_number, face_number in assigned.items()
+            if len(tracks[track_number].embeddings) < embeddings_per_track
+            and (tracks[track_number].last_embedded is None or frame_number - tracks[track_number].last_embedded >= embed_gap)
+        ]
+        if pending:
+            for (track, _), embedding in zip(pending, embed_faces([crop for _, crop in pending], model_name=model_name)):
+                track.embeddings.append(embedding)
+                track.last_embedded = frame_number
+
+        # Close tracks that went unmatched for too many detection passes
+        for track_number, track in enumerate(tracks):
+            if track_number not in assigned:
+                track.missed += 1
+        closed = [track for track in tracks if track.missed > max_missed]
+        tracks = [track for track in tracks if track.missed <= max_missed]
+        yield from close(closed)
+
+    yield from close(tracks)
+
+if __name__ == "__main__":
+    # Example usage: Identify everyone in a clip against the enrolled gallery
+    from embedding_store import load_gallery
+
+    gallery = load_gallery("database/metadata.json", "database/store")
+    for track in identify_video("testing/query_video.mp4", gallery, k=1, detect_every=10):
+        match = track["matches"][0]
+        print(f"Track {track['track_id']} ({track['start_seconds']:.1f}s - {track['end_seconds']:.1f}s): {match['label']} with distance {match['distance']:.3f}")
+
+    if instrumentation.enabled():
+        print(instrumentation.export_prometheus())
@@ -1,10 +1,16 @@
 from . import get_images
 from . import heic2png
+from . import scanner
+import numpy as np
 from pathlib import Path
-from typing import List, Union
+from typing import Iterator, List, Optional, Tuple, Union
 from itertools import combinations
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
 
-def get_image_files(path: Union[str, Path]) -> List[Path]:
+def get_image_files(path: Union[str, Path], keep_original: bool = True) -> List[Path]:
     """
     Retrieves and converts image files from the given directory or single file path.
 
@@ -12,6 +18,8 @@ def get_image_files(path: Union[str, Path]) -> List[Path]:
         path (Union[str, Path]): The path to a directory or a file. This can be either a string 
                                  or a Path object. The path may contain image files of various formats, 
                                  including HEIC.
+        keep_original (bool): If False, each HEIC file is deleted after its PNG is written.
+                              Defaults to True. Use `iter_image_files` to avoid the PNG round-trip entirely.
 
     Returns:
         List[Path]: A list of Path objects representing image files. HEIC files are converted to PNG format
@@ -28,6 +36,8 @@ def get_image_files(path: Union[str, Path]) -> List[Path]:
     Description:
     - This function retrieves all image files from the provided path (which can be a directory or a single file).
     - If any HEIC images are found, they are converted to PNG using the `heic2png` module and added to the list of compatible images.
+    - A HEIC file whose PNG is already at least as new is not converted again, and each PNG is listed once,
+      so originals kept by earlier runs do not produce duplicates.
     - If `keep_original=False`, the original HEIC file is deleted after conversion.
     - Other image files (JPEG, PNG, etc.) are added directly to the list without modification.
     - The function returns a list of all compatible image files, ensuring that HEIC images are converted to PNG.
@@ -37,11 +47,80 @@ def get_image_files(path: Union[str, Path]) -> List[Path]:
     
     for image in images:
         if heic2png.is_heic(image):
-            compatible_images.append(heic2png.heic2png(file_path=image, keep_original=False))
+            png_path = Path(image).with_suffix(".png")
+            if png_path.exists() and png_path.stat().st_mtime >= Path(image).stat().st_mtime:
+                if not keep_original:
+                    Path(image).unlink()
+                compatible_images.append(png_path)
+            else:
+                compatible_images.append(heic2png.heic2png(file_path=image, keep_original=keep_original))
         else:
             compatible_images.append(image)
     
-    return compatible_images
+    return list(dict.fromkeys(compatible_images))
+
+def _read_heic_bgr(file_path: Path) -> Optional[np.ndarray]:
+    image = heic2png.read_heic(file_path)
+    return None if image is None else np.ascontiguousarray(image[:, :, ::-1])
+
+def iter_image_files(path: Union[str, Path], workers: Optional[int] = None) -> Iterator[Tuple[Path, Union[Path, np.ndarray]]]:
+    """
+    Streams images from the given directory or single file path, decoding HEIC files in parallel in memory.
+
+    Args:
+        path (Union[str, Path]): The path to a directory or a file. This can be either a string or a Path object.
+        workers (Optional[int]): Number of HEIC decoding processes. Defaults to `os.cpu_count()`.
+
+    Yields:
+        Tuple[Path, Union[Path, np.ndarray]]: The source file and the image to hand to DeepFace. Non-HEIC images
+                                              are yielded as their Path. HEIC images are yielded as a decoded
+                                              uint8 array in BGR channel order, which is what DeepFace expects
+                                              from in-memory images.
+
+    Example:
+        >>> for source, image in iter_image_files("path_to_directory"):
+        ...     results = get_vector(image)
+
+    Description:
+    - Files are yielded as soon as they are discovered, without materializing the full directory listing first.
+    - HEIC files are decoded by `heic2png.read_heic` in a process pool that is only started once the first
+      HEIC file is found. At most `workers * 4` decodes are in flight at once.
+    - Nothing is written to disk and the original HEIC files are kept.
+    - Decoded HEIC images may be yielded after non-HEIC files discovered later. HEIC files that fail to decode are skipped.
+    """
+    workers = workers or os.cpu_count()
+    executor = None
+    pending = deque()
+
+    def ready(block: bool):
+        while pending and (block or pending[0][1].done()):
+            source, future = pending.popleft()
+            image = future.result()
+            if image is not None:
+                yield source, image
+
+    try:
+        for image in get_images.iter_images(path):
+            if heic2png.is_heic(image):
+                if executor is None:
+                    # Spawn rather than fork: callers usually have TensorFlow loaded, which is not fork-safe
+                    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+                pending.append((image, executor.submit(_read_heic_bgr, image)))
+                if len(pending) >= workers * 4:
+                    source, future = pending.popleft()
+                    decoded = future.result()
+                    if decoded is not None:
+                        yield source, decoded
+            else:
+                yield image, image
+
+            yield from ready(block=False)
+
+        yield from ready(block=True)
+
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
 
 def pairwise_comparison(images, callback):
     output = []
@@ -1,6 +1,12 @@
+import os
 import mimetypes
+import instrumentation
 from pathlib import Path
-from typing import List, Union
+from typing import Iterator, List, Union
+
+# Extension lookup table built once from the MIME database, so classifying a file is a single set lookup
+mimetypes.init()
+IMAGE_EXTENSIONS = frozenset(ext for ext, mimetype in mimetypes.types_map.items() if mimetype.split('/')[0] == "image")
 
 def is_image(path) -> bool:
     """
@@ -20,27 +26,43 @@ def is_image(path) -> bool:
         >>> is_image(Path("example_document.pdf"))
         False
 
-    This function checks the MIME type of the file based on its extension and determines whether
-    it belongs to the "image" category (e.g., "image/jpeg", "image/png", etc.).
+    This function looks the file extension up in `IMAGE_EXTENSIONS`, the extensions whose MIME type
+    belongs to the "image" category (e.g., "image/jpeg", "image/png", etc.).
     
-    If the path is provided as a Path object, it is converted to a string before checking the MIME type.
-    If an exception occurs (e.g., invalid path or MIME type issue), the function catches the exception and returns False.
+    If an exception occurs (e.g., invalid path), the function catches the exception and returns False.
     """
     try:
-        if isinstance(path, Path):
-            path = str(path)
-        
-        mimetype = mimetypes.guess_type(path)[0]
-        
-        if mimetype is not None:
-            return mimetypes.guess_type(path)[0].split('/')[0] == "image"
-        else:
-            return False
+        return os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS
 
     except Exception as e:
         print(f"Error: {str(e)}")
         return False
 
+def scan_tree(path: Union[str, Path]) -> Iterator[os.DirEntry]:
+    """
+    Recursively yields a `os.DirEntry` for every file under a directory.
+
+    Args:
+        path (Union[str, Path]): The directory to walk.
+
+    Yields:
+        os.DirEntry: Each regular file found. Symlinked directories are not followed.
+
+    This walks the tree with `os.scandir`, which returns file types with the directory listing and
+    avoids the extra per-file `stat` calls of `Path.rglob`. Unreadable directories are skipped.
+    """
+    directories = [path]
+    while directories:
+        try:
+            with os.scandir(directories.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                    elif entry.is_file():
+                        yield entry
+        except OSError as e:
+            print(f"Error: {str(e)}")
+
 def get_images(path: Union[str, Path]) -> List[Path]:
     """
     Retrieves all image files from a given directory or a single image file.
@@ -68,17 +90,35 @@ def get_images(path: Union[str, Path]) -> List[Path]:
     it recursively searches for all image files within the directory and its subdirectories.
     If the provided path is a single file, it checks if the file is an image and, if so, adds it to the result list.
     """
+    with instrumentation.span("discovery"):
+        images = list(iter_images(path))
+    instrumentation.count("images_discovered", len(images))
+    return images
+
+def iter_images(path: Union[str, Path]) -> Iterator[Path]:
+    """
+    Lazily yields image files from a given directory or a single image file as they are discovered.
+
+    Args:
+        path (Union[str, Path]): The path to a directory or a file. Can be provided as a string or a Path object.
+
+    Yields:
+        Path: Each image file found. Directories are searched recursively.
+
+    Example:
+        >>> next(iter_images("path_to_directory"))
+        PosixPath('path_to_directory/image1.jpg')
+
+    Unlike `get_images`, nothing is materialized up front, so callers can start processing the first
+    image while the rest of the tree is still being walked.
+    """
     if isinstance(path, str):
         path = Path(path)
     
-    images = []
-    
     if path.is_dir():
-        images.extend(filter(lambda file_path: is_image(file_path), path.rglob("*")))
+        yield from (Path(entry.path) for entry in scan_tree(path) if is_image(entry.name))
     elif path.is_file():
         if is_image(path):
-            images.append(path)
+            yield path
     else:
         print("No images found")
-    
-    return images
\ No newline at end of file
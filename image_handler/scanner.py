@@ -0,0 +1,147 @@
+import io
+import os
+import hashlib
+import numpy as np
+import instrumentation
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Union
+from .get_images import is_image, scan_tree
+
+@instrumentation.timed("hash")
+def sha256_hash(file: Union[str, Path], chunk_size: int = 1 << 20) -> str:
+    """
+    Calculates the sha256 hash of a file's bytes.
+
+    Args:
+        file (Union[str, Path]): The file to hash.
+        chunk_size (int): Number of bytes read at a time. Defaults to 1 MiB.
+
+    Returns:
+        str: The hex digest.
+    """
+    sha256 = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+class Manifest:
+    """
+    Persisted record of (path, size, mtime_ns, sha256) for every scanned image.
+
+    A file is only re-hashed when its size or modification time differs from the recorded one, so
+    rescanning an unchanged tree costs one `stat` per file and no reads.
+
+    Example:
+        >>> manifest = Manifest("database/manifest.npz")
+        >>> manifest.hash(Path("database/images/Hunter Boon/4.png"))
+        '9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08'
+        >>> manifest.save()
+    """
+
+    def __init__(self, manifest_path: Optional[Union[str, Path]] = None):
+        self.manifest_path = Path(manifest_path) if manifest_path is not None else None
+        self.entries: Dict[str, tuple] = {}
+
+        if self.manifest_path is not None and self.manifest_path.exists():
+            with np.load(self.manifest_path) as data:
+                self.entries = {
+                    path: (int(size), int(mtime_ns), sha256)
+                    for path, size, mtime_ns, sha256 in zip(data["path"], data["size"], data["mtime_ns"], data["sha256"])
+                }
+
+    def is_current(self, path: str, stat: os.stat_result) -> bool:
+        entry = self.entries.get(path)
+        return entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns
+
+    def hash(self, path: Union[str, Path], stat: Optional[os.stat_result] = None) -> str:
+        """
+        Returns the sha256 of a file, re-hashing it only if its size or mtime changed.
+        """
+        path = str(path)
+        stat = stat or os.stat(path)
+        if not self.is_current(path, stat):
+            self.entries[path] = (stat.st_size, stat.st_mtime_ns, sha256_hash(path))
+        return self.entries[path][2]
+
+    def save(self) -> None:
+        if self.manifest_path is None:
+            return
+
+        paths = list(self.entries)
+        buffer = io.BytesIO()
+        np.savez(
+            buffer,
+            path=np.array(paths, dtype=str),
+            size=np.array([self.entries[path][0] for path in paths], dtype=np.int64),
+            mtime_ns=np.array([self.entries[path][1] for path in paths], dtype=np.int64),
+            sha256=np.array([self.entries[path][2] for path in paths], dtype=str),
+        )
+        tmp_path = self.manifest_path.with_name(self.manifest_path.name + ".tmp")
+        tmp_path.write_bytes(buffer.getvalue())
+        os.replace(tmp_path, self.manifest_path)
+
+@instrumentation.timed("scan")
+def scan(path: Union[str, Path], manifest_path: Union[str, Path], workers: Optional[int] = None) -> dict:
+    """
+    Scans a directory for images and reports what changed since the previous scan.
+
+    Args:
+        path (Union[str, Path]): The directory to scan.
+        manifest_path (Union[str, Path]): Where the manifest of the previous scan is kept. It is updated in place.
+        workers (Optional[int]): Number of threads hashing changed files. Defaults to `os.cpu_count()`.
+
+    Returns:
+        dict: `added`, `modified`, `deleted` and `unchanged` lists of Paths, plus `hashes` mapping every
+              present image path (as a string) to its sha256.
+
+    Example:
+        >>> changes = scan("database/images", "database/manifest.npz")
+        >>> changes["added"]
+        [PosixPath('database/images/Hunter Boon/5.png')]
+
+    Description:
+    - The tree is walked with `os.scandir` and images are recognized with the extension lookup table.
+    - Files whose size and mtime match the manifest are reported as unchanged without being read.
+    - Other files are hashed in a thread pool. A file whose bytes are unchanged despite a new mtime
+      counts as unchanged.
+    - Files in the manifest that are no longer on disk are reported as deleted and dropped from it.
+    """
+    manifest = Manifest(manifest_path)
+    previous = dict(manifest.entries)
+    changes = {"added": [], "modified": [], "deleted": [], "unchanged": []}
+
+    seen, to_hash = set(), []
+    for entry in scan_tree(path):
+        if not is_image(entry.name):
+            continue
+        seen.add(entry.path)
+        stat = entry.stat()
+        if manifest.is_current(entry.path, stat):
+            changes["unchanged"].append(Path(entry.path))
+        else:
+            to_hash.append((entry.path, stat))
+
+    # hashlib releases the GIL on large buffers, so threads hash files in parallel
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        hashes = executor.map(lambda item: sha256_hash(item[0]), to_hash)
+        for (file_path, stat), file_hash in zip(to_hash, hashes):
+            manifest.entries[file_path] = (stat.st_size, stat.st_mtime_ns, file_hash)
+            if file_path not in previous:
+                changes["added"].append(Path(file_path))
+            elif previous[file_path][2] != file_hash:
+                changes["modified"].append(Path(file_path))
+            else:
+                changes["unchanged"].append(Path(file_path))
+
+    for file_path in previous.keys() - seen:
+        del manifest.entries[file_path]
+        changes["deleted"].append(Path(file_path))
+
+    manifest.save()
+    for change in ("added", "modified", "deleted", "unchanged"):
+        instrumentation.count("images_scanned", len(changes[change]), change=change)
+    changes["hashes"] = {file_path: entry[2] for file_path, entry in manifest.entries.items()}
+
+    return changes
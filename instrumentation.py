@@ -0,0 +1,186 @@
+"""
+Lightweight span timers and counters for the enrollment and identification pipeline.
+
+Instrumentation is disabled by default and every call then returns immediately, so the helpers can stay
+in hot paths. Enable it with `enable()` or by setting FACE_METRICS=1, then export the collected
+per-stage latency histograms and counters with `export_json()` or `export_prometheus()`.
+
+Example:
+    >>> import instrumentation
+    >>> instrumentation.enable(profile_path="enroll.prof")
+    >>> store_metadata_and_embeddings(images, "database/metadata.json", "database/embeddings")
+    >>> instrumentation.write("metrics.json")
+    >>> instrumentation.dump_profile()
+"""
+
+import os
+import json
+import time
+import bisect
+import cProfile
+import threading
+from contextlib import nullcontext
+from functools import wraps
+from pathlib import Path
+from typing import Optional, Union
+
+# Latency histogram bucket upper bounds in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_enabled = os.environ.get("FACE_METRICS") == "1"
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+_profiler = None
+_profile_path = None
+
+def enabled() -> bool:
+    return _enabled
+
+def enable(profile_path: Optional[Union[str, Path]] = None) -> None:
+    """
+    Starts collecting metrics, and a cProfile of this process if `profile_path` is given.
+    """
+    global _enabled, _profiler, _profile_path
+    _enabled = True
+    if profile_path is not None:
+        _profile_path = Path(profile_path)
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+
+def disable() -> None:
+    global _enabled
+    _enabled = False
+    if _profiler is not None:
+        _profiler.disable()
+
+def reset() -> None:
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+def dump_profile() -> Optional[Path]:
+    """
+    Writes the cProfile collected since `enable(profile_path=...)`, readable with `pstats` or snakeviz.
+    """
+    if _profiler is None:
+        return None
+    _profiler.disable()
+    _profiler.dump_stats(_profile_path)
+    return _profile_path
+
+def observe(stage: str, seconds: float) -> None:
+    if not _enabled:
+        return
+    with _lock:
+        histogram = _histograms.get(stage)
+        if histogram is None:
+            histogram = _histograms[stage] = {"buckets": [0] * (len(BUCKETS) + 1), "count": 0, "sum": 0.0}
+        histogram["buckets"][bisect.bisect_left(BUCKETS, seconds)] += 1
+        histogram["count"] += 1
+        histogram["sum"] += seconds
+
+def count(name: str, value: int = 1, **labels) -> None:
+    """
+    Adds `value` to a counter, e.g. `count("failures", stage="heic_decode", error="ValueError")`.
+    """
+    if not _enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+class _Span:
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        observe(self.stage, time.perf_counter() - self.start)
+        if exc_type is not None:
+            count("failures", stage=self.stage, error=exc_type.__name__)
+        return False
+
+_noop = nullcontext()
+
+def span(stage: str):
+    """
+    Context manager timing a block into the latency histogram of `stage`. Exceptions raised inside the
+    block are counted as failures of the stage.
+    """
+    return _Span(stage) if _enabled else _noop
+
+def timed(stage: str):
+    """
+    Decorator timing every call of a function into the latency histogram of `stage`.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with _Span(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def export_json() -> dict:
+    with _lock:
+        return {
+            "stages": {
+                stage: {
+                    "count": histogram["count"],
+                    "sum_seconds": histogram["sum"],
+                    "mean_ms": histogram["sum"] * 1000 / histogram["count"],
+                    "buckets": {str(bound): count for bound, count in zip(BUCKETS + ("+Inf",), histogram["buckets"])},
+                }
+                for stage, histogram in _histograms.items()
+            },
+            "counters": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in _counters.items()
+            ],
+        }
+
+# Function to escape a label value for the Prometheus text format: backslash, double quote and newline
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def export_prometheus(prefix: str = "face") -> str:
+    """
+    Renders the metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    with _lock:
+        if _histograms:
+            lines += [f"# TYPE {prefix}_stage_seconds histogram"]
+        for stage, histogram in _histograms.items():
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS + ("+Inf",), histogram["buckets"]):
+                cumulative += bucket
+                lines.append(f'{prefix}_stage_seconds_bucket{{stage="{_escape_label(stage)}",le="{bound}"}} {cumulative}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{_escape_label(stage)}"}} {histogram["sum"]}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{_escape_label(stage)}"}} {histogram["count"]}')
+
+        for name in sorted({name for name, _ in _counters}):
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            for (counter_name, labels), value in _counters.items():
+                if counter_name == name:
+                    rendered = ",".join(f'{key}="{_escape_label(value_)}"' for key, value_ in labels)
+                    lines.append(f"{prefix}_{name}_total{{{rendered}}} {value}" if rendered else f"{prefix}_{name}_total {value}")
+    return "\n".join(lines) + "\n"
+
+def write(path: Union[str, Path]) -> None:
+    """
+    Writes the metrics to `path`, as Prometheus text if it ends in .prom and as JSON otherwise.
+    """
+    path = Path(path)
+    if path.suffix == ".prom":
+        path.write_text(export_prometheus())
+    else:
+        path.write_text(json.dumps(export_json(), indent=4))
@@ -0,0 +1,320 @@
+import numpy as np
+import instrumentation
+from deepface.modules.verification import find_threshold
+from gallery import normalize
+from image_handler import get_image_files
+from pathlib import Path
+from represent_faces import get_vector
+from typing import List, Optional, Union
+
+UNKNOWN = "unknown"
+
+class Thresholds:
+    """
+    Calibrated acceptance thresholds on cosine distance for one recognition model.
+
+    `threshold` is the model-wide threshold. `person_thresholds` holds a threshold for each enrolled
+    label, which is never looser than the model-wide one. Labels without their own threshold (e.g.
+    people enrolled after calibration) use the model-wide threshold.
+
+    Example:
+        >>> thresholds = calibrate(load_gallery(), model_name="ArcFace", target_far=1e-3)
+        >>> thresholds.save("database/thresholds.npz")
+        >>> thresholds.threshold_for("Hunter Boon")
+        0.512
+    """
+
+    def __init__(self, model_name, threshold, labels=(), person_thresholds=(), target_far=None, frr=None):
+        self.model_name = model_name
+        self.threshold = float(threshold)
+        self.person_thresholds = {str(label): float(value) for label, value in zip(labels, person_thresholds)}
+        self.target_far = target_far
+        self.frr = frr
+
+    def threshold_for(self, label) -> float:
+        return self.person_thresholds.get(str(label), self.threshold)
+
+    def save(self, path: Union[str, Path]) -> None:
+        with open(path, "wb") as file:
+            np.savez(
+                file,
+                model_name=self.model_name,
+                threshold=self.threshold,
+                labels=np.array(list(self.person_thresholds), dtype=str),
+                person_thresholds=np.array(list(self.person_thresholds.values()), dtype=np.float64),
+                target_far=np.nan if self.target_far is None else self.target_far,
+                frr=np.nan if self.frr is None else self.frr,
+            )
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "Thresholds":
+        with np.load(path) as data:
+            optional = {key: None if np.isnan(data[key]) else float(data[key]) for key in ("target_far", "frr")}
+            return cls(str(data["model_name"]), float(data["threshold"]), list(data["labels"]), data["person_thresholds"], **optional)
+
+# Function to sample up to `per_label` rows of each label, returning the rows grouped by label, each group's start, the labels and each row's label code
+def grouped_sample(labels, per_label, seed=0):
+    rng = np.random.default_rng(seed)
+    names, codes = np.unique(np.asarray(labels, dtype=str), return_inverse=True)
+    order = np.lexsort((rng.random(len(codes)), codes))
+    starts = np.flatnonzero(np.r_[True, codes[order][1:] != codes[order][:-1]])
+    rank = np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+    order = order[rank < per_label]
+    starts = np.flatnonzero(np.r_[True, codes[order][1:] != codes[order][:-1]])
+    return order, starts, names, codes
+
+def calibrate(gallery, model_name="ArcFace", target_far=1e-3, centroid_index=None, per_person=32, probes=4096,
+              block_size=4096, seed=0) -> Thresholds:
+    """
+    Calibrates model-wide and per-person thresholds from the gallery's genuine and impostor distances.
+
+    Args:
+        gallery (Gallery): Enrolled embeddings, e.g. from `embedding_store.load_gallery`.
+        model_name (str): Recognition model the gallery was built with. Defaults to "ArcFace".
+        target_far (float): Accepted fraction of impostor queries (false accept rate). Defaults to 1e-3.
+        centroid_index (Optional[CentroidIndex]): Calibrate for searches against person centroids instead
+                                                  of individual gallery images.
+        per_person (int): Maximum number of images per person used as references. Defaults to 32.
+        probes (int): Number of gallery images used as impostor queries. A `target_far` of 1e-3 needs a few
+                      thousand for a stable threshold. Defaults to 4096.
+        block_size (int): Number of reference rows scored per operation. Defaults to 4096.
+        seed (int): Seed of the sampling. Defaults to 0.
+
+    Returns:
+        Thresholds: The calibrated thresholds.
+
+    Description:
+    - Impostor distances: each probe image is scored against every other person, keeping the distance to
+      that person's closest reference (image or centroid), which is what a search returns for a stranger.
+    - The model-wide threshold is the `target_far` quantile of each probe's closest other person, i.e. of
+      the best match a stranger gets from the whole gallery, so about `target_far` of strangers are accepted.
+    - A person's threshold is the `target_far` quantile of the probes' distances to that person alone,
+      capped at the model-wide threshold, so people with look-alikes get a stricter threshold.
+    - Genuine distances: each sampled image is scored against the person's other sampled images (or
+      against their centroid without that image). The fraction above the model-wide threshold is the `frr`.
+    - Galleries with fewer than two people fall back to DeepFace's default threshold for the model.
+    """
+    rng = np.random.default_rng(seed)
+    sample_rows, sample_starts, names, codes = grouped_sample(gallery.labels, per_person, seed)
+    if len(names) < 2:
+        return Thresholds(model_name, find_threshold(model_name, "cosine"))
+
+    probe_rows = rng.choice(len(codes), size=min(probes, len(codes)), replace=False)
+    probe_vectors, probe_codes = normalize(gallery.embeddings[probe_rows]), codes[probe_rows]
+
+    if centroid_index is None:
+        references, rows, starts = gallery.embeddings, sample_rows, sample_starts
+    else:
+        # One reference per person: their centroid, in the same label order as `names`
+        references = np.zeros((len(names), gallery.embeddings.shape[1]), dtype=np.float32)
+        known = np.array([label in centroid_index.rows for label in names])
+        references[known] = centroid_index.centroids[[centroid_index.rows[label] for label in names[known]]]
+        rows, starts = np.arange(len(names)), np.arange(len(names))
+    sizes = np.diff(np.r_[starts, len(rows)])
+
+    nearest = np.full(len(probe_rows), np.inf, dtype=np.float32)
+    person_thresholds = np.empty(len(names), dtype=np.float64)
+    genuine = []
+
+    first = 0
+    while first < len(names):
+        # Blocks hold whole people so each person's closest reference can be reduced within the block
+        last = first + max(1, int(np.searchsorted(np.cumsum(sizes[first:]), block_size, side="right")))
+        block_vectors = normalize(references[rows[starts[first]:starts[last] if last < len(names) else len(rows)]])
+
+        closest = np.minimum.reduceat(1 - block_vectors @ probe_vectors.T, starts[first:last] - starts[first], axis=0)
+        closest[np.arange(first, last)[:, None] == probe_codes[None, :]] = np.inf
+
+        ordered = np.sort(closest, axis=1)
+        valid = np.isfinite(ordered).sum(axis=1)
+        person_thresholds[first:last] = ordered[np.arange(last - first), np.floor(target_far * valid).astype(int)]
+
+        nearest = np.minimum(nearest, closest.min(axis=0))
+
+        if centroid_index is None:
+            # Genuine: each image against the closest other image of the same person in the block
+            people = np.repeat(np.arange(first, last), sizes[first:last])
+            similarities = block_vectors @ block_vectors.T
+            similarities[(people[:, None] != people[None, :]) | np.eye(len(people), dtype=bool)] = -np.inf
+            genuine.append(1 - similarities.max(axis=1)[sizes[first:last].repeat(sizes[first:last]) > 1])
+        first = last
+
+    threshold = float(np.quantile(nearest[np.isfinite(nearest)], target_far))
+
+    if centroid_index is None:
+        genuine = np.concatenate(genuine)
+    else:
+        # Genuine: each sampled image against its person's centroid without that image
+        vectors = normalize(gallery.embeddings[sample_rows])
+        label_rows = np.array([centroid_index.rows.get(label, -1) for label in names])[codes[sample_rows]]
+        usable = (label_rows >= 0) & (centroid_index.counts[np.maximum(label_rows, 0)] >= 2)
+        genuine = 1 - np.einsum("ij,ij->i", vectors[usable], normalize(centroid_index.sums[label_rows[usable]] - vectors[usable]))
+
+    return Thresholds(
+        model_name,
+        threshold,
+        names,
+        np.minimum(person_thresholds, threshold),
+        target_far=target_far,
+        frr=float(np.mean(genuine > threshold)) if len(genuine) else None,
+    )
+
+class OpenSetSearcher:
+    """
+    Wraps any searcher with a `search_batch(queries, k)` method so matches beyond their threshold are unknown.
+
+    A rejected match keeps its distance and image path, but its `label` becomes "unknown" and the
+    rejected label is kept as `candidate`. Every match carries the `threshold` it was held to. Use
+    thresholds calibrated for the same kind of searcher (`calibrate(..., centroid_index=index)` for a
+    `CentroidIndex`).
+
+    Example:
+        >>> searcher = OpenSetSearcher(load_gallery(), Thresholds.load("database/thresholds.npz"))
+        >>> identify_all_faces("testing/query_image.png", searcher, k=1)
+    """
+
+    def __init__(self, searcher, thresholds: Thresholds):
+        self.searcher = searcher
+        self.thresholds = thresholds
+
+    def search_batch(self, queries, k: int = 1) -> List[List[dict]]:
+        results = self.searcher.search_batch(queries, k)
+        for matches in results:
+            for number, match in enumerate(matches):
+                threshold = self.thresholds.threshold_for(match["label"])
+                if match["distance"] > threshold:
+                    match = {**match, "label": UNKNOWN, "candidate": match["label"]}
+                    instrumentation.count("unknown_matches")
+                matches[number] = {**match, "threshold": threshold}
+        return results
+
+    def search(self, query, k: int = 1) -> List[dict]:
+        return self.search_batch(np.atleast_2d(query), k)[0]
+
+# Function to find the root of each node, compressing the paths it walked
+def _find(parent, nodes):
+    roots = parent[nodes]
+    while True:
+        next_roots = parent[roots]
+        if np.array_equal(next_roots, roots):
+            parent[nodes] = roots
+            return roots
+        roots = next_roots
+
+# Function to merge the components joined by each edge, hooking the larger root onto the smaller
+def _union(parent, left, right):
+    while len(left):
+        left_roots, right_roots = _find(parent, left), _find(parent, right)
+        differ = left_roots != right_roots
+        left, right = left[differ], right[differ]
+        np.minimum.at(parent, np.maximum(left_roots[differ], right_roots[differ]), np.minimum(left_roots[differ], right_roots[differ]))
+
+def cluster_embeddings(embeddings, threshold, min_size=2, block_size=4096) -> np.ndarray:
+    """
+    Groups embeddings into the connected components of their threshold graph.
+
+    Two embeddings are linked when their cosine distance is at most `threshold`. Similarities are
+    computed block by block over the upper triangle and each block's edges are merged into a
+    vectorized union-find, so memory stays at `block_size ** 2` similarities however many faces there are.
+
+    Args:
+        embeddings: Array of shape (n, d).
+        threshold (float): Maximum cosine distance of a link, e.g. `Thresholds.threshold`.
+        min_size (int): Components smaller than this get cluster -1. Defaults to 2.
+        block_size (int): Rows per block. Defaults to 4096.
+
+    Returns:
+        np.ndarray: Cluster id of each embedding, numbered from 0 by decreasing cluster size, or -1.
+    """
+    vectors = normalize(embeddings)
+    parent = np.arange(len(vectors))
+
+    with instrumentation.span("cluster"):
+        for start in range(0, len(vectors), block_size):
+            block = vectors[start:start + block_size]
+            for other in range(start, len(vectors), block_size):
+                links = block @ vectors[other:other + block_size].T >= 1 - threshold
+                if other == start:
+                    # Mask the links rather than the similarities: a zeroed similarity would still pass a threshold >= 1
+                    links = np.triu(links, k=1)
+                left, right = np.nonzero(links)
+                _union(parent, left + start, right + other)
+
+    roots = _find(parent, np.arange(len(vectors)))
+    components, inverse, counts = np.unique(roots, return_inverse=True, return_counts=True)
+
+    # Renumber by decreasing size, dropping components below min_size
+    ranking = np.argsort(-counts, kind="stable")
+    cluster_of = np.full(len(components), -1, dtype=np.int64)
+    large = ranking[counts[ranking] >= min_size]
+    cluster_of[large] = np.arange(len(large))
+    return cluster_of[inverse]
+
+def identify_open_set(images, searcher, thresholds: Thresholds, k=1, cluster_threshold: Optional[float] = None,
+                      min_cluster_size=2, detector_backend="retinaface", model_name="ArcFace"):
+    """
+    Identifies every face against the gallery and groups the unknown ones by identity.
+
+    Args:
+        images (Union[str, Path, List[Path]]): A query image, a directory of query images or a list of image files.
+        searcher (Union[Gallery, CentroidIndex, QuantizedGallery]): Anything with a `search_batch(queries, k)` method.
+        thresholds (Thresholds): Thresholds calibrated for `searcher`.
+        k (int): Number of matches per face. Defaults to 1.
+        cluster_threshold (Optional[float]): Linking distance of the clustering. Defaults to `thresholds.threshold`.
+        min_cluster_size (int): Unknown faces in smaller groups get cluster -1. Defaults to 2.
+        detector_backend (str): DeepFace detector backend. Defaults to "retinaface".
+        model_name (str): DeepFace recognition model. Defaults to "ArcFace".
+
+    Returns:
+        List[dict]: Shaped like `identify_faces.identify_all_faces`. Matches beyond their threshold are
+                    "unknown", and each face whose best match is unknown carries a `cluster` id shared by
+                    the other unknown faces of the same person.
+    """
+    if isinstance(images, (str, Path)):
+        images = get_image_files(images)
+
+    results = [get_vector(image, detector_backend=detector_backend, model_name=model_name) for image in images]
+    embeddings = np.array([face["embedding"] for faces in results if not isinstance(faces, str) for face in faces])
+    matches = OpenSetSearcher(searcher, thresholds).search_batch(embeddings, k=k) if len(embeddings) else []
+
+    unknown = np.array([bool(face_matches) and face_matches[0]["label"] == UNKNOWN for face_matches in matches], dtype=bool)
+    clusters = np.full(len(matches), -1, dtype=np.int64)
+    if unknown.any():
+        clusters[unknown] = cluster_embeddings(embeddings[unknown], cluster_threshold or thresholds.threshold, min_cluster_size)
+
+    faces_out = iter(zip(matches, clusters, unknown))
+    output = []
+    for image, faces in zip(images, results):
+        if not isinstance(faces, str):
+            entries = []
+            for face in faces:
+                face_matches, cluster, is_unknown = next(faces_out)
+                entry = {"facial_area": face["facial_area"], "face_confidence": face["face_confidence"], "matches": face_matches}
+                if is_unknown:
+                    entry["cluster"] = int(cluster)
+                entries.append(entry)
+            faces = entries
+        output.append({"image_path": str(image), "faces": faces})
+    return output
+
+if __name__ == "__main__":
+    # Example usage: Calibrate once, then identify a folder of photos and group the strangers in it
+    from embedding_store import load_gallery
+
+    thresholds_file = "database/thresholds.npz"
+    gallery = load_gallery("database/metadata.json", "database/store")
+    if Path(thresholds_file).exists():
+        thresholds = Thresholds.load(thresholds_file)
+    else:
+        thresholds = calibrate(gallery, model_name="ArcFace", target_far=1e-3)
+        thresholds.save(thresholds_file)
+    print(f"Threshold {thresholds.threshold:.3f} at FAR {thresholds.target_far}, FRR {thresholds.frr}")
+
+    for result in identify_open_set("testing/unlabelled", gallery, thresholds):
+        if isinstance(result["faces"], str):
+            print(f"Skipping {result['image_path']}: {result['faces']}")
+            continue
+        for face in result["faces"]:
+            match = face["matches"][0]
+            group = f" (unknown person #{face['cluster']})" if face.get("cluster", -1) >= 0 else ""
+            print(f"{Path(result['image_path']).name}: {match['label']} with distance {match['distance']:.3f}{group}")
@@ -0,0 +1,424 @@
+import time
+import numpy as np
+import instrumentation
+from gallery import normalize, top_k
+from pathlib import Path
+from typing import List, Optional, Union
+
+class Float16Codec:
+    """
+    Stores each unit-normalized embedding as float16: 2 bytes per dimension instead of 4.
+    """
+    kind = "float16"
+    max_training_points = 0
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+
+    @property
+    def code_size(self) -> int:
+        return 2 * self.dim
+
+    def train(self, vectors) -> None:
+        pass
+
+    def encode(self, vectors) -> np.ndarray:
+        return normalize(vectors).astype(np.float16)
+
+    def similarities(self, queries, codes) -> np.ndarray:
+        return queries @ codes.astype(np.float32).T
+
+    def state(self) -> dict:
+        return {}
+
+    @classmethod
+    def from_state(cls, dim, state) -> "Float16Codec":
+        return cls(dim)
+
+class Int8Codec:
+    """
+    Symmetric int8 quantization with one float32 scale per vector: d + 4 bytes per embedding.
+
+    Each normalized embedding is divided by max(|x|) / 127 and rounded, so its largest component maps to
+    ±127. Codes are a structured array with a `scale` and an int8 `values` field; the cosine similarity to
+    a query is `scale * (values @ query)`.
+    """
+    kind = "int8"
+    max_training_points = 0
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+        self.dtype = np.dtype([("scale", np.float32), ("values", np.int8, (dim,))])
+
+    @property
+    def code_size(self) -> int:
+        return self.dtype.itemsize
+
+    def train(self, vectors) -> None:
+        pass
+
+    def encode(self, vectors) -> np.ndarray:
+        vectors = normalize(vectors)
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1
+
+        codes = np.empty(len(vectors), dtype=self.dtype)
+        codes["scale"] = scales
+        codes["values"] = np.rint(vectors / scales[:, None])
+        return codes
+
+    def similarities(self, queries, codes) -> np.ndarray:
+        return (queries @ codes["values"].astype(np.float32).T) * codes["scale"]
+
+    def state(self) -> dict:
+        return {}
+
+    @classmethod
+    def from_state(cls, dim, state) -> "Int8Codec":
+        return cls(dim)
+
+# Function to run Lloyd's k-means, assigning in chunks to bound memory
+def kmeans(vectors, clusters, iterations=20, seed=0, chunk_size=65536):
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=clusters, replace=len(vectors) < clusters)].copy()
+
+    for _ in range(iterations):
+        assignments = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), chunk_size):
+            chunk = vectors[start:start + chunk_size]
+            assignments[start:start + chunk_size] = ((centroids ** 2).sum(axis=1) - 2 * chunk @ centroids.T).argmin(axis=1)
+
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        counts = np.bincount(assignments, minlength=clusters)
+
+        # Re-seed empty clusters with random vectors so every code stays in use
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        centroids[empty] = vectors[rng.choice(len(vectors), size=int(empty.sum()))]
+
+    return centroids
+
+class PQCodec:
+    """
+    Product quantization with asymmetric distance computation (ADC).
+
+    The embedding is split into `m` sub-vectors of `dim / m` dimensions and each sub-vector is replaced
+    by the id of its nearest of 256 k-means centroids, so an embedding costs `m` bytes (64 bytes for
+    m=64 instead of 2048). A query is not quantized: per query, a table of the inner products between
+    each of its sub-vectors and every centroid of that sub-space is built once, and the similarity to
+    a code is the sum of `m` table lookups.
+
+    Example:
+        >>> codec = PQCodec(dim=512, m=64)
+        >>> codec.train(embeddings)
+        >>> codes = codec.encode(embeddings)
+    """
+    kind = "pq"
+
+    def __init__(self, dim: int = 512, m: int = 64, max_training_points: int = 65536):
+        if dim % m:
+            raise ValueError(f"dim {dim} must be divisible by the number of sub-quantizers {m}")
+        self.dim = dim
+        self.m = m
+        self.max_training_points = max_training_points
+        self.codebooks = None
+
+    @property
+    def code_size(self) -> int:
+        return self.m
+
+    def train(self, vectors) -> None:
+        """
+        Fits the 256 centroids of each sub-space on at most `max_training_points` sampled embeddings.
+        """
+        rng = np.random.default_rng(0)
+        sample = normalize(vectors[np.sort(rng.choice(len(vectors), size=min(len(vectors), self.max_training_points), replace=False))])
+        sub_vectors = sample.reshape(len(sample), self.m, self.dim // self.m)
+        self.codebooks = np.stack([kmeans(sub_vectors[:, part], 256, seed=part) for part in range(self.m)])
+
+    def encode(self, vectors) -> np.ndarray:
+        if self.codebooks is None:
+            raise ValueError("PQCodec must be trained before vectors are encoded")
+
+        sub_vectors = normalize(vectors).reshape(-1, self.m, self.dim // self.m)
+        codes = np.empty((len(sub_vectors), self.m), dtype=np.uint8)
+        for part, codebook in enumerate(self.codebooks):
+            codes[:, part] = ((codebook ** 2).sum(axis=1) - 2 * sub_vectors[:, part] @ codebook.T).argmin(axis=1)
+        return codes
+
+    def tables(self, queries) -> np.ndarray:
+        """
+        Inner products of each query sub-vector with every centroid, of shape (n, m, 256).
+        """
+        return np.einsum("nmd,mcd->nmc", queries.reshape(len(queries), self.m, self.dim // self.m), self.codebooks)
+
+    def similarities(self, queries, codes) -> np.ndarray:
+        tables = self.tables(queries)
+        # Sub-space-major codes make each lookup a contiguous gather
+        codes = np.ascontiguousarray(codes.T)
+        similarities = np.zeros((len(queries), codes.shape[1]), dtype=np.float32)
+        for part in range(self.m):
+            similarities += np.take(tables[:, part], codes[part], axis=1)
+        return similarities
+
+    def state(self) -> dict:
+        return {"m": self.m, "codebooks": self.codebooks}
+
+    @classmethod
+    def from_state(cls, dim, state) -> "PQCodec":
+        codec = cls(dim, m=int(state["m"]))
+        codec.codebooks = state["codebooks"]
+        return codec
+
+CODECS = {"float16": Float16Codec, "int8": Int8Codec, "pq": PQCodec}
+
+class QuantizedGallery:
+    """
+    Gallery searched directly on compressed embedding codes.
+
+    The embeddings are held only as codes of the chosen codec ("float16", "int8" or "pq"), scanned in
+    chunks so no full-precision copy of the gallery is ever materialized. With `rerank` set, the
+    `rerank` best candidates by approximate distance are re-scored against the full-precision vectors,
+    which are read from `full_vectors` (e.g. the memory-mapped matrix of an `EmbeddingStore`) only for
+    those rows. Results have the same shape as `Gallery.search_batch`, so it can be passed to
+    `identify_faces.identify_all_faces`.
+
+    Example:
+        >>> store = EmbeddingStore("database/store")
+        >>> gallery = QuantizedGallery.from_store(store, codec="pq", m=64, rerank=100)
+        >>> gallery.search(query_embedding, k=3)
+        [{'label': 'Hunter Boon', 'distance': 0.393, 'image_path': 'database/images/Hunter Boon/4.png', 'hash': '...'}, ...]
+    """
+
+    def __init__(self, codec, codes, labels, image_paths, hashes=None, rows=None, full_vectors=None, rerank: int = 0,
+                 version: Optional[str] = None):
+        self.codec = codec
+        self.codes = codes
+        self.labels = np.asarray(labels, dtype=object)
+        self.image_paths = np.asarray(image_paths, dtype=object)
+        self.hashes = np.asarray(hashes if hashes is not None else [None] * len(labels), dtype=object)
+        self.rows = np.arange(len(labels)) if rows is None else np.asarray(rows, dtype=np.int64)
+        self.full_vectors = full_vectors
+        self.rerank = rerank
+        self.version = version
+
+    def __len__(self):
+        return len(self.labels)
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes
+
+    @classmethod
+    def encode(cls, embeddings, labels, image_paths, hashes=None, rows=None, codec="int8", full_vectors=None,
+               rerank: int = 0, chunk_size: int = 65536, **codec_kwargs) -> "QuantizedGallery":
+        """
+        Trains the codec on the embeddings and encodes them chunk by chunk.
+
+        Args:
+            embeddings: Array of shape (n, d). May be a memory map; it is read one chunk at a time.
+            labels (Sequence[str]): Person label for each embedding.
+            image_paths (Sequence[str]): Source image for each embedding.
+            hashes (Optional[Sequence[str]]): sha256 of each source image.
+            rows (Optional[Sequence[int]]): Row of each embedding in `full_vectors`. Defaults to 0..n-1.
+            codec (str): "float16", "int8" or "pq". Defaults to "int8".
+            full_vectors (Optional[np.ndarray]): Full-precision matrix used for re-ranking.
+            rerank (int): Number of candidates re-scored at full precision per query. 0 disables re-ranking.
+            chunk_size (int): Number of embeddings encoded at a time. Defaults to 65536.
+            **codec_kwargs: Passed to the codec, e.g. `m` for "pq".
+
+        Returns:
+            QuantizedGallery: The compressed gallery.
+        """
+        codec = CODECS[codec](dim=embeddings.shape[1], **codec_kwargs)
+        codec.train(embeddings)
+        codes = np.concatenate([codec.encode(embeddings[start:start + chunk_size]) for start in range(0, len(embeddings), chunk_size)])
+        return cls(codec, codes, labels, image_paths, hashes, rows, full_vectors, rerank)
+
+    @classmethod
+    def from_gallery(cls, gallery, codec="int8", rerank: int = 0, **codec_kwargs) -> "QuantizedGallery":
+        return cls.encode(gallery.embeddings, gallery.labels, gallery.image_paths, gallery.hashes, codec=codec,
+                          full_vectors=gallery.embeddings, rerank=rerank, **codec_kwargs)
+
+    @classmethod
+    def from_store(cls, store, codec="int8", rerank: int = 0, chunk_size: int = 65536, **codec_kwargs) -> "QuantizedGallery":
+        """
+        Encodes the live rows of an `embedding_store.EmbeddingStore`, re-ranking against its memory map.
+
+        Only the codec's training sample and one chunk of live rows are read into memory at a time, and the
+        gallery records the store's `version` so a saved copy can be checked for staleness after `load`.
+        """
+        live, embeddings = store.live, store.embeddings
+        codec = CODECS[codec](dim=store.dim, **codec_kwargs)
+        sample = np.random.default_rng(0).choice(len(live), size=min(len(live), codec.max_training_points), replace=False)
+        codec.train(embeddings[live[np.sort(sample)]])
+        codes = np.concatenate(
+            [codec.encode(embeddings[live[start:start + chunk_size]]) for start in range(0, len(live), chunk_size)]
+            or [codec.encode(np.empty((0, store.dim), dtype=np.float32))]
+        )
+        return cls(codec, codes, store.labels[live], store.image_paths[live], store.hashes[live], live, embeddings, rerank,
+                   version=store.version)
+
+    def distances(self, queries, chunk_size: int = 65536) -> np.ndarray:
+        """
+        Approximate cosine distance between each query and every code, of shape (n, len(gallery)).
+        """
+        queries = normalize(queries)
+        distances = np.empty((len(queries), len(self)), dtype=np.float32)
+        for start in range(0, len(self), chunk_size):
+            distances[:, start:start + chunk_size] = 1 - self.codec.similarities(queries, self.codes[start:start + chunk_size])
+        return distances
+
+    @instrumentation.timed("quantized_search")
+    def search_batch(self, queries, k: int = 1, rerank: Optional[int] = None) -> List[List[dict]]:
+        """
+        Finds the k closest gallery images for each query by scanning the codes.
+
+        Args:
+            queries: Embeddings of shape (n, d), or a single embedding of shape (d,).
+            k (int): Number of matches to return per query. Defaults to 1.
+            rerank (Optional[int]): Overrides the gallery's `rerank` candidate count for this call.
+
+        Returns:
+            List[List[dict]]: For each query, up to k matches ordered by increasing distance. Each match
+                              holds `label`, `distance`, `image_path` and `hash`. Re-ranked matches carry
+                              the exact distance, the others the approximate one.
+        """
+        queries = normalize(queries)
+        if len(self) == 0:
+            return [[] for _ in range(len(queries))]
+
+        rerank = self.rerank if rerank is None else rerank
+        distances = self.distances(queries)
+
+        if rerank and self.full_vectors is not None:
+            candidates = top_k(distances, max(rerank, k))
+            for row_distances, row_candidates, query in zip(distances, candidates, queries):
+                # Rows are read in sorted order so a memory map is touched sequentially
+                order = np.argsort(self.rows[row_candidates])
+                row_candidates = row_candidates[order]
+                row_distances[:] = np.inf
+                row_distances[row_candidates] = 1 - normalize(self.full_vectors[self.rows[row_candidates]]) @ query
+
+        indices = top_k(distances, k)
+        return [
+            [
+                {
+                    "label": self.labels[index],
+                    "distance": float(row_distances[index]),
+                    "image_path": self.image_paths[index],
+                    "hash": self.hashes[index],
+                }
+                for index in row_indices
+            ]
+            for row_distances, row_indices in zip(distances, indices)
+        ]
+
+    def search(self, query, k: int = 1, rerank: Optional[int] = None) -> List[dict]:
+        return self.search_batch(np.atleast_2d(query), k, rerank)[0]
+
+    def save(self, path: Union[str, Path]) -> None:
+        with open(path, "wb") as file:
+            np.savez(
+                file,
+                codec=self.codec.kind,
+                dim=self.codec.dim,
+                codes=self.codes,
+                labels=np.array(self.labels, dtype=str),
+                image_paths=np.array(self.image_paths, dtype=str),
+                hashes=np.array([image_hash or "" for image_hash in self.hashes], dtype=str),
+                rows=self.rows,
+                version=self.version or "",
+                **{f"codec_{key}": value for key, value in self.codec.state().items()},
+            )
+
+    @classmethod
+    def load(cls, path: Union[str, Path], full_vectors=None, rerank: int = 0) -> "QuantizedGallery":
+        """
+        Loads a gallery written by `save`. Pass the store's `embeddings` as `full_vectors` to re-rank.
+        The saved rows refer to the store as it was when the gallery was encoded: re-encode with
+        `from_store` whenever `version` differs from the store's `version`.
+        """
+        with np.load(path) as data:
+            dim = int(data["dim"])
+            state = {key[len("codec_"):]: data[key] for key in data.files if key.startswith("codec_")}
+            codec = CODECS[str(data["codec"])].from_state(dim, state)
+            return cls(
+                codec,
+                data["codes"],
+                list(data["labels"]),
+                list(data["image_paths"]),
+                [image_hash or None for image_hash in data["hashes"]],
+                data["rows"],
+                full_vectors,
+                rerank,
+                str(data["version"]) if "version" in data.files and str(data["version"]) else None,
+            )
+
+def recall_report(embeddings, queries, k=10, codecs=("float16", "int8", "pq"), rerank=100, **codec_kwargs):
+    """
+    Measures the recall@k lost by each codec against exact cosine search.
+
+    Args:
+        embeddings: Gallery embeddings of shape (N, d).
+        queries: Query embeddings of shape (n, d).
+        k (int): Number of neighbours compared per query. Defaults to 10.
+        codecs (Iterable[str]): Codecs to evaluate. Defaults to all of them.
+        rerank (int): Candidates re-scored at full precision for the re-ranked recall. Defaults to 100.
+        **codec_kwargs: Passed to the "pq" codec, e.g. `m`.
+
+    Returns:
+        List[dict]: One row per codec with `codec`, `bytes_per_vector`, `compression`, `recall`,
+                    `recall_reranked` and `latency_ms`. The first row is exact float32 search.
+    """
+    from gallery import Gallery
+
+    embeddings = normalize(embeddings)
+    labels = np.arange(len(embeddings))
+    exact = Gallery(embeddings, labels, labels)
+
+    start = time.perf_counter()
+    expected = [{match["label"] for match in matches} for matches in exact.search_batch(queries, k)]
+    rows = [{
+        "codec": "float32",
+        "bytes_per_vector": 4 * embeddings.shape[1],
+        "compression": 1.0,
+        "recall": 1.0,
+        "recall_reranked": 1.0,
+        "latency_ms": (time.perf_counter() - start) * 1000 / len(queries),
+    }]
+
+    def recall(results):
+        return sum(len(expected_labels & {match["label"] for match in matches}) for expected_labels, matches in zip(expected, results)) / (k * len(queries))
+
+    for codec in codecs:
+        quantized = QuantizedGallery.encode(embeddings, labels, labels, codec=codec, full_vectors=embeddings,
+                                            **(codec_kwargs if codec == "pq" else {}))
+        start = time.perf_counter()
+        results = quantized.search_batch(queries, k, rerank=0)
+        latency = (time.perf_counter() - start) * 1000 / len(queries)
+
+        rows.append({
+            "codec": codec,
+            "bytes_per_vector": quantized.codec.code_size,
+            "compression": 4 * embeddings.shape[1] / quantized.codec.code_size,
+            "recall": recall(results),
+            "recall_reranked": recall(quantized.search_batch(queries, k, rerank=rerank)),
+            "latency_ms": latency,
+        })
+
+    return rows
+
+if __name__ == "__main__":
+    # Example usage: Recall loss of each codec on a synthetic clustered gallery
+    rng = np.random.default_rng(0)
+    people = rng.normal(size=(2000, 512)).astype(np.float32)
+    embeddings = people[rng.integers(0, len(people), size=50000)] + 0.6 * rng.normal(size=(50000, 512)).astype(np.float32)
+    queries = embeddings[rng.choice(len(embeddings), size=200, replace=False)] + 0.1 * rng.normal(size=(200, 512)).astype(np.float32)
+
+    for row in recall_report(embeddings, queries, k=10, m=64):
+        print(
+            f"{row['codec']:8s} {row['bytes_per_vector']:5d} B/vector ({row['compression']:5.1f}x): "
+            f"recall@10 {row['recall']:.3f}, re-ranked {row['recall_reranked']:.3f}, {row['latency_ms']:.2f} ms/query"
+        )
@@ -1,49 +1,179 @@
+import os
 import json
-import hashlib
+import time
 import numpy as np
+import instrumentation
 from pathlib import Path
 from deepface import DeepFace
+from deepface.modules import preprocessing
+from face_cache import FaceCache, default_cache
 from image_handler import get_image_files
+from image_handler.scanner import Manifest, sha256_hash
 
-# Function to calculate the sha256 hash of a file
-def sha256_hash(file):
-    sha256 = hashlib.sha256()
-    with file.open('rb') as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            sha256.update(chunk)
-    return sha256.hexdigest()
+# Function to resolve the face cache and key for an image, or (None, None) when it cannot be cached
+def cache_entry(img_path, detector_backend, cache=None, align=True, file_hash=None, enforce_detection=True):
+    if cache is False:
+        return None, None
+    if file_hash is None:
+        # In-memory images can only be cached when the caller passes the hash of their source file
+        if not isinstance(img_path, (str, Path)) or str(img_path).startswith("data:") or not Path(img_path).is_file():
+            return None, None
+        file_hash = sha256_hash(Path(img_path))
+    return cache or default_cache(), FaceCache.key(file_hash, detector_backend, align, enforce_detection)
 
 # Function to get the vector (embedding) for a given image
-def get_vector(img_path, detector_backend="retinaface", model_name="ArcFace", enforce_detection=True):
+def get_vector(img_path, detector_backend="retinaface", model_name="ArcFace", enforce_detection=True, cache=None, file_hash=None):
+    cache, key = cache_entry(img_path, detector_backend, cache, file_hash=file_hash, enforce_detection=enforce_detection)
+    if key is not None:
+        cached = cache.get(key)
+        if cached is not None and model_name in cached["embeddings"]:
+            instrumentation.count("cache_hits", stage="represent")
+            return [
+                {"embedding": embedding.tolist(), "facial_area": face["facial_area"], "face_confidence": face["confidence"]}
+                for face, embedding in zip(cached["faces"], cached["embeddings"][model_name])
+            ]
+
+        instrumentation.count("cache_misses", stage="represent")
+
     try:
-        return DeepFace.represent(
+        with instrumentation.span("represent"):
+            results = DeepFace.represent(
+                img_path=img_path,
+                model_name=model_name,
+                detector_backend=detector_backend,
+                enforce_detection=enforce_detection,
+            )
+    except Exception as e:
+        # The "represent" span has already counted the failure
+        return f"Error: {str(e)}"
+
+    instrumentation.count("faces", len(results), stage="represent")
+
+    if key is not None:
+        # The cache only saves work, so a failed write never fails the call
+        try:
+            cache.put(
+                key,
+                faces=[{"facial_area": result["facial_area"], "confidence": result["face_confidence"]} for result in results],
+                model_name=model_name,
+                embeddings=[result["embedding"] for result in results],
+            )
+        except OSError as e:
+            instrumentation.count("failures", stage="cache", error=type(e).__name__)
+    return results
+
+# Function to detect and align the faces in a given image
+def detect_faces(img_path, detector_backend="retinaface", enforce_detection=True, align=True, cache=None, file_hash=None):
+    cache, key = cache_entry(img_path, detector_backend, cache, align, file_hash, enforce_detection)
+    if key is not None:
+        cached = cache.get(key)
+        if cached is not None and all("face" in face for face in cached["faces"]):
+            instrumentation.count("cache_hits", stage="detect")
+            return cached["faces"]
+        instrumentation.count("cache_misses", stage="detect")
+
+    with instrumentation.span("detect"):
+        faces = DeepFace.extract_faces(
             img_path=img_path,
-            model_name=model_name,
             detector_backend=detector_backend,
             enforce_detection=enforce_detection,
+            align=align,
         )
-    except Exception as e:
-        return f"Error: {str(e)}"
+    instrumentation.count("faces", len(faces), stage="detect")
+
+    if key is not None:
+        try:
+            cache.put(key, faces=faces)
+        except OSError as e:
+            instrumentation.count("failures", stage="cache", error=type(e).__name__)
+    return faces
+
+# Function to embed a batch of aligned RGB face crops with a single model instance
+@instrumentation.timed("embed")
+def embed_faces(faces, model_name="ArcFace", normalization="base"):
+    instrumentation.count("faces", len(faces), stage="embed")
+    model = DeepFace.build_model(model_name)
+    target_size = model.input_shape
+    batch = np.concatenate([
+        preprocessing.resize_image(img=face[:, :, ::-1], target_size=(target_size[1], target_size[0]))
+        for face in faces
+    ])
+    batch = preprocessing.normalize_input(img=batch, normalization=normalization)
+    return model.model.predict(batch, verbose=0)
 
 # Function to save embeddings as .npy files
 def save_embedding(embedding, output_path):
-    np.save(output_path, embedding)
+    np.save(output_path, np.asarray(embedding, dtype=np.float32))
+
+# Function to load an existing metadata database, or start an empty one when the params differ
+def load_database(metadata_output, params):
+    if Path(metadata_output).exists():
+        with open(metadata_output) as file:
+            database = json.load(file)
+        if database.get("params") == params:
+            return database
+    return {"params": params, "images": []}
+
+# Function to atomically write metadata to JSON
+def write_database(database, metadata_output):
+    tmp_path = Path(f"{metadata_output}.tmp")
+    with open(tmp_path, "w+") as file:
+        json.dump(database, file, indent=4)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, metadata_output)
 
 # Function to store metadata and embeddings
-def store_metadata_and_embeddings(images, metadata_output, embeddings_folder):
-    database = {
-        "params": {"model_name": "ArcFace", "detector_backend": "retinaface"},
-        "images": []
-    }
+@instrumentation.timed("enroll")
+def store_metadata_and_embeddings(images, metadata_output, embeddings_folder, incremental=False, detector_backend="retinaface", model_name="ArcFace", centroid_index_file=None, manifest_file=None):
+    params = {"model_name": model_name, "detector_backend": detector_backend}
+    database = {"params": params, "images": []}
+
+    # Reuse entries whose image hash was already embedded with the same params
+    existing = {}
+    if incremental:
+        for saved_image in load_database(metadata_output, params)["images"]:
+            if Path(saved_image["embedding_path"]).exists():
+                existing[saved_image["hash"]] = saved_image
+
+    report = {status: {"count": 0, "seconds": 0.0} for status in ("new", "skipped", "removed")}
+    kept_hashes = set()
+
+    # With a manifest, files whose size and mtime are unchanged are not read again to hash them
+    manifest = Manifest(manifest_file)
+
+    # Keep the per-person centroid index in step with the enrolled images, one O(d) update per image
+    centroid_index = None
+    rebuild_centroids = True
+    if centroid_index_file is not None:
+        from centroid_index import CentroidIndex
+        rebuild_centroids = not (existing and Path(centroid_index_file).exists())
+        centroid_index = CentroidIndex() if rebuild_centroids else CentroidIndex.load(centroid_index_file)
 
     for image in images:
-        results = get_vector(image)  # Get embedding from DeepFace
+        start = time.perf_counter()
+        image_hash = manifest.hash(image)  # Generate hash for the image
+
+        if image_hash in existing:
+            saved_image = existing[image_hash]
+            database["images"].append({**saved_image, "label": image.parent.name, "image_path": str(image)})
+            if centroid_index is not None and (rebuild_centroids or saved_image["label"] != image.parent.name):
+                embedding = np.load(saved_image["embedding_path"])
+                if not rebuild_centroids:
+                    centroid_index.remove(saved_image["label"], embedding, saved_image["image_path"])
+                centroid_index.add(image.parent.name, embedding, str(image))
+            kept_hashes.add(image_hash)
+            report["skipped"]["count"] += 1
+            report["skipped"]["seconds"] += time.perf_counter() - start
+            continue
+
+        results = get_vector(image, detector_backend=detector_backend, model_name=model_name, file_hash=image_hash)  # Get embedding from DeepFace
         if isinstance(results, str):
             print(f"Skipping {image}: {results}")
+            instrumentation.count("images", stage="enroll", status="failed")
             continue
         
         embedding = results[0]["embedding"]
-        image_hash = sha256_hash(image)  # Generate hash for the image
 
         # Save embedding as a .npy file
         embedding_file_path = Path(embeddings_folder) / f"{image_hash}.npy"
@@ -55,13 +185,47 @@ def store_metadata_and_embeddings(images, metadata_output, embeddings_folder):
             "image_path": str(image),
             "hash": image_hash,
             "embedding_path": str(embedding_file_path),
-            "magnitude": np.linalg.norm(embedding)
         })
+        if centroid_index is not None:
+            centroid_index.add(image.parent.name, embedding, str(image))
+        report["new"]["count"] += 1
+        report["new"]["seconds"] += time.perf_counter() - start
+
+    # Drop entries whose image files disappeared or changed
+    start = time.perf_counter()
+    for image_hash, saved_image in existing.items():
+        if image_hash not in kept_hashes:
+            if centroid_index is not None and not rebuild_centroids:
+                centroid_index.remove(saved_image["label"], np.load(saved_image["embedding_path"]), saved_image["image_path"])
+            Path(saved_image["embedding_path"]).unlink(missing_ok=True)
+            report["removed"]["count"] += 1
+    report["removed"]["seconds"] = time.perf_counter() - start
+
+    # Replace removed representatives with the closest remaining image of the same person
+    if centroid_index is not None and centroid_index.missing_representatives():
+        missing = set(centroid_index.missing_representatives())
+        candidates = {label: [] for label in missing}
+        for saved_image in database["images"]:
+            if saved_image["label"] in missing:
+                candidates[saved_image["label"]].append((saved_image["image_path"], np.load(saved_image["embedding_path"])))
+        for label, label_candidates in candidates.items():
+            centroid_index.choose_representative(label, label_candidates)
 
     # Save metadata to JSON
-    with open(metadata_output, "w+") as file:
-        json.dump(database, file, indent=4)
+    write_database(database, metadata_output)
+    manifest.save()
+    if centroid_index is not None:
+        centroid_index.save(centroid_index_file)
+
+    for status, timing in report.items():
+        instrumentation.count("images", timing["count"], stage="enroll", status=status)
+        print(f"{status.capitalize()}: {timing['count']} images in {timing['seconds']:.2f}s")
+
+    return report
 
-# Example usage: Save metadata and embeddings
-images = get_image_files("database/images")
-store_metadata_and_embeddings(images, "database/metadata.json", "database/embeddings")
+if __name__ == "__main__":
+    # Example usage: Save metadata and embeddings, embedding only new or changed images
+    images = get_image_files("database/images")
+    store_metadata_and_embeddings(images, "database/metadata.json", "database/embeddings", incremental=True, centroid_index_file="database/centroids.npz", manifest_file="database/manifest.npz")
+    if instrumentation.enabled():
+        instrumentation.write("database/metrics.json")
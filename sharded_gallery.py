@@ -0,0 +1,441 @@
+import os
+import json
+import shutil
+import tempfile
+import multiprocessing
+import numpy as np
+import instrumentation
+from embedding_store import LOCK_FILE, STORE_FILE, EmbeddingStore, atomic_write_bytes, file_lock
+from gallery import normalize, top_k
+from pathlib import Path
+from typing import Iterable, List, Optional, Union
+
+MANIFEST_FILE = "shards.json"
+PREFIX_SPACE = 1 << 32
+
+# Function to map sha256 hex digests to their leading 32 bits
+def hash_prefixes(hashes):
+    return np.array([int(image_hash[:8], 16) for image_hash in hashes], dtype=np.int64)
+
+class ShardedGallery:
+    """
+    Enrolled embeddings partitioned into shards by ranges of their sha256 hash prefix.
+
+    Each shard is an `EmbeddingStore` directory holding the faces whose image hash starts in the
+    shard's [start, end) range of 32-bit prefixes. Because sha256 is uniform, equal ranges hold
+    about equal numbers of faces. `shards.json` lists the ranges with the live row count of each and
+    is replaced atomically.
+
+    A shard that outgrows `max_rows` is split at the median prefix of its rows into two new shards;
+    the other shards are not touched. Ingest only appends to the shards its hashes fall into, and
+    `append(..., shard=name)` checks that a batch belongs to that shard.
+
+    Writers hold the gallery lock and re-read `shards.json` before routing, so a write never lands in
+    a shard another process has split away; writes to a shard missing from the manifest are refused.
+
+    Example:
+        >>> sharded = ShardedGallery.create("database/shards", shards=8, max_rows=2_000_000)
+        >>> sharded.append(embeddings, labels, hashes, image_paths)
+        >>> with ShardedSearcher("database/shards") as searcher:
+        ...     searcher.search(query_embedding, k=3)
+    """
+
+    def __init__(self, root: Union[str, Path]):
+        self.root = Path(root)
+        self.stores = {}
+        self._load()
+
+    def _load(self):
+        # Re-read the manifest and drop the open stores of shards it no longer lists
+        with open(self.root / MANIFEST_FILE) as file:
+            manifest = json.load(file)
+        self.dim = manifest["dim"]
+        self.max_rows = manifest["max_rows"]
+        self.shards = manifest["shards"]
+        names = {self.shard_name(shard) for shard in self.shards}
+        self.stores = {name: store for name, store in self.stores.items() if name in names}
+        for number, shard in enumerate(self.shards):
+            if "rows" not in shard:
+                shard["rows"] = len(self.store(number))
+
+    def lock(self):
+        """
+        Holds the gallery lock. Appends, deletes and splits of other writers wait until it is released.
+        """
+        return file_lock(self.root / LOCK_FILE)
+
+    @classmethod
+    def create(cls, root: Union[str, Path], shards: int = 8, dim: int = 512, max_rows: Optional[int] = None) -> "ShardedGallery":
+        """
+        Creates an empty sharded gallery with `shards` equal prefix ranges.
+        """
+        root = Path(root)
+        root.mkdir(parents=True, exist_ok=True)
+        bounds = np.linspace(0, PREFIX_SPACE, shards + 1).astype(np.int64)
+        ranges = [{"start": int(start), "end": int(end), "rows": 0} for start, end in zip(bounds[:-1], bounds[1:])]
+        cls._write_manifest(root, dim, max_rows, ranges)
+        for shard in ranges:
+            EmbeddingStore(root / cls.shard_name(shard), dim=dim)
+        return cls(root)
+
+    @classmethod
+    def from_store(cls, store: EmbeddingStore, root: Union[str, Path], shards: int = 8, max_rows: Optional[int] = None,
+                   chunk_size: int = 65536) -> "ShardedGallery":
+        """
+        Partitions the live rows of an existing `EmbeddingStore` into a new sharded gallery.
+        """
+        sharded = cls.create(root, shards, store.dim, max_rows)
+        live = store.live
+        for start in range(0, len(live), chunk_size):
+            rows = live[start:start + chunk_size]
+            sharded.append(store.embeddings[rows], store.labels[rows], store.hashes[rows], store.image_paths[rows], rebalance=False)
+        sharded.rebalance()
+        return sharded
+
+    @staticmethod
+    def shard_name(shard) -> str:
+        return f"shard-{shard['start']:08x}-{shard['end'] - 1:08x}"
+
+    @staticmethod
+    def _write_manifest(root, dim, max_rows, shards):
+        manifest = {"dim": dim, "max_rows": max_rows, "shards": shards}
+        atomic_write_bytes(Path(root) / MANIFEST_FILE, json.dumps(manifest, indent=4).encode())
+
+    def _save(self):
+        self._write_manifest(self.root, self.dim, self.max_rows, self.shards)
+
+    def __len__(self):
+        self._load()
+        return sum(shard["rows"] for shard in self.shards)
+
+    def store(self, number: int) -> EmbeddingStore:
+        """
+        Open store of shard `number`, refreshed to its latest rows.
+        """
+        name = self.shard_name(self.shards[number])
+        if name in self.stores:
+            self.stores[name].refresh()
+            return self.stores[name]
+        # Never create a store here: a missing directory means the shard was split away
+        if not (self.root / name / STORE_FILE).exists():
+            raise FileNotFoundError(f"Shard {name} no longer exists")
+        self.stores[name] = EmbeddingStore(self.root / name, dim=self.dim)
+        return self.stores[name]
+
+    def shard_of(self, hashes: Iterable[str]) -> np.ndarray:
+        """
+        Shard number of each hash.
+        """
+        starts = np.array([shard["start"] for shard in self.shards], dtype=np.int64)
+        return np.searchsorted(starts, hash_prefixes(hashes), side="right") - 1
+
+    def append(self, embeddings, labels: Iterable[str], hashes: Iterable[str], image_paths: Iterable[str],
+               shard: Optional[str] = None, rebalance: bool = True) -> None:
+        """
+        Routes each embedding to the shard its hash falls into and appends it there.
+
+        Args:
+            embeddings: Array of shape (n, dim).
+            labels (Iterable[str]): Person label for each embedding.
+            hashes (Iterable[str]): sha256 of each source image; decides the shard.
+            image_paths (Iterable[str]): Source image path for each embedding.
+            shard (Optional[str]): Name of a shard, from `shard_name`. If given, every hash must belong to it
+                                   and only it is written; the write is refused if the shard no longer exists.
+            rebalance (bool): If True, shards that grew beyond `max_rows` are split afterwards. Defaults to True.
+        """
+        embeddings = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+        labels, hashes, image_paths = np.asarray(list(labels)), np.asarray(list(hashes)), np.asarray(list(image_paths))
+        with self.lock():
+            self._load()
+            numbers = self.shard_of(hashes)
+            if shard is not None:
+                names = [self.shard_name(current) for current in self.shards]
+                if shard not in names:
+                    raise ValueError(f"Shard {shard} no longer exists")
+                if np.any(numbers != names.index(shard)):
+                    raise ValueError(f"{int(np.count_nonzero(numbers != names.index(shard)))} hashes do not belong to shard {shard}")
+
+            for number in np.unique(numbers):
+                members = numbers == number
+                store = self.store(number)
+                store.append(embeddings[members], labels[members], hashes[members], image_paths[members])
+                self.shards[number]["rows"] = len(store)
+            self._save()
+
+            if rebalance:
+                self._rebalance()
+
+    def delete(self, hashes: Iterable[str]) -> int:
+        """
+        Tombstones the rows of `hashes` in the shards they belong to.
+        """
+        hashes = np.asarray(list(hashes))
+        with self.lock():
+            self._load()
+            numbers = self.shard_of(hashes)
+            deleted = 0
+            for number in np.unique(numbers):
+                store = self.store(number)
+                deleted += store.delete(hashes[numbers == number])
+                self.shards[number]["rows"] = len(store)
+            self._save()
+        return deleted
+
+    def _split(self, number: int) -> bool:
+        shard, store = self.shards[number], self.store(number)
+        # The shard's own lock is held throughout, so no writer holding an outdated manifest appends to it mid-split
+        with store.lock():
+            store.refresh()
+            live = store.live
+            prefixes = hash_prefixes(store.hashes[live])
+            if len(prefixes) == 0:
+                middle = (shard["start"] + shard["end"]) // 2
+            else:
+                # The median is the first row of the upper half; if it is the shard start, the upper half begins at the next distinct prefix
+                middle = int(np.partition(prefixes, len(prefixes) // 2)[len(prefixes) // 2])
+                if middle == shard["start"]:
+                    above = prefixes[prefixes > middle]
+                    if len(above) == 0:
+                        return False
+                    middle = int(above.min())
+            if not shard["start"] < middle < shard["end"]:
+                return False
+
+            # Each half is built in a fresh temporary directory and renamed into place, so rows left behind by an
+            # interrupted split are discarded instead of appended to
+            for leftover in self.root.glob(".split-*"):
+                shutil.rmtree(leftover, ignore_errors=True)
+            halves = [{"start": shard["start"], "end": middle}, {"start": middle, "end": shard["end"]}]
+            for half in halves:
+                tmp_root = Path(tempfile.mkdtemp(prefix=".split-", dir=self.root))
+                new_store = EmbeddingStore(tmp_root, dim=self.dim)
+                rows = live[(prefixes >= half["start"]) & (prefixes < half["end"])]
+                for start in range(0, len(rows), 65536):
+                    chunk = rows[start:start + 65536]
+                    new_store.append(store.embeddings[chunk], store.labels[chunk], store.hashes[chunk], store.image_paths[chunk])
+                half["rows"] = len(rows)
+                shutil.rmtree(self.root / self.shard_name(half), ignore_errors=True)
+                os.rename(tmp_root, self.root / self.shard_name(half))
+
+            # Publish the new ranges before removing the old shard, so a reader never sees a gap
+            self.shards = self.shards[:number] + halves + self.shards[number + 1:]
+            self._save()
+            self.stores.pop(self.shard_name(shard), None)
+            shutil.rmtree(store.root, ignore_errors=True)
+        return True
+
+    def rebalance(self, shards: Optional[int] = None) -> int:
+        """
+        Splits shards until none holds more than `max_rows` live rows and there are at least `shards` of them.
+
+        Args:
+            shards (Optional[int]): Minimum number of shards, e.g. after moving to a machine with more cores.
+
+        Returns:
+            int: Number of splits made. Running `ShardedSearcher`s pick them up on `refresh`.
+        """
+        with self.lock():
+            self._load()
+            return self._rebalance(shards)
+
+    def _rebalance(self, shards=None):
+        splits, unsplittable = 0, set()
+        while True:
+            # Shards whose rows all share one prefix cannot be split; the others still can
+            sizes = [
+                (shard["rows"], number) for number, shard in enumerate(self.shards)
+                if self.shard_name(shard) not in unsplittable
+            ]
+            if not sizes:
+                return splits
+            size, largest = max(sizes)
+            too_big = self.max_rows is not None and size > self.max_rows
+            too_few = shards is not None and len(self.shards) < shards
+            if not (too_big or too_few):
+                return splits
+            if self._split(largest):
+                splits += 1
+            else:
+                unsplittable.add(self.shard_name(self.shards[largest]))
+
+# Function to open one shard in a worker: the memory-mapped matrix, its row norms and its tombstones
+def _open_shard(root, dim, chunk_size=65536):
+    store = EmbeddingStore(root, dim=dim)
+    matrix = store.embeddings
+    norms = np.concatenate([np.linalg.norm(matrix[start:start + chunk_size], axis=1) for start in range(0, len(matrix), chunk_size)] or [np.empty(0, dtype=np.float32)])
+    norms[norms == 0] = 1
+    return {"store": store, "matrix": matrix, "norms": norms}
+
+# Function to scan the shards of one worker chunk by chunk, keeping a running top-k per query
+def _search_shards(shards, queries, k, chunk_size=65536):
+    best_distances = np.full((len(queries), 0), np.inf, dtype=np.float32)
+    best_keys = np.empty((len(queries), 0, 2), dtype=np.int64)
+
+    for number, shard in enumerate(shards):
+        matrix, norms, deleted = shard["matrix"], shard["norms"], shard["store"].deleted
+        for start in range(0, len(matrix), chunk_size):
+            distances = 1 - (queries @ matrix[start:start + chunk_size].T) / norms[start:start + chunk_size]
+            distances[:, deleted[start:start + chunk_size]] = np.inf
+            positions = top_k(distances, k)
+
+            keys = np.stack(np.broadcast_arrays(number, positions + start), axis=-1)
+            best_distances = np.concatenate([best_distances, np.take_along_axis(distances, positions, axis=1)], axis=1)
+            best_keys = np.concatenate([best_keys, keys], axis=1)
+            keep = top_k(best_distances, k)
+            best_distances = np.take_along_axis(best_distances, keep, axis=1)
+            best_keys = np.take_along_axis(best_keys, keep[..., None], axis=1)
+
+    return [
+        [
+            {
+                "label": str(shards[number]["store"].labels[row]),
+                "distance": float(distance),
+                "image_path": str(shards[number]["store"].image_paths[row]),
+                "hash": str(shards[number]["store"].hashes[row]),
+            }
+            for distance, (number, row) in zip(row_distances, row_keys)
+            if np.isfinite(distance)
+        ]
+        for row_distances, row_keys in zip(best_distances, best_keys)
+    ]
+
+# Function run in each worker process: serve search and reload requests for its shards until closed
+def _serve(connection, roots, dim):
+    # Failures are sent back to the parent rather than ending the worker; a failed reload keeps the previous shards
+    shards = error = None
+    try:
+        shards = [_open_shard(root, dim) for root in roots]
+    except Exception as e:
+        error = e
+
+    while True:
+        command, *arguments = connection.recv()
+        if command == "close":
+            connection.close()
+            return
+        try:
+            if command == "reload":
+                shards = [_open_shard(root, dim) for root in roots]
+                reply = True
+            elif shards is None:
+                raise error
+            else:
+                queries, k = arguments
+                reply = _search_shards(shards, queries, k)
+        except Exception as e:
+            reply = e
+        connection.send(reply)
+
+class ShardedSearcher:
+    """
+    Searches a `ShardedGallery` with one worker process per group of shards.
+
+    Workers memory-map their shards' matrices, so the gallery is never copied into the parent and
+    each page is shared through the OS page cache. A query batch is sent to every worker, each scans
+    only its shards, and the per-shard top-k lists are merged in the parent. Workers run
+    single-threaded BLAS, so latency falls with the number of cores until there is a worker per core.
+
+    Example:
+        >>> with ShardedSearcher("database/shards", workers=8) as searcher:
+        ...     identify_all_faces("testing/query_image.png", searcher, k=3)
+    """
+
+    def __init__(self, root: Union[str, Path], workers: Optional[int] = None):
+        self.root = Path(root)
+        self.workers = workers
+        self.processes = []
+        self.connections = []
+        self.start()
+
+    def start(self):
+        gallery = ShardedGallery(self.root)
+        self.shard_names = [gallery.shard_name(shard) for shard in gallery.shards]
+        roots = [str(self.root / name) for name in self.shard_names]
+        workers = min(self.workers or os.cpu_count(), len(roots))
+
+        # Spawned workers inherit the environment, so limit their BLAS to one thread each while starting them
+        limits = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS")
+        saved = {name: os.environ.get(name) for name in limits}
+        os.environ.update({name: "1" for name in limits})
+        try:
+            context = multiprocessing.get_context("spawn")
+            for number in range(workers):
+                parent, child = context.Pipe()
+                process = context.Process(target=_serve, args=(child, roots[number::workers], gallery.dim), daemon=True)
+                process.start()
+                self.processes.append(process)
+                self.connections.append(parent)
+        finally:
+            for name, value in saved.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+
+    def close(self):
+        for connection, process in zip(self.connections, self.processes):
+            connection.send(("close",))
+            process.join()
+        self.processes, self.connections = [], []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def refresh(self):
+        """
+        Picks up appended or deleted rows, restarting the workers if the shards were rebalanced.
+        """
+        gallery = ShardedGallery(self.root)
+        if [gallery.shard_name(shard) for shard in gallery.shards] != self.shard_names:
+            self.close()
+            self.start()
+            return
+        for connection in self.connections:
+            connection.send(("reload",))
+        results = [connection.recv() for connection in self.connections]
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+    @instrumentation.timed("sharded_search")
+    def search_batch(self, queries, k: int = 1) -> List[List[dict]]:
+        """
+        Finds the k closest gallery images for each query across every shard.
+
+        Returns:
+            List[List[dict]]: For each query, up to k matches ordered by increasing distance, shaped like
+                              `Gallery.search_batch`.
+        """
+        queries = normalize(queries)
+        for connection in self.connections:
+            connection.send(("search", queries, k))
+
+        shard_results = [connection.recv() for connection in self.connections]
+        for result in shard_results:
+            if isinstance(result, Exception):
+                raise result
+
+        merged = []
+        for query_number in range(len(queries)):
+            candidates = [match for result in shard_results for match in result[query_number]]
+            order = top_k(np.array([[match["distance"] for match in candidates]], dtype=np.float32), k)[0] if candidates else []
+            merged.append([candidates[index] for index in order])
+        return merged
+
+    def search(self, query, k: int = 1) -> List[dict]:
+        return self.search_batch(np.atleast_2d(query), k)[0]
+
+if __name__ == "__main__":
+    # Example usage: Shard the packed store once, then identify against it with a worker per core
+    from identify_faces import identify_all_faces
+
+    shards_folder = "database/shards"
+    if not (Path(shards_folder) / MANIFEST_FILE).exists():
+        ShardedGallery.from_store(EmbeddingStore("database/store"), shards_folder, shards=os.cpu_count(), max_rows=2_000_000)
+
+    with ShardedSearcher(shards_folder) as searcher:
+        for result in identify_all_faces("testing/query_image.png", searcher, k=3):
+            print(json.dumps(result, indent=4, default=str))
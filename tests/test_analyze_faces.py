@@ -0,0 +1,57 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+pytest.importorskip("deepface")
+pytest.importorskip("cv2")
+import analyze_faces
+
+
+@pytest.fixture
+def images(tmp_path):
+    paths = []
+    for number in range(6):
+        path = tmp_path / "images" / f"{number}.png"
+        path.parent.mkdir(exist_ok=True)
+        path.write_bytes(b"")
+        paths.append(path)
+    return paths
+
+
+@pytest.fixture
+def in_process(monkeypatch):
+    # Chunks run in threads of this process, so the patched functions below are the ones they call
+    monkeypatch.setattr(analyze_faces, "ProcessPoolExecutor", lambda max_workers, mp_context: ThreadPoolExecutor(max_workers))
+
+    def detect_faces(image, **kwargs):
+        return [{"face": np.zeros((8, 8, 3), dtype=np.float32), "facial_area": {"x": 0, "y": 0, "w": 8, "h": 8}, "confidence": 0.9}]
+
+    monkeypatch.setattr(analyze_faces, "detect_faces", detect_faces)
+
+
+@pytest.mark.parametrize("suffix", [".jsonl", ".parquet"])
+def test_resume_retries_images_of_a_failed_batch(tmp_path, images, in_process, monkeypatch, suffix):
+    if suffix == ".parquet":
+        pytest.importorskip("pyarrow")
+    output = tmp_path / f"analysis{suffix}"
+    calls, lock = [], threading.Lock()
+
+    # The first batch fails, every later one succeeds
+    def predict_attributes(faces, actions):
+        with lock:
+            calls.append(len(faces))
+            if len(calls) == 1:
+                raise RuntimeError("injected failure")
+        return [{"age": 30.0} for _ in faces]
+
+    monkeypatch.setattr(analyze_faces, "predict_attributes", predict_attributes)
+    first = analyze_faces.analyze_all(images, output, actions=("age",), workers=1, chunk_size=2)
+    assert first["failed"] == 2 and first["analyzed"] == 4
+
+    second = analyze_faces.analyze_all(images, output, actions=("age",), workers=1, chunk_size=2)
+    assert second == {**second, "analyzed": 2, "skipped": 4, "failed": 0}
+
+    writer = analyze_faces.ParquetOutput(output, ("age",)) if suffix == ".parquet" else analyze_faces.JSONLinesOutput(output)
+    assert writer.completed() == {str(image) for image in images}